@@ -0,0 +1,283 @@
+"""
+Cold storage for old messages.
+
+'archive_old_messages' moves messages older than a given age out of the database and into
+per-room segment files next to it. A room's segment file ('room_<id>.seg') is append-only:
+messages are packed into blocks, each block is zlib-compressed and added to the end of the
+file. A small index file ('room_<id>.idx') holds one fixed-size record per block -
+(first seq, last seq, offset, length) - so a reader can find the block a message lives in
+without decompressing anything else.
+
+Readers memory-map the segment files, so scrolling back through old history only touches
+the pages of the blocks it actually decompresses - it doesn't go through SQLite's page
+cache, and the file's contents never have to be copied onto the heap wholesale. We keep
+the maps of the CHATROOM_ARCHIVE_MAPPED_ROOMS rooms read most recently (64 by default),
+so a server with thousands of archived rooms doesn't hold a map and a file for each.
+
+Run 'python archive.py --max-age-days 30' (from this folder) to archive messages by hand,
+or call 'archive_old_messages' from a scheduled job.
+"""
+import argparse
+import bisect
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+INDEX_RECORD = struct.Struct("<QQQI")  # first seq, last seq, offset into the segment file, compressed length
+MESSAGE_HEADER = struct.Struct("<QdII")  # seq, created_at, author length, body length
+NO_AUTHOR = 0xFFFFFFFF  # author length we store for messages without an author
+MAPPED_ROOMS = int(os.environ.get("CHATROOM_ARCHIVE_MAPPED_ROOMS", 64))  # rooms whose segment files we keep mapped
+
+
+def encode_block(messages):
+    """Packs (seq, author, created_at, body) rows into one compressed block"""
+    parts = []
+    for seq, author, created_at, body in messages:
+        author_bytes = b'' if author is None else author.encode("utf-8")
+        body_bytes = body.encode("utf-8")
+        parts.append(MESSAGE_HEADER.pack(seq, created_at, NO_AUTHOR if author is None else len(author_bytes), len(body_bytes)))
+        parts.append(author_bytes)
+        parts.append(body_bytes)
+    return zlib.compress(b''.join(parts))
+
+
+def decode_block(compressed):
+    """Unpacks a block written by 'encode_block' back into (seq, author, created_at, body) rows"""
+    data = memoryview(zlib.decompress(compressed))
+    messages = []
+    offset = 0
+    while offset < len(data):
+        seq, created_at, author_length, body_length = MESSAGE_HEADER.unpack_from(data, offset)
+        offset += MESSAGE_HEADER.size
+        author = None
+        if author_length != NO_AUTHOR:
+            author = str(data[offset:offset + author_length], "utf-8")
+            offset += author_length
+        body = str(data[offset:offset + body_length], "utf-8")
+        offset += body_length
+        messages.append((seq, author, created_at, body))
+    return messages
+
+
+class MessageArchive:
+    """
+    Reads and writes the segment files in one archive directory.
+
+    Reading is safe from any number of threads and processes; writing should only happen
+    through 'archive_old_messages', which holds a lock file while it appends.
+    """
+    def __init__(self, directory, mapped_rooms=MAPPED_ROOMS):
+        self.directory = directory
+        self.mapped_rooms = mapped_rooms
+        self._lock = threading.Lock()
+        self._mapped = OrderedDict()  # room_id -> (segment size when mapped, mmap, index records), least recently read first
+
+
+    def _paths(self, room_id):
+        base = os.path.join(self.directory, f"room_{room_id}")
+        return base + ".seg", base + ".idx"
+
+
+    def _read_index(self, room_id):
+        _segment_path, index_path = self._paths(room_id)
+        try:
+            with open(index_path, "rb") as index_file:
+                data = index_file.read()
+        except FileNotFoundError:
+            return []
+
+        usable = len(data) - len(data) % INDEX_RECORD.size  # ignore a record that was only half written
+        return [INDEX_RECORD.unpack_from(data, offset) for offset in range(0, usable, INDEX_RECORD.size)]
+
+
+    def last_archived_seq(self, room_id):
+        """Sequence number of the newest archived message in a room (0 if nothing is archived)"""
+        index = self._read_index(room_id)
+        return index[-1][1] if index else 0
+
+
+    def _mapping(self, room_id):
+        """
+        Returns (mmap, index records) for a room, remapping if the archive grew since we last looked.
+
+        Maps we stop keeping (the room's old one, or the least recently read room's) aren't
+        closed here - another thread may still be reading from one. Dropping our reference
+        unmaps it as soon as the last reader is done with it.
+        """
+        segment_path, _index_path = self._paths(room_id)
+        try:
+            size = os.path.getsize(segment_path)
+        except FileNotFoundError:
+            return None, []
+
+        with self._lock:
+            cached = self._mapped.get(room_id)
+            if cached is not None and cached[0] == size:
+                self._mapped.move_to_end(room_id)
+                return cached[1], cached[2]
+
+            index = [record for record in self._read_index(room_id) if record[2] + record[3] <= size]
+            if size == 0 or not index:
+                return None, []
+
+            with open(segment_path, "rb") as segment_file:
+                mapped = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mapped[room_id] = (size, mapped, index)
+            self._mapped.move_to_end(room_id)
+            while len(self._mapped) > self.mapped_rooms:
+                self._mapped.popitem(last=False)
+            return mapped, index
+
+
+    def messages_before(self, room_id, before_seq, limit):
+        """Returns up to 'limit' archived messages with a sequence number below 'before_seq', oldest first"""
+        mapped, index = self._mapping(room_id)
+        if mapped is None:
+            return []
+
+        # index records are in seq order, so we can binary search for the last block that starts before 'before_seq'
+        block = bisect.bisect_left([first_seq for first_seq, _last_seq, _offset, _length in index], before_seq) - 1
+        messages = []
+        while block >= 0 and len(messages) < limit:
+            _first_seq, _last_seq, offset, length = index[block]
+            older = [message for message in decode_block(mapped[offset:offset + length]) if message[0] < before_seq]
+            messages[:0] = older
+            block -= 1
+
+        return messages[-limit:] if limit else []
+
+
+    def messages_after(self, room_id, after_seq, limit):
+        """Returns up to 'limit' archived messages with a sequence number above 'after_seq', oldest first"""
+        mapped, index = self._mapping(room_id)
+        if mapped is None:
+            return []
+
+        # the first block that ends after 'after_seq'
+        block = bisect.bisect_right([last_seq for _first_seq, last_seq, _offset, _length in index], after_seq)
+        messages = []
+        while block < len(index) and len(messages) < limit:
+            _first_seq, _last_seq, offset, length = index[block]
+            messages.extend(message for message in decode_block(mapped[offset:offset + length]) if message[0] > after_seq)
+            block += 1
+
+        return messages[:limit]
+
+
+    def all_messages(self, room_id):
+        """Every archived message in a room, oldest first (one block in memory at a time)"""
+        mapped, index = self._mapping(room_id)
+        if mapped is None:
+            return
+
+        for _first_seq, _last_seq, offset, length in index:
+            yield from decode_block(mapped[offset:offset + length])
+
+
+    def append_block(self, room_id, messages):
+        """
+        Appends one block of messages to a room's segment and index files.
+
+        The segment is written and synced before its index record, so a crash in between
+        leaves some unreferenced bytes at the end of the segment, never a bad index record.
+        """
+        segment_path, index_path = self._paths(room_id)
+        block = encode_block(messages)
+        with open(segment_path, "ab") as segment_file:
+            offset = segment_file.seek(0, os.SEEK_END)
+            segment_file.write(block)
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+
+        with open(index_path, "ab") as index_file:
+            index_file.write(INDEX_RECORD.pack(messages[0][0], messages[-1][0], offset, len(block)))
+            index_file.flush()
+            os.fsync(index_file.fileno())
+
+
+    @contextmanager
+    def writing(self):
+        """Holds the archive's lock file, so only one archiver appends at a time"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "archive.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+    def close(self):
+        with self._lock:
+            for _size, mapped, _index in self._mapped.values():
+                mapped.close()
+            self._mapped = OrderedDict()
+
+
+def archive_old_messages(pool, archive, max_age_seconds, block_size=256):
+    """
+    Moves messages older than 'max_age_seconds' out of the database (or shard) behind 'pool' and into 'archive'.
+
+    We always archive a room's oldest messages first, one block at a time, and each block is
+    safely on disk before its rows are deleted. If we crash in between, the next run finds
+    those rows in the archive already and just deletes them. Returns how many messages moved.
+    """
+    cutoff = time.time() - max_age_seconds
+    moved = 0
+    with archive.writing():
+        with pool.connection() as conn:
+            room_ids = [room_id for (room_id,) in conn.execute("SELECT room_id FROM room_sequences")]
+
+        for room_id in room_ids:
+            archived_up_to = archive.last_archived_seq(room_id)
+            while True:
+                with pool.transaction() as conn:
+                    # rows we archived last time but didn't get to delete
+                    conn.execute("DELETE FROM messages WHERE room_id=? AND seq<=?", (room_id, archived_up_to,))
+
+                with pool.connection() as conn:
+                    oldest = conn.execute(
+                        "SELECT seq, author, created_at, body FROM messages WHERE room_id=? ORDER BY seq LIMIT ?",
+                        (room_id, block_size,),
+                    ).fetchall()
+
+                # only a run of old messages from the very start of what's left, so the archive stays in seq order
+                block = []
+                for message in oldest:
+                    if message[2] >= cutoff:
+                        break
+                    block.append(message)
+                if not block:
+                    break
+
+                archive.append_block(room_id, block)
+                archived_up_to = block[-1][0]
+                moved += len(block)
+
+                if len(block) < len(oldest) or len(oldest) < block_size:
+                    with pool.transaction() as conn:
+                        conn.execute("DELETE FROM messages WHERE room_id=? AND seq<=?", (room_id, archived_up_to,))
+                    break
+
+    return moved
+
+
+if __name__ == "__main__":
+    import utils
+
+    parser = argparse.ArgumentParser(description="Moves old messages from the database into compressed archive files")
+    parser.add_argument("--max-age-days", type=float, required=True, help="archive messages older than this")
+    parser.add_argument("--block-size", type=int, default=256, help="messages per compressed block")
+    args = parser.parse_args()
+
+    moved = sum(
+        archive_old_messages(shard_pool, utils.archive, args.max_age_days * 24 * 60 * 60, args.block_size)
+        for shard_pool in utils.shard_pools
+    )
+    print(f"Archived {moved} messages into {utils.archive.directory}")
@@ -0,0 +1,63 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncDB:
+    """
+    Runs blocking database calls (anything in utils.py) on a small pool of threads, so
+    coroutines can 'await' them and the event loop keeps handling input and printing
+    messages while SQLite commits or waits for a lock.
+
+    'queue_depth' is how many calls are waiting or running right now. If it keeps
+    climbing, the database is what's holding the chat back - 'stats()' has the details.
+    """
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.calls = 0
+        self.total_wait = 0.0  # seconds calls spent queued before a thread picked them up
+        self._executor = None
+        self._lock = threading.Lock()
+
+
+    async def run(self, func, *args):
+        """'await db.run(utils.some_helper, arg1, arg2)' calls some_helper(arg1, arg2) on a database thread"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="chat-db")
+
+        queued_at = time.perf_counter()
+
+        def call():
+            with self._lock:
+                self.total_wait += time.perf_counter() - queued_at
+            return func(*args)
+
+        # only ever touched from the event loop's thread, so no lock needed
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+        finally:
+            self.queue_depth -= 1
+            self.calls += 1
+
+
+    def stats(self):
+        """Queue depth and wait time counters"""
+        with self._lock:
+            total_wait = self.total_wait
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "calls": self.calls,
+            "average_wait_ms": 1000 * total_wait / self.calls if self.calls else 0.0,
+        }
+
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
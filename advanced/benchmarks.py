@@ -0,0 +1,285 @@
+"""
+Small benchmarks for the chat application's hot paths.
+
+Run them from this folder, e.g. 'python benchmarks.py group-commit'. Every benchmark
+works on a throwaway database in a temporary directory, never on ./chatroom_app.db.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import schema
+import utils
+import wrapping
+
+
+def _fresh_db(directory, shards=0, rooms=("bench",)):
+    """Points utils at a new, empty database in 'directory' and creates its tables"""
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+
+    db_path = os.path.join(directory, "bench.db")
+    utils.configure_db(db_path, shards=shards)
+    utils.ensure_schema()
+    for room in rooms:
+        utils.add_room_in_rooms_table(room)
+    return db_path
+
+
+def _run_senders(senders, messages_per_sender, send):
+    """Starts 'senders' threads that each call send(author, body) 'messages_per_sender' times, returns seconds taken"""
+    start = threading.Barrier(senders + 1)
+
+    def sender(n):
+        start.wait()
+        for i in range(messages_per_sender):
+            send(f"user{n}", f"message {i} from user{n} " + "x" * 150)
+
+    threads = [threading.Thread(target=sender, args=(n,)) for n in range(senders)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    began = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - began
+
+
+def bench_group_commit(args):
+    """
+    Message throughput with 1, 10 and 100 concurrent senders, committing every message
+    on its own (the old behaviour, but on a rollback journal) versus the WAL + group-commit writer.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'senders':>8} {'mode':>26} {'msgs/s':>10} {'batches':>8} {'msgs/batch':>10}")
+        for senders in args.senders:
+            total = max(senders * 5, args.messages)
+            per_sender = max(1, total // senders)
+
+            # one connection and one commit per message, rollback journal - what every send used to cost
+            db_path = _fresh_db(directory)
+            room_id = utils.get_room_id("bench")
+            utils.lookup_cache.close()
+            with utils.pool.connection() as conn:
+                conn.execute("PRAGMA journal_mode=DELETE")
+            utils.pool.close()
+
+            def send_legacy(author, body):
+                conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+                conn.execute("BEGIN IMMEDIATE")
+                utils._insert_message(conn, room_id, author, body)
+                conn.execute("COMMIT")
+                conn.close()
+
+            elapsed = _run_senders(senders, per_sender, send_legacy)
+            print(f"{senders:>8} {'commit per message':>26} {senders * per_sender / elapsed:>10.0f} {'-':>8} {'-':>10}")
+
+            _fresh_db(directory)
+            elapsed = _run_senders(senders, per_sender, lambda author, body: utils.submit_message_to_room("bench", author, body).result())
+            batches = utils.writers[0].batches_committed
+            print(f"{senders:>8} {'WAL + group commit':>26} {senders * per_sender / elapsed:>10.0f} {batches:>8} {utils.writers[0].writes_committed / batches:>10.1f}")
+
+
+def bench_shards(args):
+    """
+    Message throughput with one sender per room in 'rooms' different rooms, committing every
+    message on its own, with all rooms in one database file versus spread over N shards.
+    """
+    rooms = [f"room{n}" for n in range(args.rooms)]
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'shards':>8} {'rooms':>8} {'msgs/s':>10}")
+        for shards in args.shards:
+            _fresh_db(directory, shards=shards, rooms=rooms)
+            per_sender = max(1, args.messages // len(rooms))
+            elapsed = _run_senders(len(rooms), per_sender, lambda author, body: utils.add_message_to_room(f"room{author[4:]}", author, body))
+            print(f"{shards:>8} {len(rooms):>8} {len(rooms) * per_sender / elapsed:>10.0f}")
+
+
+def _server_load(port, rooms, clients_per_room, messages, started, results):
+    """
+    One load-generating process for 'bench_server_workers': connects 'clients_per_room' clients
+    to each of 'rooms', then the first client in each room sends 'messages' messages and the
+    others wait for all of them. Puts the time it finished on 'results'.
+    """
+    from client import ServerConnection  # needs aioconsole, which the other benchmarks don't
+
+    async def main():
+        connections = {}
+        for room in rooms:
+            connections[room] = []
+            for n in range(clients_per_room):
+                connection = await ServerConnection.connect(port=port)
+                await connection.request("create_account", user=f"{room}-{n}", password="bench")
+                await connection.subscribe(room, limit=1)
+                connections[room].append(connection)
+
+        async def send(connection, room):
+            for i in range(0, messages, 20):  # a few requests in flight at once, like a busy room
+                await asyncio.gather(*(connection.send_message(room, f"message {j} " + "x" * 150) for j in range(i, min(i + 20, messages))))
+
+        async def receive(connection):
+            received = 0
+            while received < messages:
+                message = await connection.next_message()
+                received += message.get("skipped", 1)
+
+        await asyncio.to_thread(started.wait)
+        await asyncio.gather(*(
+            send(connection, room) if n == 0 else receive(connection)
+            for room, room_connections in connections.items() for n, connection in enumerate(room_connections)
+        ))
+        results.put(time.time())
+        for room_connections in connections.values():
+            for connection in room_connections:
+                connection.close()
+
+    asyncio.run(main())
+
+
+def bench_server_workers(args):
+    """
+    Messages delivered per second by the chat server (server.py) with 1, 2 and 4 worker
+    processes. Clients are spread over 'rooms' rooms, and the kernel spreads their
+    connections over the workers, so most messages cross the bus to reach everyone.
+    The clients run in 'load_processes' processes of their own - give the machine at
+    least workers + load_processes cores, or they all end up sharing the same ones.
+
+    Don't expect more workers to beat the bus or the database writer: each message goes
+    through both once, however many workers there are (see server.py).
+    """
+    context = multiprocessing.get_context("spawn")
+    rooms = [f"room{n}" for n in range(args.rooms)]
+    cores = os.cpu_count() or 1
+    if cores < max(args.workers) + args.load_processes:
+        print(f"Only {cores} cores for up to {max(args.workers)} workers and {args.load_processes} load processes - they'll share cores, so this can't show scaling")
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'workers':>8} {'clients':>8} {'msgs/s':>10} {'deliveries/s':>13}")
+        for workers in args.workers:
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            port = args.port + workers
+            env = dict(os.environ, CHATROOM_DB_PATH=os.path.join(directory, "bench.db"), CHATROOM_SHARDS=str(args.shards))
+            command = [sys.executable, "-u", "server.py", "--port", str(port), "--workers", str(workers), "--queue-size", "1000000"]
+            server = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, text=True)
+            try:
+                for _ in range(1 + workers if workers > 1 else 1):
+                    server.stdout.readline()  # "listening on ..." from us, and from each worker
+                time.sleep(0.2)
+
+                async def create_rooms():
+                    from client import ServerConnection
+                    connection = await ServerConnection.connect(port=port)
+                    await connection.request("create_account", user="bench", password="bench")
+                    for room in rooms:
+                        await connection.request("create_room", room=room)
+                    connection.close()
+                asyncio.run(create_rooms())
+
+                load_processes = min(args.load_processes, len(rooms))
+                started = context.Barrier(load_processes + 1)
+                results = context.Queue()
+                loaders = [
+                    context.Process(target=_server_load, args=(port, rooms[n::load_processes], args.clients_per_room, args.messages, started, results))
+                    for n in range(load_processes)
+                ]
+                for loader in loaders:
+                    loader.start()
+                started.wait()
+                began = time.time()
+                elapsed = max(results.get() for _ in loaders) - began
+                for loader in loaders:
+                    loader.join()
+            finally:
+                server.terminate()
+                server.wait()
+
+            sent = len(rooms) * args.messages
+            print(f"{workers:>8} {len(rooms) * args.clients_per_room:>8} {sent / elapsed:>10.0f} {sent * (args.clients_per_room - 1) / elapsed:>13.0f}")
+
+
+def _chat_messages(count, wide_share, seed=0):
+    """
+    'count' made-up chat messages: mostly a few words, some paragraphs and the odd pasted
+    wall of text or long URL (log-normal lengths, median ~40 characters) - with about
+    'wide_share' of them in Chinese or with emoji and accents.
+    """
+    rng = random.Random(seed)
+    latin = ["the", "a", "chat", "room", "message", "ok", "thanks", "tomorrow", "meeting", "lol", "https://example.com/" + "x" * 80]
+    wide = ["你好", "谢谢", "明天见", "😀", "👍", "café", "naïve", "résumé"]
+    messages = []
+    for _ in range(count):
+        length = min(int(rng.lognormvariate(3.7, 1.0)), 20000)
+        words = wide + latin if rng.random() < wide_share else latin
+        text = []
+        while sum(map(len, text)) + len(text) < length:
+            text.append(rng.choice(words))
+        messages.append(" ".join(text))
+    return messages
+
+
+def bench_bubbles(args):
+    """
+    Drawing speech bubbles: the old wrapper versus wrapping.py, over a realistic mix of
+    message sizes - and on single messages of growing length, to show how each one scales.
+    """
+    def per_message(wrap, messages):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for message in messages:
+                wrap("alice", message)
+        return (time.perf_counter() - start) / (args.repeat * len(messages)) * 1e6
+
+    print(f"{'messages':>16} {'old (us/msg)':>13} {'new (us/msg)':>13}")
+    for wide_share in (0.0, 0.2):
+        messages = _chat_messages(args.messages, wide_share)
+        old = per_message(schema.legacy_bubble, messages)
+        new = per_message(wrapping.draw_bubble, messages)
+        print(f"{f'mix, {wide_share:.0%} wide':>16} {old:>13.1f} {new:>13.1f}")
+
+    for length in (1_000, 10_000, 100_000):
+        message = " ".join(["message"] * (length // 8))
+        old = per_message(schema.legacy_bubble, [message])
+        new = per_message(wrapping.draw_bubble, [message])
+        print(f"{f'{length} chars':>16} {old:>13.1f} {new:>13.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subcommands = parser.add_subparsers(dest="benchmark", required=True)
+
+    group_commit = subcommands.add_parser("group-commit", help=bench_group_commit.__doc__)
+    group_commit.add_argument("--senders", type=int, nargs="+", default=[1, 10, 100])
+    group_commit.add_argument("--messages", type=int, default=2000, help="total messages per run")
+    group_commit.set_defaults(run=bench_group_commit)
+
+    shards = subcommands.add_parser("shards", help=bench_shards.__doc__)
+    shards.add_argument("--shards", type=int, nargs="+", default=[0, 2, 4, 8])
+    shards.add_argument("--rooms", type=int, default=8)
+    shards.add_argument("--messages", type=int, default=4000, help="total messages per run")
+    shards.set_defaults(run=bench_shards)
+
+    server_workers = subcommands.add_parser("server-workers", help=bench_server_workers.__doc__)
+    server_workers.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    server_workers.add_argument("--rooms", type=int, default=8)
+    server_workers.add_argument("--clients-per-room", type=int, default=25)
+    server_workers.add_argument("--messages", type=int, default=200, help="messages sent in each room")
+    server_workers.add_argument("--shards", type=int, default=4, help="so the database isn't what we're measuring")
+    server_workers.add_argument("--load-processes", type=int, default=4)
+    server_workers.add_argument("--port", type=int, default=8800, help="we use this port + the number of workers")
+    server_workers.set_defaults(run=bench_server_workers)
+
+    bubbles = subcommands.add_parser("bubbles", help=bench_bubbles.__doc__)
+    bubbles.add_argument("--messages", type=int, default=2000, help="messages in each mix")
+    bubbles.add_argument("--repeat", type=int, default=5)
+    bubbles.set_defaults(run=bench_bubbles)
+
+    args = parser.parse_args()
+    args.run(args)
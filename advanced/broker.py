@@ -0,0 +1,170 @@
+"""
+A tiny local message broker, so chat clients hear about new messages the moment they're sent
+instead of polling the database.
+
+Start it once per machine (from this folder) with 'python broker.py'. Clients connect over a
+Unix domain socket, subscribe to the rooms they're in, and publish every message right after
+it's committed. The broker passes each message on to that room's other subscribers and keeps
+nothing itself - the database stays the source of truth. A client that falls behind (a gap
+in the sequence numbers) or reconnects after losing the broker catches up from the database,
+and clients fall back to polling whenever the broker isn't running.
+
+The protocol is one JSON object per line:
+    {"op": "subscribe", "room": ...}
+    {"op": "unsubscribe", "room": ...}
+    {"op": "publish", "room": ..., "seq": ..., "author": ..., "created_at": ..., "body": ...}
+(plus any other fields the publisher wants to pass on, like the chat server's ids) and
+subscribers receive publishes as {"op": "message", ...} with the same fields - or, if
+they've fallen too far behind, {"op": "resync", "skipped": N} (see outbound.py).
+"""
+import argparse
+import asyncio
+import json
+import os
+from collections import defaultdict
+
+import utils
+from outbound import OUTBOUND_POLICY, OUTBOUND_QUEUE_SIZE, POLICIES, OutboundQueue, total_stats
+
+SOCKET_PATH = os.environ.get("CHATROOM_BROKER_SOCKET", os.path.splitext(utils.pool.db_path)[0] + ".broker.sock")
+
+
+def resync_marker(skipped):
+    return (json.dumps({"op": "resync", "skipped": skipped}) + "\n").encode("utf-8")
+
+
+class Broker:
+    def __init__(self, queue_size=OUTBOUND_QUEUE_SIZE, policy=OUTBOUND_POLICY):
+        self.queue_size = queue_size
+        self.policy = policy
+        self.subscribers = defaultdict(set)  # room -> StreamWriters subscribed to it
+        self.queues = {}  # StreamWriter -> its OutboundQueue
+        self.published = 0
+        self.delivered = 0
+
+
+    def publish(self, room, message, sender=None):
+        """Queues an encoded message line for every subscriber of 'room' (except the one who sent it)"""
+        self.published += 1
+        for subscriber in list(self.subscribers.get(room, ())):
+            if subscriber is sender:
+                continue
+            if not self.queues[subscriber].put(message):
+                subscriber.transport.abort()  # too far behind - it'll catch up from the database
+                continue
+            self.delivered += 1
+
+
+    async def _send_outbound(self, writer, queue):
+        try:
+            while True:
+                writer.write(b"".join(await queue.get_batch()))
+                await writer.drain()
+        except ConnectionError:
+            writer.transport.abort()
+
+
+    def stats(self):
+        return {"published": self.published, "delivered": self.delivered, **total_stats(self.queues.values())}
+
+
+    async def handle_client(self, reader, writer):
+        rooms = set()
+        self.queues[writer] = OutboundQueue(self.queue_size, self.policy, marker=resync_marker)
+        sender = asyncio.create_task(self._send_outbound(writer, self.queues[writer]))
+        try:
+            async for line in reader:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    break  # valid JSON, but not a request - as good as nonsense
+                op, room = request.get("op"), request.get("room")
+                if op == "subscribe":
+                    self.subscribers[room].add(writer)
+                    rooms.add(room)
+                elif op == "unsubscribe":
+                    self.subscribers[room].discard(writer)
+                    rooms.discard(room)
+                elif op == "publish":
+                    request["op"] = "message"
+                    self.publish(room, (json.dumps(request) + "\n").encode("utf-8"), sender=writer)
+        except (ConnectionError, ValueError):
+            pass  # a client that goes away or talks nonsense just gets dropped
+        finally:
+            sender.cancel()
+            del self.queues[writer]
+            for room in rooms:
+                self.subscribers[room].discard(writer)
+                if not self.subscribers[room]:
+                    del self.subscribers[room]
+            writer.close()
+
+
+    async def start(self, socket_path=SOCKET_PATH):
+        """Starts listening on 'socket_path' and returns the asyncio server (see 'serve')"""
+        if os.path.exists(socket_path):
+            os.remove(socket_path)  # left over from a broker that didn't shut down cleanly
+        return await asyncio.start_unix_server(self.handle_client, path=socket_path)
+
+
+    async def serve(self, socket_path=SOCKET_PATH):
+        server = await self.start(socket_path)
+        async with server:
+            await server.serve_forever()
+
+
+class BrokerClient:
+    """One client's connection to the broker (see 'connect')"""
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+
+    @classmethod
+    async def connect(cls, socket_path=SOCKET_PATH):
+        """Connects to the broker, or returns None if it isn't running"""
+        try:
+            reader, writer = await asyncio.open_unix_connection(socket_path)
+        except OSError:
+            return None
+        return cls(reader, writer)
+
+
+    async def _send(self, request):
+        self.writer.write((json.dumps(request) + "\n").encode("utf-8"))
+        await self.writer.drain()
+
+
+    async def subscribe(self, room):
+        await self._send({"op": "subscribe", "room": room})
+
+
+    async def unsubscribe(self, room):
+        await self._send({"op": "unsubscribe", "room": room})
+
+
+    async def publish(self, room, seq, author, created_at, body, **extra):
+        """Publishes a message - any 'extra' fields are passed on to subscribers as they are"""
+        await self._send({"op": "publish", "room": room, "seq": seq, "author": author, "created_at": created_at, "body": body, **extra})
+
+
+    async def next_message(self):
+        """Waits for the next message in any subscribed room. Raises ConnectionError if the broker goes away."""
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("lost the connection to the message broker")
+        return json.loads(line)
+
+
+    def close(self):
+        self.writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pushes new chat messages to the clients in each room")
+    parser.add_argument("--socket", default=SOCKET_PATH, help="path of the Unix domain socket to listen on")
+    parser.add_argument("--queue-size", type=int, default=OUTBOUND_QUEUE_SIZE, help="messages a subscriber can fall behind by")
+    parser.add_argument("--slow-client-policy", choices=POLICIES, default=OUTBOUND_POLICY, help="what to do when a subscriber falls further behind")
+    args = parser.parse_args()
+
+    print(f"Broker listening on {args.socket}")
+    asyncio.run(Broker(args.queue_size, args.slow_client_policy).serve(args.socket))
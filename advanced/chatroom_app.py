@@ -1,12 +1,31 @@
 import asyncio
+import os
 import sqlite3
-from multiprocessing import Process, Queue
-from concurrent.futures import CancelledError
+from collections import deque
 
 from aioconsole import ainput, aprint  # asynchronous implementations of python's built-in "input()" and "print()" functions
 
+import passwords
 import utils
-from speech_bubble import SpeechBubble
+from async_db import AsyncDB
+from broker import BrokerClient
+from db_watcher import DatabaseWatcher
+from outbound import COALESCE_MAX_DELAY, COALESCE_WINDOW
+from screen import ChatScreen
+from speech_bubble import renderer
+
+
+# how many messages we show when joining a room, and per '/more' when scrolling back
+HISTORY_PAGE_SIZE = int(os.environ.get("CHATROOM_HISTORY_PAGE_SIZE", 50))
+
+# history is fetched, drawn and written this many messages at a time (see 'SharedChat.show_history')
+HISTORY_CHUNK_SIZE = int(os.environ.get("CHATROOM_HISTORY_CHUNK_SIZE", 100))
+
+# coroutines run their database calls through this, so a slow commit or a lock wait never freezes the chat
+db = AsyncDB()
+
+# without the message broker, how often we try to reconnect to it while the room is quiet
+BROKER_RETRY_SECONDS = 5
 
 
 class ChatApp:
@@ -19,92 +38,121 @@ class ChatApp:
 
 
     def ensure_db_initialized(self):
-        conn = sqlite3.connect("chatroom_app.db")
-
-        # create a table (if it doesn't already exist)
-        with conn:
-            conn.execute("""CREATE TABLE IF NOT EXISTS administrative (
-                            users,
-                            passwords
-                        );""")
-            
-            conn.execute("""CREATE TABLE IF NOT EXISTS rooms (
-                         room_name,
-                         room_content,
-                         room_update
-            );""")
+        """Creates the database's tables, or upgrades an existing database to the current schema (see schema.py)"""
+        utils.ensure_schema()
+
+
+    # Everything ChatApp and SharedChat need from the database goes through a handful of small
+    # methods like these, so a client of the chat server (see client.py) can answer them over
+    # the network instead.
+
+    async def user_exists(self, username):
+        return await db.run(utils.query_exists_long, username)
+
+
+    async def password_matches(self, username, password):
+        return await passwords.check_password(db, username, password)
+
+
+    async def create_user(self, username, password):
+        """Creates an account - returns False if the username is already taken"""
+        try:
+            await passwords.create_account(db, username, password)
+        except sqlite3.IntegrityError:  # usernames are unique
+            return False
+        return True
+
+
+    async def room_exists(self, room):
+        return await db.run(utils.query_exists_short, room)
+
+
+    async def create_room(self, room):
+        """Creates a room - returns False if it already exists"""
+        try:
+            await db.run(utils.add_room_in_rooms_table, room)
+        except sqlite3.IntegrityError:
+            return False
+        return True
 
 
-    def ensure_logged_in(self):
+    def new_chat(self, room):
+        return SharedChat(self.current_user, room, '')  # we pass '' here because it simplifies subclassing later
+
+
+    async def ensure_logged_in(self):
         '''
         Before users can access a chatroom, we make sure they are logged in.
 
         If they're not, we ask them to log in or create an account.
         '''        
-        if utils.query_exists_long(self.current_user):
+        if self.current_user is not None and await self.user_exists(self.current_user):
             return True
 
         while True:
-            print("Do you have an account or do you want to create one?\n\na) Log in to my account\nb) Create account\n\n")
-            answer = input("> ").lower()  # Convert input to lowercase for case-insensitive comparison
+            await aprint("Do you have an account or do you want to create one?\n\na) Log in to my account\nb) Create account\n\n")
+            answer = (await ainput("> ")).lower()  # Convert input to lowercase for case-insensitive comparison
 
             if answer == 'a':
-                if self.log_in():
+                if await self.log_in():
                     return True  # exit the loop if login is successful
             elif answer == 'b':
-                if self.create_account_and_log_in():
+                if await self.create_account_and_log_in():
                     return True  # exit the loop if account creation is successful
             else:
-                print("\nInvalid option. Please enter 'a' to log in or 'b' to create an account.")
+                await aprint("\nInvalid option. Please enter 'a' to log in or 'b' to create an account.")
 
 
-    def log_in(self):
+    async def log_in(self):
         """
         Helps users log in.
         """
         while True:
-            print("Press 'q' to return to the main menu")
-            print("What is your username?")
+            await aprint("Press 'q' to return to the main menu")
+            await aprint("What is your username?")
             
-            username = input("> ")
+            username = await ainput("> ")
             if username == 'q':
                 return False
             
-            if not utils.query_exists_long(username):   # if this runs, username does not exist
-                print("Invalid username!\n")
+            if not await self.user_exists(username):   # if this runs, username does not exist
+                await aprint("Invalid username!\n")
                 continue
 
-            self.current_user = username
-            print(f"Thank you, {username}!")
+            await aprint(f"Thank you, {username}!")
 
             # if we reach here, user has given valid username
             while True:
-                print("What is your password?")
-                print("Press 'q' to return to the main menu")
-                password = input("> ")
+                await aprint("What is your password?")
+                await aprint("Press 'q' to return to the main menu")
+                password = await ainput("> ")
                 if password == 'q':
                     return False
                 
-                elif password != utils.get_password_from_username(username):
-                    print("Incorrect password!\n")
+                elif not await self.password_matches(username, password):
+                    await aprint("Incorrect password!\n")
                     continue
 
+                self.current_user = username
                 return True
         
 
-    def create_account_and_log_in(self):
+    async def create_account_and_log_in(self):
         """
         Creates account and logs user in.
         """
-        print("Press 'q' to return to the main menu")
-        print("Please create a username")
-        username = input("> ")
+        await aprint("Press 'q' to return to the main menu")
+        await aprint("Please create a username")
+        username = await ainput("> ")
         if username == 'q':
             return False
 
-        print("Please create a password")
-        password = input("> ")
-        utils.create_user_and_password(username, password)
+        await aprint("Please create a password")
+        password = await ainput("> ")
+        if not await self.create_user(username, password):
+            await aprint(f"The username {username} is already taken!\n")
+            return False
+
         self.current_user = username
         return True
 
@@ -115,7 +163,7 @@ class ChatApp:
 
         This method leaves creation/joining chatrooms to callees.
         """
-        print("Congratulations on logging in!")
+        await aprint("Congratulations on logging in!")
 
         while True:
             await aprint("Press 'a' to join a shared chat room or 'b' to create your own")
@@ -143,7 +191,7 @@ class ChatApp:
             if response == 'q':
                 return False
 
-            if utils.query_exists_short(response):
+            if await self.room_exists(response):
                 await aprint(f"{response} already exists. Do you want to return to the main menu to join it?")
                 answer = await ainput("> ")
                 if answer == 'yes':
@@ -155,7 +203,10 @@ class ChatApp:
                     await aprint("Please write 'yes' or 'no'!\n")
                     continue
 
-            utils.add_room_in_rooms_table(response)
+            if not await self.create_room(response):  # someone else created it since we checked
+                await aprint(f"{response} already exists!\n")
+                continue
+
             await aprint(f"Congratulations! You've created room {response}")
             return
         
@@ -173,13 +224,13 @@ class ChatApp:
             if response == 'q':
                 return False
 
-            elif not utils.query_exists_short(response):  # if this runs, the room does not exist
+            elif not await self.room_exists(response):  # if this runs, the room does not exist
                 await aprint("Room doesn't exist!\n")
                 await aprint("If you would like to create the room, please return to the main menu")
                 continue
 
             else:
-                chatroom = SharedChat(self.current_user, response, '')  # we pass '' here because it simplifies subclassing later
+                chatroom = self.new_chat(response)
                 return await chatroom.join_chat(response)
 
 
@@ -187,7 +238,7 @@ class ChatApp:
         """Essentially runs the chat application"""
         while True:
             self.ensure_db_initialized()
-            self.ensure_logged_in()
+            await self.ensure_logged_in()
             await self.get_chat_room()
 
             while True:
@@ -206,166 +257,536 @@ class ChatApp:
                     await aprint("\nPlease answer 'yes' or 'no'!")
 
 
+async def in_chunks(rows, size=HISTORY_CHUNK_SIZE):
+    """Hands out a list of rows 'size' at a time, for 'SharedChat.show_history'"""
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+class RoomState:
+    """
+    What a SharedChat keeps for each room it's in.
+
+    'recent' holds the room's latest messages, as (seq, author, created_at, text) rows, so
+    switching back to a room shows them straight away without asking the database again.
+    """
+    def __init__(self, history_page_size):
+        self.last_seq = None  # sequence number of the last message we've seen (None until the room's history is loaded)
+        self.oldest_seq = None  # sequence number of the oldest message we've shown - '/more' pages back from here
+        self.sent_seqs = set()  # our own messages - we print these when we send them, so the checker skips them
+        self.unread = 0  # messages that arrived while another room was on screen
+        self.recent = deque(maxlen=history_page_size)
+
+
 class SharedChat(ChatApp):
     """
     Look at the comments at the start of the program for general
     details about this class' function/position in the program
     
-    This class manages chat "instances." Each user/room is an instance.
+    This class manages chat "instances." Each user is an instance.
     Different users in the same room access the chat through different
     SharedChat instances.
+
+    One instance can be in many rooms at once ('self.rooms') - a single checker task,
+    broker connection and database watcher cover all of them, and 'self.current_room'
+    is the one on screen.
     """
-    def __init__(self, current_user, room, room_content):
-        super().__init__(current_user, current_room)
+    def __init__(self, current_user, room, room_content, history_page_size=HISTORY_PAGE_SIZE):
+        super().__init__(current_user, room)
         self.current_room = room  # note, we override the parent class' self.current_room method
         self.room_content = room_content
+        self.history_page_size = history_page_size
+        self.rooms = {}  # room name -> RoomState, for every room we're in
+        self.broker = None  # our BrokerClient while the message broker is running (see broker.py), otherwise we poll
+        self.watcher = None  # wakes us when our rooms' database files change, when we have to poll (see db_watcher.py)
+        self.screen = None  # our ChatScreen while we're in the chat on a terminal (see screen.py), otherwise we just print
+        self.sending = asyncio.Lock()  # held from a send until its seq is in 'sent_seqs' - see 'self.fetch_new_content'
+        self.screen_writes = 0  # how many times 'self.print_new_content' printed
+        self.updates_printed = 0  # ... and how many updates those covered
 
 
     async def update_room_content_class_db(self, message, room):
         """
-        Given a 'beautified' message and a room name, we update the
-        class 'room_content' attribute and 'room_content' database column.
-        """
-        conn = sqlite3.connect("chatroom_app.db")
-        cursor = conn.cursor()
+        Given a message's text and a room name, we append the message to the
+        room's rows in the messages table.
 
-        pre_update_content = self.room_content
-        if self.room_content == '':  # if we're just joining the chat, we check if there's previous chat history - if not, we initialize with ''
-            pre_update_content = utils.get_room_content_from_db(room)
+        The write goes through the group-commit writer, so other sends arriving at the
+        same moment share its commit, and we wait for it without blocking the event loop.
 
-        self.room_content = pre_update_content + message  # basically gets the current room content and appends user's message
-        cursor.execute("UPDATE rooms SET room_content=? WHERE room_name=?", (self.room_content, room,))
-        conn.commit()
-        conn.close()
+        Once it's committed we hand it to the message broker (if it's running), which pushes
+        it to everyone else in the room.
+        """
+        async with self.sending:
+            commit = await db.run(utils.submit_message_to_room, room, self.current_user, message)
+            seq, created_at = await asyncio.wrap_future(commit)
+            state = self.rooms[room]
+            state.sent_seqs.add(seq)
+            state.recent.append((seq, self.current_user, created_at, message))
+        if self.broker is not None:
+            try:
+                await self.broker.publish(room, seq, self.current_user, created_at, message)
+            except ConnectionError:
+                self.broker = None  # the others will still find the message in the database
         return
 
 
+    async def connect_to_broker(self):
+        """
+        Connects to the message broker and subscribes to all of our rooms. Returns False if the broker isn't running.
+
+        'self.subscribe' subscribes to a room before reading its messages from the database, so
+        nothing sent in between can slip past both.
+        """
+        self.broker = await BrokerClient.connect()
+        if self.broker is None:
+            return False
+        try:
+            for room in self.rooms:
+                await self.broker.subscribe(room)
+        except ConnectionError:
+            self.broker = None
+            return False
+        return True
+
+
+    async def subscribe(self, room):
+        """
+        Adds 'room' to the rooms we're in (if it isn't already) and loads its latest page of messages.
+
+        We subscribe to it on the broker and start watching its database file first, so
+        anything sent while we read the history is picked up afterwards.
+        """
+        if room in self.rooms:
+            return self.rooms[room]
+
+        state = self.rooms[room] = RoomState(self.history_page_size)
+        if self.broker is not None:
+            try:
+                await self.broker.subscribe(room)
+            except ConnectionError:
+                self.broker = None
+        self.watcher.add(utils.shard_pool_for_room(room))
+
+        chat_history = await db.run(utils.get_recent_room_messages, room, self.history_page_size)
+        state.recent.extend(chat_history)
+        if chat_history:
+            state.oldest_seq = chat_history[0][0]
+        state.last_seq = chat_history[-1][0] if chat_history else 0
+
+        # anything the broker pushed while we were reading was dropped (we had no cursor yet)
+        self.deliver(room, await db.run(utils.get_room_messages_after, room, state.last_seq))
+        return state
+
+
+    async def unsubscribe(self, room):
+        """Stops following 'room' (its database file stays watched if we're in any other room on it)"""
+        del self.rooms[room]
+        if self.broker is not None:
+            try:
+                await self.broker.unsubscribe(room)
+            except ConnectionError:
+                self.broker = None
+
+
+    def deliver(self, room, messages):
+        """
+        Moves 'room's cursor past 'messages' (rows from the database or the broker) and returns what to print.
+
+        That's the messages themselves if the room is on screen. Otherwise we count them as
+        unread, and return a one-line notice when the room goes from no unread messages to some.
+        """
+        state = self.rooms.get(room)
+        if state is None or state.last_seq is None:
+            return ''
+        messages = [message for message in messages if message[0] > state.last_seq]  # we may have seen these already
+        if not messages:
+            return ''
+
+        state.last_seq = messages[-1][0]
+        messages = [message for message in messages if message[0] not in state.sent_seqs]
+        state.sent_seqs = {seq for seq in state.sent_seqs if seq > state.last_seq}
+        state.recent.extend(messages)
+        if not messages or room == self.current_room:
+            return self.render(room, messages)
+
+        state.unread += len(messages)
+        if state.unread == len(messages):
+            return f"(new messages in {room} - type '/switch {room}' to read them)"
+        return ''
+
+
+    async def fetch_new_content(self):
+        """
+        Returns the messages other users have sent since our cursors and moves the cursors forward.
+
+        This covers every room we're in with one query per database file (see
+        'utils.get_new_messages_in_rooms'), and each room only reads rows after its cursor, so a check
+        costs as much as the new traffic, and identical messages can't be confused with each other.
+
+        We wait for any send of ours that's in flight: once its row is committed we could read
+        it before the send has put it in 'sent_seqs', and show our own message twice.
+        """
+        async with self.sending:
+            cursors = {room: state.last_seq for room, state in self.rooms.items() if state.last_seq is not None}
+            if not cursors:
+                return ''
+            new_messages = await self.new_messages_in_rooms(cursors)
+        return '\n'.join(content for content in (self.deliver(room, messages) for room, messages in new_messages.items()) if content)
+
+
+    async def new_messages_in_rooms(self, cursors):
+        """{room: messages after cursor} for the {room: cursor} we're given"""
+        return await db.run(utils.get_new_messages_in_rooms, cursors)
+
+
+    async def receive_new_content(self):
+        """
+        Waits for the message broker to push the next message in one of our rooms and returns what
+        to print ('' if there's nothing to show, e.g. we had already seen it).
+
+        Pushed messages cost no database queries. If one arrives out of order - a sequence
+        number we haven't reached yet, because something we never heard about came first -
+        we catch up from the database instead. Raises ConnectionError if the broker goes away.
+        """
+        return await self.handle_pushed_message(await self.broker.next_message())
+
+
+    async def handle_pushed_message(self, message):
+        """Takes a message someone pushed to us (see 'self.receive_new_content') and returns what to print"""
+        if message.get("op") == "resync":
+            return await self.fetch_new_content()  # we fell behind and they dropped what we missed
+        room, seq = message["room"], message["seq"]
+        state = self.rooms.get(room)
+        if state is None or state.last_seq is None:
+            return ''
+
+        # the broker doesn't send us our own messages, so step over them first
+        while state.last_seq + 1 in state.sent_seqs:
+            state.last_seq += 1
+        if seq > state.last_seq + 1:
+            return await self.fetch_new_content()
+
+        return self.deliver(room, [(seq, message["author"], message["created_at"], message["body"])])
+
+
     async def get_and_handle_user_input(self):
         """Accepts and handles user input in the chat room"""
         while True:
-            conn = sqlite3.connect("chatroom_app.db")
-            cursor = conn.cursor()
-            cursor.execute("SELECT room_update FROM rooms WHERE room_name=?", (self.current_room,))
-            if cursor.fetchall()[0] == '1':
-                self.room_content = utils.get_room_content_from_db(self.current_room)
-                cursor.execute("UPDATE rooms set room_update=? WHERE room_name=?", ('0', self.current_room,))
-                conn.commit()
-            conn.close()
-
-            raw_message = await ainput("> ")
+            raw_message = await self.read_input()
             if raw_message == 'q':
-                # Monkey patching to partially resolve an async.gather bug
-                # (also see 'self.run_chat_rountine', 'self.thin_wrapper', and CheckUpdateRoomContent.__anext__)
-                conn = sqlite3.connect("chatroom_app.db")
-                cursor = conn.cursor()
-                cursor.execute("UPDATE rooms set room_update=? WHERE room_name=?", ('-1', self.current_room,))
-                conn.commit()
-                conn.close()
-                raise CancelledError
-
-            bubble = SpeechBubble(self.current_user, raw_message)
-            await self.update_room_content_class_db(await bubble.beautify(), self.current_room)  # add user input to database - should the be a class method or unattached (does it rely on aioconsole?)
-    
+                return  # 'self.run_chat_routine' stops the checker task and leaves our rooms
+
+            if raw_message == '/more':
+                await self.show_older_messages()
+                continue
+
+            if raw_message == '/history':
+                await self.show_whole_history()
+                continue
+
+            if raw_message == '/stats':
+                await self.show_stats()
+                continue
+
+            if raw_message == '/rooms':
+                await self.show_rooms()
+                continue
+
+            command, _, room = raw_message.partition(' ')
+            if command == '/join':
+                await self.join_room_command(room.strip())
+                continue
 
-    async def check_update_room_content(self, queue, room):  # async_generator
+            if command == '/switch':
+                await self.switch_room_command(room.strip())
+                continue
+
+            if command == '/leave':
+                await self.leave_room_command(room.strip())
+                continue
+
+            await self.show(renderer.render(None, self.current_user, raw_message))
+            await self.update_room_content_class_db(raw_message, self.current_room)  # add user input to database - we store the text, and draw the bubble whenever it's shown
+
+
+    def render(self, room, messages):
+        """Draws (seq, author, created_at, text) rows from 'room' as speech bubbles, one after another"""
+        return '\n'.join(renderer.render((room, seq), author, text) for seq, author, _created_at, text in messages)
+
+
+    async def show_history(self, room, chunks):
+        """
+        Shows messages from 'room' as the async iterator 'chunks' produces them (lists of
+        (seq, author, created_at, text) rows), and returns how many there were.
+
+        Each chunk is drawn and printed - waiting until the terminal has taken it - before we
+        ask for the next one, so the first messages show up straight away, and we never hold
+        more than a chunk or two of the history (or of its output) however long it is. The
+        ChatScreen only draws a screenful, and doesn't wait for anything, so we pause it
+        meanwhile: the history goes into the terminal's own scrollback, where it can be read.
+        """
+        shown = 0
+        if self.screen is not None:
+            self.screen.pause()
+        try:
+            async for chunk in chunks:
+                text = self.render(room, chunk)
+                await aprint(text)
+                if self.screen is not None:
+                    self.screen.write(text)  # so it's still there once the screen is back
+                shown += len(chunk)
+        finally:
+            if self.screen is not None:
+                self.screen.resume()
+        return shown
+
+
+    async def show(self, text, clear=False):
+        """
+        Puts 'text' in the chat, under what's already there - 'clear' starts from an empty
+        screen (e.g. for another room). On a terminal the ChatScreen draws it; otherwise we print it.
         """
-        This runs in a subprocess. Every user runs this checker function. It looks to see whether
-        other users have sent messages. It does this by querying the room_content table of the rooms database
-        and checks whether the room_content in the shared database is different from the user's local version
-        (stored in the SharedClass.room_content class attribute).
+        if self.screen is None:
+            await aprint('\n' * 25 + text if clear else text)
+            return
+        if clear:
+            self.screen.clear()
+        self.screen.write(text)
 
-        If there is new content in a chatroom, this function sets the "room_update" column to '1'.
-        The main process (what function in it?) queries the "room_update" column, and when it is equal to '1', the main process
-        fetches the new content. This is how users chat instances are notified when other users send messages.
 
-        Finally, this function sends new messages to a wrapper function in the main process which prints
-        the messages.
-        
-        Some error handling performed by the caller function.
+    async def read_input(self):
+        """The next line the user enters in the chat"""
+        if self.screen is None:
+            return await ainput("> ")
+        return await self.screen.read_line("> ")
+
+
+    def screen_stats(self):
+        stats = f"screen: {self.updates_printed} updates in {self.screen_writes} writes"
+        if self.screen is not None:
+            stats += f", {self.screen.stats()}"
+        return stats
+
+
+    async def join_room_command(self, room):
+        """'/join <room>' - also follow 'room' in this session, and switch to it"""
+        if room not in self.rooms:
+            if not await self.room_exists(room):
+                await self.show("Room doesn't exist!")
+                return
+            await self.subscribe(room)
+        await self.switch_room_command(room)
+
+
+    async def switch_room_command(self, room):
+        """'/switch <room>' - show another room we're in. Its latest messages are already in memory, so this is instant."""
+        if room not in self.rooms:
+            await self.show(f"You're not in {room} - type '/join {room}' to join it")
+            return
+
+        self.current_room = room
+        state = self.rooms[room]
+        state.unread = 0
+        await self.show(f"--- {room} ---", clear=True)
+        if not state.recent:
+            await self.show(f"Congratulations on joining {room}!")
+            await self.show("Send a message!")
+        else:
+            await self.show_history(room, in_chunks(list(state.recent)))
+            state.oldest_seq = state.recent[0][0]  # '/more' carries on from what's on screen now, not from the page we joined with
+        if state.oldest_seq is not None and state.oldest_seq > 1:
+            await self.show("Type '/more' to see older messages, or '/history' for all of them")
+
+
+    async def leave_room_command(self, room):
+        """'/leave <room>' - stop following 'room' (pressing 'q' leaves all of them)"""
+        if room not in self.rooms:
+            await self.show(f"You're not in {room}")
+            return
+        if len(self.rooms) == 1:
+            await self.show("That's your only room - press 'q' to leave it")
+            return
+
+        await self.unsubscribe(room)
+        await self.show(f"You left {room}")
+        if room == self.current_room:
+            await self.switch_room_command(next(iter(self.rooms)))
+
+
+    async def show_rooms(self):
+        """'/rooms' - the rooms we're in, with how many unread messages each has"""
+        for room, state in self.rooms.items():
+            marker = '*' if room == self.current_room else ' '
+            await self.show(f"{marker} {room}" + (f" ({state.unread} unread)" if state.unread else ''))
+
+
+    async def show_older_messages(self):
         """
-        while True:
-            await asyncio.sleep(1)
-            conn = sqlite3.connect("chatroom_app.db")
-            cursor = conn.cursor()
-            new_content = utils.get_room_content_from_db(room).replace(self.room_content, "")  # essentially take the difference of the most current string and the previous to find new messages
-            if new_content != '':
-                # sets room_update flag in database
-                # other users' chat applications will see this flag and update their local chatroom data
-                cursor.execute("UPDATE rooms SET room_update=? WHERE room_name=?", ('1', room,))
-                conn.commit()
-                conn.close()
-
-                # send new_content to parent process which will handle/print it
-                yield queue.put_nowait(new_content)
-                continue
+        Scrollback: prints the page of messages sent before the oldest one we've shown so far.
+
+        Only that page is fetched, and we don't hold on to it after printing it.
+        """
+        state = self.rooms[self.current_room]
+        if state.oldest_seq is None or state.oldest_seq <= 1:
+            await self.show("There are no older messages in this room.")
+            return
+
+        older_messages = await self.older_messages(self.current_room, state.oldest_seq)
+        if not older_messages:
+            state.oldest_seq = None
+            await self.show("There are no older messages in this room.")
+            return
 
-            conn.close()
+        await self.show(f"--- {len(older_messages)} older messages ---")
+        await self.show_history(self.current_room, in_chunks(older_messages))
+        await self.show("--- end of older messages ---")
+        state.oldest_seq = older_messages[0][0]
 
 
-    async def thin_wrapper(self, room, room_content, queue):
+    async def older_messages(self, room, before_seq):
+        """The page of messages in 'room' just before 'before_seq', oldest first"""
+        return await db.run(utils.get_room_messages_before, room, before_seq, self.history_page_size)
+
+
+    async def show_whole_history(self):
+        """'/history' - everything ever said in the room on screen, oldest first, however much that is"""
+        room = self.current_room
+        state = self.rooms[room]
+        await self.show(f"--- all of {room} ---")
+        shown = await self.show_history(room, self.history_chunks(room, state.last_seq))
+        await self.show(f"--- end of {room} ({shown} messages) ---")
+
+
+    async def history_chunks(self, room, until_seq):
         """
-        Retrieves data from the 'check_update_room_content' function and prints it for the user.
-        
-        multiprocessing.Queue raises "_queue.Empty" if we try to 'get' from a subprocess when nothing is put.
+        Yields the room's messages up to 'until_seq' (what the checker shows from then on
+        shouldn't appear twice), oldest first, HISTORY_CHUNK_SIZE at a time. We fetch the
+        next chunk while the caller shows this one - but never more than one ahead.
+        """
+        next_chunk = asyncio.ensure_future(self.history_chunk(room, 0))
+        try:
+            while True:
+                chunk = [row for row in await next_chunk if row[0] <= until_seq]
+                if not chunk:
+                    return
+                next_chunk = asyncio.ensure_future(self.history_chunk(room, chunk[-1][0]))
+                yield chunk
+        finally:
+            next_chunk.cancel()
+
+
+    async def history_chunk(self, room, after_seq):
+        """Up to HISTORY_CHUNK_SIZE of the room's messages after 'after_seq', oldest first"""
+        return await db.run(utils.get_room_history_chunk, room, after_seq, HISTORY_CHUNK_SIZE)
 
-        "_queue.Empty" is an empty object with no attributes. It is difficult to specifically filter those
-        errors so we ignore all TypeErrors errors with no attributes.
+
+    async def show_stats(self):
+        """'/stats' - how busy the database is, to tell whether it's what's slowing the chat down"""
+        await self.show(f"database calls: {db.stats()}")
+        await self.show(f"lookup cache: {utils.lookup_cache.stats()}")
+        await self.show(f"speech bubbles: {renderer.stats()}")
+        await self.show(f"password hashing: {passwords.hasher.stats()}")
+        await self.show("message broker: " + ("connected" if self.broker is not None else "not running (watching the database for changes)"))
+        if self.watcher is not None:
+            await self.show(f"database watcher: {self.watcher.stats()}")
+        for n, writer in enumerate(utils.writers):
+            await self.show(f"shard {n} writer: {writer.writes_committed} messages in {writer.batches_committed} commits")
+        await self.show(self.screen_stats())
+
+
+    async def thin_wrapper(self):
         """
-        async for _ in CheckUpdateRoomContent(room, room_content, queue):
-             # see 'self.run_chat_routine' - this partially resolves a bug in asyncio.gather where it will keep yielding forever
-            if _ == -1:
-                try:
-                    # empty queue if we have to (can't join process if queue is not empty)
-                    while True:
-                        queue.get_nowait()
-                except:
-                    pass
-                return
+        Retrieves other users' messages from CheckUpdateRoomContent and prints them for the user.
 
-            # start of the actual wrapper
-            try:
-                await aprint('\n' * 25 + queue.get_nowait())
-            except Exception as e:
+        Runs until it's cancelled (see 'self.run_chat_routine').
+        """
+        await self.print_new_content(CheckUpdateRoomContent(self))
+
+
+    async def print_new_content(self, new_contents, window=COALESCE_WINDOW, max_delay=COALESCE_MAX_DELAY):
+        """
+        Shows what the async iterator 'new_contents' yields until it runs out, coalescing bursts.
+
+        When updates arrive within 'window' seconds of each other we collect them and show
+        them together - but never hold the first one back for more than 'max_delay' seconds,
+        so a lone message still shows up at once. (The ChatScreen also batches what it draws
+        into frames, but without one, each print is a write to the terminal.)
+        """
+        new_contents = aiter(new_contents)
+        loop = asyncio.get_running_loop()
+        pending = None  # the next update, if we gave up waiting for it
+        try:
+            while True:
+                if pending is None:
+                    pending = asyncio.ensure_future(anext(new_contents))
                 try:
-                    if "_queue.Empty" in e:
-                        continue
-                except TypeError:
-                    if len(e.__dict__) == 0:  # looks like 'e' is 
-                        pass
-                    else:
-                        raise f"Uh oh! What happened here?\ne.__dict__ == {e.__dict__}"
+                    batch = [await pending]
+                except StopAsyncIteration:
+                    return
+                pending = None
+
+                deadline = loop.time() + max_delay
+                finished = False
+                while (remaining := min(window, deadline - loop.time())) > 0:
+                    pending = asyncio.ensure_future(anext(new_contents))
+                    done, _ = await asyncio.wait({pending}, timeout=remaining)
+                    if not done:
+                        break  # it's still on its way - it'll start the next batch
+                    arrived, pending = pending, None
+                    try:
+                        batch.append(arrived.result())
+                    except StopAsyncIteration:
+                        finished = True
+                        break
+
+                updates = [content for content in batch if content]
+                if updates:
+                    self.screen_writes += 1
+                    self.updates_printed += len(updates)
+                    await self.show('\n'.join(updates))
+                if finished:
+                    return
+        finally:
+            if pending is not None:
+                pending.cancel()
 
 
     async def run_chat_routine(self):
         """
-        Starts and runs subprocess that checks for other users' messages
-
-        Runs 'self.thin_wrapper' and 'self.get_and_handle_user_input' in asynchronous loop.
+        Runs 'self.thin_wrapper' as a task alongside 'self.get_and_handle_user_input'.
         Prints other users' messages, and also prints the current users' messages.
 
-        Terminates process before it returns.
+        The checker lives in this process and event loop, so joining a room costs no more than
+        starting a task. When the user presses 'q' we cancel it, wait for it to finish, and close
+        our broker connection and database watcher - nothing outlives the chat.
         """
-        # only create a new process for the check update content
-        queue = Queue()
-        run_check_update_content = Process(target=self.check_update_room_content, args=(queue, self.current_room,))
-        run_check_update_content.start()  # checks/updates content database in a while True loop under the hood
-        assert(run_check_update_content.is_alive() == True)
-
-        # this workaround is due to a bug where asyncio.gather won't quit (https://stackoverflow.com/questions/69997653/python-asyncio-gather-does-not-exit-after-task-complete)
+        checker = asyncio.create_task(self.thin_wrapper())
         try:
-            await asyncio.gather(
-                self.thin_wrapper(self.current_room, self.room_content, queue),
-                self.get_and_handle_user_input(),
-            )
-
-        except CancelledError:
-            # kill the child process
-            run_check_update_content.join()
-            while run_check_update_content.is_alive() == True:
-                await asyncio.sleep(1)
-                await aprint("checking again...")
+            await self.get_and_handle_user_input()
+        finally:
+            checker.cancel()
+            try:
+                await checker
+            except asyncio.CancelledError:
+                pass
+            await self.leave_chat()
+
+
+    async def start_listening(self):
+        """Sets up how we hear about new messages: the message broker if it's running, and a database watcher"""
+        await self.connect_to_broker()
+        self.watcher = DatabaseWatcher()
 
-        return
+
+    async def leave_chat(self):
+        """Leaves all of our rooms, closing our connection to the message broker and our database watcher"""
+        self.rooms = {}
+        if self.broker is not None:
+            self.broker.close()
+            self.broker = None
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
 
 
     async def join_chat(self, room: str):
@@ -373,24 +794,33 @@ class SharedChat(ChatApp):
         User types messages here. This function also periodically check whether other users have
         added to the chat, and if so, this method fetches the "updated" chat.
         
-        This method delegates to the SpeechBubble class to beautify the messages.
+        Messages are stored as plain text and drawn as speech bubbles (see speech_bubble.py) when they're shown.
 
-        Caller performs error checking for the room name.
-        """
-        chat_history = utils.get_room_content_from_db(room)
-        if chat_history == '':
-            await aprint(f"Congratulations on joining {room}!")
-            await aprint("Send a message!")
-
-        else:
-            await aprint(chat_history)  # we print the chat history if it's not empty
+        We only load the most recent 'self.history_page_size' messages here, however big the
+        room's history is - users can type '/more' to scroll further back (or '/history' to
+        see all of it, streamed a chunk at a time). Users can also
+        '/join' more rooms and '/switch' between them without leaving this one.
 
-        await aprint("Press 'q' to leave")
+        On a terminal the chat takes over the screen (see screen.py) until the user leaves.
 
+        Caller performs error checking for the room name.
+        """
+        self.screen = await ChatScreen.open()
         try:
-            return await self.run_chat_routine()
-        except BlockingIOError:
-            raise  "Run this program with the Python '-u' flag (like so, 'python -u ./chatroom_app.py')" # - (https://stackoverflow.com/questions/230751/how-can-i-flush-the-output-of-the-print-function/230780#230780)
+            await self.start_listening()
+            await self.subscribe(room)
+            await self.switch_room_command(room)
+            await self.show("Type '/join <room>' to join another room as well, '/switch <room>' to move between them, and '/rooms' to list them")
+            await self.show("Press 'q' to leave")
+
+            try:
+                return await self.run_chat_routine()
+            except BlockingIOError:
+                raise  "Run this program with the Python '-u' flag (like so, 'python -u ./chatroom_app.py')" # - (https://stackoverflow.com/questions/230751/how-can-i-flush-the-output-of-the-print-function/230780#230780)
+        finally:
+            if self.screen is not None:
+                self.screen.close()  # back to printing for the menus
+                self.screen = None
 
 
 class CheckUpdateRoomContent(SharedChat):
@@ -399,38 +829,34 @@ class CheckUpdateRoomContent(SharedChat):
 
     These methods are called in SharedChat.thin_wrapper in order to yield and print other users' messages.
     """
-    def __init__(self, current_room, room_content, queue):
-        super().__init__(current_user, current_room, room_content)
-        self.queue = queue
+    def __init__(self, chat):
+        super().__init__(chat.current_user, chat.current_room, chat.room_content)
+        self.chat = chat  # the SharedChat we report to - we share its rooms and their cursors
 
 
     async def __anext__(self):
+        """
+        Returns the next new content from other users, in any of the chat's rooms ('' if there was nothing new this time).
+
+        While the message broker is running we just wait for it to push messages to us. Without it
+        we wait for the database files to change (see db_watcher.py) and only then ask what's
+        new, so quiet rooms don't cost any queries. We also try to reconnect to the broker every
+        time we wake up (or every BROKER_RETRY_SECONDS) - once we're back, we catch up on whatever we missed.
+        """
         while True:
-            # hacky work-around for bug in asyncio.gather (also see 'self.run_chat_rountine' and 'self.thin_wrapper')
-            conn = sqlite3.connect("chatroom_app.db")
-            cursor = conn.cursor()
-            cursor.execute("SELECT room_update FROM rooms WHERE room_name=?", (self.current_room,))
-            if str('-1') in cursor.fetchall() or int('-1') in cursor.fetchall():
-                conn.close()
-                return self.queue.put_nowait(-1)
-            conn.close()
-
-            await asyncio.sleep(1)
-            conn = sqlite3.connect("chatroom_app.db")
-            cursor = conn.cursor()
-            new_content = utils.get_room_content_from_db(self.current_room).replace(self.room_content, "")  # essentially take the difference of the most current string and the previous to find new messages
-            if new_content != '':
-                # add new_content to database
-                cursor.execute("UPDATE rooms SET room_content=? WHERE room_name=?", (new_content, self.current_room,))
-                cursor.execute("UPDATE rooms SET room_update=? WHERE room_name=?", ('1', self.current_room,))
-                conn.commit()
-                conn.close()
-
-                # send new_content to parent process which will handle/print it
-                return self.queue.put_nowait(new_content)
-
-            conn.close()
-            return
+            if self.chat.broker is not None:
+                try:
+                    return await self.chat.receive_new_content()
+                except ConnectionError:
+                    self.chat.broker = None  # fall back to polling until the broker is back
+
+            changed = await self.chat.watcher.wait(timeout=BROKER_RETRY_SECONDS)
+            if await self.chat.connect_to_broker():
+                return await self.chat.fetch_new_content()
+            if not changed:
+                continue
+
+            return await self.chat.fetch_new_content()
 
 
     def __aiter__(self):
@@ -0,0 +1,399 @@
+"""
+Thin client for the chat server (see server.py).
+
+Run 'python client.py --host <server address>' (from this folder) instead of chatroom_app.py
+to chat through a server rather than the database file - it's the same chat, but every
+database call becomes a request to the server, and new messages are pushed to us.
+"""
+import argparse
+import asyncio
+import itertools
+import random
+
+import protocol
+from chatroom_app import ChatApp, RoomState, SharedChat, HISTORY_CHUNK_SIZE, HISTORY_PAGE_SIZE
+from outbound import OutboundQueue
+from server import HOST, PORT
+
+# after losing the server we retry after a random delay of up to 0.5 s, 1 s, 2 s, ... (at most
+# RECONNECT_MAX_DELAY) - random, so a room full of clients doesn't reconnect all at once
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+
+
+class ServerError(Exception):
+    """The server couldn't do what we asked (the message says why)"""
+
+
+class ServerConnection:
+    """
+    Our connection to the chat server. 'request' sends a request and waits for its reply; the
+    messages the server pushes to us in between are queued up for 'next_message'.
+
+    That queue is bounded too (see outbound.py), so if the terminal stalls we coalesce what
+    piled up into a {"op": "resync"} marker rather than holding on to all of it.
+
+    The server names rooms and authors by id on the wire (see protocol.py), so we keep
+    the ids of the rooms we've subscribed to, and the names of the authors we've seen.
+    We also remember who we logged in as (and the resume token the server gave us - never
+    the password), so 'resume' can pick up where we left off on a new connection.
+    """
+    def __init__(self, reader, writer, address=None):
+        self.address = address  # (host, port)
+        self.credentials = None  # (user, resume token) once we've logged in
+        self.user_names = {}  # user id -> username
+        self.room_ids = {}  # room name -> id, for the rooms we've subscribed to
+        self.room_names = {}  # ... and back
+        self._ids = itertools.count(1)
+        self._attach(reader, writer)
+
+
+    def _attach(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pushed = OutboundQueue(policy="coalesce", marker=lambda skipped: {"op": "resync", "skipped": skipped})
+        self._replies = {}  # request id -> Future for its reply
+        self._reader_task = asyncio.create_task(self._read_replies())
+
+
+    @classmethod
+    async def connect(cls, host=HOST, port=PORT):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer, (host, port))
+
+
+    async def resume(self, cursors, limit):
+        """
+        Opens a new connection to the server in place of the one we lost, logs back in and
+        resubscribes to our rooms, given {room: the last seq we have}. Returns {room: {"messages":
+        [...], "complete": ...}} - see the server's 'op_resume' - or None if we can't log back in.
+        Raises OSError or ConnectionError if the server is still unreachable.
+
+        We keep our rooms' ids meanwhile (a room's id never changes), so a message sent while
+        we're at it fails with ConnectionError like any other, or goes out right after the
+        server has resubscribed us - it handles our requests in order.
+        """
+        self.close()
+        self._attach(*await asyncio.open_connection(*self.address))
+        user, token = self.credentials
+        reply = await self.request("resume", user=user, token=token, cursors=cursors, limit=limit)
+        if not reply["ok"]:
+            self.room_ids, self.room_names = {}, {}
+            return None
+        for room, resumed in reply["rooms"].items():
+            self.room_ids[room] = resumed["room_id"]
+            self.room_names[resumed["room_id"]] = room
+            resumed["messages"] = [tuple(message) for message in resumed["messages"]]
+        return reply["rooms"]
+
+
+    async def log_in(self, user, password):
+        return self._logged_in(user, await self.request("log_in", user=user, password=password))
+
+
+    async def create_account(self, user, password):
+        return self._logged_in(user, await self.request("create_account", user=user, password=password))
+
+
+    def _logged_in(self, user, reply):
+        if reply["ok"]:
+            self.credentials = (user, reply["token"])
+        return reply["ok"]
+
+
+    async def _read_replies(self):
+        try:
+            while True:
+                frame = await protocol.read_frame(self.reader)
+                if frame is None:
+                    break
+                if frame[0] == protocol.MESSAGE:
+                    self.pushed.put(frame)
+                elif frame[0] == protocol.RESYNC:
+                    self.pushed.put({"op": "resync", "skipped": frame[1]})
+                elif frame[0] in (protocol.REPLY, protocol.SENT):
+                    _, request_id, *reply = frame
+                    reply = reply[0] if frame[0] == protocol.REPLY else tuple(reply)  # SENT: (seq, created_at)
+                    future = self._replies.pop(request_id, None)
+                    if future is not None and not future.done():
+                        future.set_result(reply)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            for reply in self._replies.values():
+                if not reply.done():
+                    reply.set_exception(ConnectionError("lost the connection to the chat server"))
+            self._replies = {}
+            self.pushed.put(None, droppable=False)
+
+
+    async def _request(self, encode, *args):
+        """Sends the frame 'encode(request_id, *args)' and returns its reply"""
+        if self._reader_task.done():
+            raise ConnectionError("lost the connection to the chat server")
+        request_id = next(self._ids)
+        reply = self._replies[request_id] = asyncio.get_running_loop().create_future()
+        self.writer.write(encode(request_id, *args))
+        await self.writer.drain()
+        reply = await reply
+        if isinstance(reply, dict) and "error" in reply:
+            raise ServerError(reply["error"])
+        return reply
+
+
+    async def request(self, op, **fields):
+        """Sends the request {"op": op, **fields} and returns the reply. Raises ServerError if the server refused it."""
+        return await self._request(protocol.encode_request, {"op": op, **fields})
+
+
+    async def send_message(self, room, body):
+        """Sends a message to a room we've subscribed to, and returns (its sequence number, the created_at the server stored)"""
+        room_id = self.room_ids.get(room)
+        if room_id is None:  # e.g. the server wouldn't let us log back in after we lost it
+            raise ConnectionError(f"we're not in {room!r} on the chat server")
+        return await self._request(protocol.encode_send, room_id, body)
+
+
+    async def subscribe(self, room, limit):
+        """Subscribes to a room and returns its latest 'limit' messages"""
+        reply = await self.request("subscribe", room=room, limit=limit)
+        self.room_ids[room] = reply["room_id"]
+        self.room_names[reply["room_id"]] = room
+        return [tuple(message) for message in reply["messages"]]
+
+
+    async def unsubscribe(self, room):
+        self.room_names.pop(self.room_ids.pop(room, None), None)
+        await self.request("unsubscribe", room=room)
+
+
+    async def user_name(self, user_id):
+        if user_id not in self.user_names:
+            names = (await self.request("user_names", ids=[user_id]))["names"]
+            self.user_names.update((int(known_id), name) for known_id, name in names.items())
+        return self.user_names.get(user_id)
+
+
+    async def next_message(self):
+        """
+        Waits for the server to push us a message, and returns it as {"op": "message", "room": ...,
+        "seq": ..., "author": ..., "created_at": ..., "body": ...} (or {"op": "resync", "skipped": N}).
+        Raises ConnectionError if the server goes away.
+        """
+        while True:
+            frame = await self.pushed.get()
+            if frame is None:
+                self.pushed.put(None, droppable=False)  # so anyone else waiting hears about it too
+                raise ConnectionError("lost the connection to the chat server")
+            if isinstance(frame, dict):
+                return frame
+
+            _, room_id, seq, author_id, created_at, body = frame
+            room = self.room_names.get(room_id)
+            if room is not None:  # not a room we've just left
+                author = await self.user_name(author_id)
+                return {"op": "message", "room": room, "seq": seq, "author": author, "created_at": created_at, "body": body}
+
+
+    def close(self):
+        self._reader_task.cancel()
+        self.writer.close()
+
+
+class RemoteChatApp(ChatApp):
+    """ChatApp, but logging in and managing rooms through the chat server"""
+    def __init__(self, connection):
+        super().__init__(None, None)
+        self.connection = connection
+
+
+    def ensure_db_initialized(self):
+        pass  # the server looks after the database
+
+
+    async def user_exists(self, username):
+        return (await self.connection.request("user_exists", user=username))["exists"]
+
+
+    async def password_matches(self, username, password):
+        return await self.connection.log_in(username, password)
+
+
+    async def create_user(self, username, password):
+        return await self.connection.create_account(username, password)
+
+
+    async def room_exists(self, room):
+        return (await self.connection.request("room_exists", room=room))["exists"]
+
+
+    async def create_room(self, room):
+        return (await self.connection.request("create_room", room=room))["ok"]
+
+
+    def new_chat(self, room):
+        return RemoteSharedChat(self.connection, self.current_user, room)
+
+
+class RemoteSharedChat(SharedChat):
+    """
+    SharedChat, but through the chat server. The server pushes us every new message in our
+    rooms, so there's no broker or database watcher - 'self.thin_wrapper' just prints what arrives.
+    """
+    def __init__(self, connection, current_user, room, history_page_size=HISTORY_PAGE_SIZE):
+        super().__init__(current_user, room, '', history_page_size)
+        self.connection = connection
+
+
+    async def start_listening(self):
+        pass  # the server pushes messages down the connection we already have
+
+
+    async def subscribe(self, room):
+        if room in self.rooms:
+            return self.rooms[room]
+
+        state = self.rooms[room] = RoomState(self.history_page_size)
+        chat_history = await self.connection.subscribe(room, self.history_page_size)
+        state.recent.extend(chat_history)
+        if chat_history:
+            state.oldest_seq = chat_history[0][0]
+        state.last_seq = chat_history[-1][0] if chat_history else 0
+
+        # anything the server pushed before its reply was dropped (we had no cursor yet) - we catch up
+        # just this room: what's waiting for our other rooms is shown when its push comes through
+        async with self.sending:
+            caught_up = await self.new_messages_in_rooms({room: state.last_seq})
+        self.deliver(room, caught_up.get(room, []))  # (into 'recent' - '/switch' shows it)
+        return state
+
+
+    async def unsubscribe(self, room):
+        del self.rooms[room]
+        await self.connection.unsubscribe(room)
+
+
+    async def get_and_handle_user_input(self):
+        while True:
+            try:
+                return await super().get_and_handle_user_input()
+            except ConnectionError:
+                await self.show("We're not connected to the chat server right now - try again in a moment.")
+
+
+    async def update_room_content_class_db(self, message, room):
+        """Sends a message's text to the server, which saves it and pushes it to everyone else in the room"""
+        async with self.sending:  # see 'SharedChat.fetch_new_content'
+            seq, created_at = await self.connection.send_message(room, message)
+            state = self.rooms[room]
+            state.sent_seqs.add(seq)
+            state.recent.append((seq, self.current_user, created_at, message))
+
+
+    async def new_messages_in_rooms(self, cursors):
+        reply = await self.connection.request("messages_after", cursors=cursors)
+        return {room: [tuple(message) for message in messages] for room, messages in reply["messages"].items()}
+
+
+    async def older_messages(self, room, before_seq):
+        reply = await self.connection.request("messages_before", room=room, before_seq=before_seq, limit=self.history_page_size)
+        return [tuple(message) for message in reply["messages"]]
+
+
+    async def history_chunk(self, room, after_seq):
+        reply = await self.connection.request("messages_from", room=room, after_seq=after_seq, limit=HISTORY_CHUNK_SIZE)
+        return [tuple(message) for message in reply["messages"]]
+
+
+    async def thin_wrapper(self):
+        """Prints the messages the server pushes to us until it's cancelled, reconnecting whenever we lose the server"""
+        while True:
+            await self.print_new_content(self.pushed_content())
+            await self.show("Lost the connection to the chat server - reconnecting...")
+            if not await self.reconnect():
+                return
+
+
+    async def reconnect(self):
+        """
+        Retries (with backoff) until we're back on the server, then catches each of our rooms up
+        from where we left off - only what we missed, or if we missed too much, the room's
+        latest page. Returns False if the server won't let us log back in.
+        """
+        for attempt in itertools.count():
+            await asyncio.sleep(random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** attempt)))
+            cursors = {room: state.last_seq or 0 for room, state in self.rooms.items()}
+            try:
+                resumed = await self.connection.resume(cursors, self.history_page_size)
+                break
+            except (OSError, ConnectionError):
+                continue
+        if resumed is None:
+            await self.show("The chat server wouldn't let us log back in - press 'q' to leave.")
+            return False
+
+        caught_up = []
+        for room, catch_up in resumed.items():
+            if catch_up["complete"]:
+                caught_up.append(self.deliver(room, catch_up["messages"]))
+            else:
+                caught_up.append(self.restart_room(room, catch_up["messages"]))
+        await self.show('\n'.join(["Reconnected!", *filter(None, caught_up)]))
+        return True
+
+
+    def restart_room(self, room, messages):
+        """After missing too much of a room, starts it over from its latest page ('messages') and returns what to print"""
+        state = self.rooms[room]
+        state.recent.clear()
+        state.recent.extend(messages)
+        state.sent_seqs = set()
+        if messages:
+            state.oldest_seq, state.last_seq = messages[0][0], messages[-1][0]
+        notice = f"(you missed a lot in {room} while we were disconnected - here are its latest messages)"
+        if room != self.current_room:
+            state.unread = len(messages)
+            return notice
+        return '\n'.join([notice, self.render(room, state.recent)])
+
+
+    async def pushed_content(self):
+        """Yields what to print for each message the server pushes to us, until the server goes away"""
+        while True:
+            try:
+                message = await self.connection.next_message()
+            except ConnectionError:
+                return
+            yield await self.handle_pushed_message(message)
+
+
+    async def leave_chat(self):
+        for room in list(self.rooms):
+            try:
+                await self.unsubscribe(room)
+            except ConnectionError:
+                break
+        self.rooms = {}
+
+
+    async def show_stats(self):
+        stats = await self.connection.request("stats")
+        await self.show(f"chat server: {stats}")
+        await self.show(self.screen_stats())
+
+
+async def main(host, port):
+    connection = await ServerConnection.connect(host, port)
+    try:
+        await RemoteChatApp(connection).run()
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chats through a chat server (see server.py)")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.host, args.port))
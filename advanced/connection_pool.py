@@ -0,0 +1,129 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class ConnectionPool:
+    """
+    Keeps a handful of open sqlite3 connections around so we don't pay for
+    connecting (and re-parsing the schema) every time we touch the database.
+
+    Every connection runs the database in WAL mode, so readers polling for new messages
+    don't block writers (and vice versa), and waits up to 'busy_timeout_ms' for a lock
+    instead of failing straight away with "database is locked".
+
+    Connections are opened in autocommit mode - reads don't hold a transaction open,
+    and writers ask for one explicitly with 'transaction()'. Each connection keeps its
+    own prepared statement cache, which is why we want to hold on to them.
+
+    A connection must never be used on both sides of a fork, so the pool remembers which
+    process opened its connections and starts from scratch when it finds itself in a
+    different one (like the checker process).
+    """
+    def __init__(self, db_path, max_connections=4, cached_statements=128, busy_timeout_ms=5000):
+        self.db_path = db_path
+        self.max_connections = max_connections
+        self.cached_statements = cached_statements
+        self.busy_timeout_ms = busy_timeout_ms
+        self._lock = threading.Lock()
+        self._idle = []
+        self._pid = os.getpid()
+        self._inherited = []  # connections opened by our parent process - see '_check_pid'
+
+
+    def _check_pid(self):
+        """Drops connections that were opened by another process (we got forked)"""
+        if self._pid != os.getpid():
+            # we don't close these: closing would touch database state the parent process still uses
+            self._inherited.extend(self._idle)
+            self._idle = []
+            self._pid = os.getpid()
+
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000,
+            isolation_level=None,
+            check_same_thread=False,  # the pool makes sure only one thread uses a connection at a time
+            cached_statements=self.cached_statements,
+        )
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.execute("PRAGMA journal_mode=WAL")  # stored in the database file, so this is a no-op after the first time
+        conn.execute("PRAGMA synchronous=NORMAL")  # in WAL mode this is still safe against corruption, and skips an fsync per commit
+        return conn
+
+
+    def acquire(self):
+        """Hands out an idle connection, or opens a new one if there aren't any"""
+        with self._lock:
+            self._check_pid()
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+
+    def release(self, conn):
+        """Gives a connection back to the pool (or closes it if the pool is already full)"""
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")  # never hand out a connection halfway through someone else's transaction
+
+        with self._lock:
+            self._check_pid()
+            if len(self._idle) < self.max_connections:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+
+    @contextmanager
+    def connection(self):
+        """'with pool.connection() as conn:' borrows a connection for the body of the block"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+
+    @contextmanager
+    def transaction(self):
+        """
+        Borrows a connection and runs the body of the block in one write transaction.
+
+        We use 'BEGIN IMMEDIATE' so the write lock is taken up front - otherwise two writers
+        could both read (say, the next sequence number) before either of them writes.
+        """
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+
+    def close(self):
+        """Closes every idle connection"""
+        with self._lock:
+            self._check_pid()
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+    def __getstate__(self):
+        # connections can't be pickled (e.g. when handing objects to another process) - the copy opens its own
+        state = self.__dict__.copy()
+        state["_lock"] = None
+        state["_idle"] = []
+        state["_inherited"] = []
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
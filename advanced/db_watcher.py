@@ -0,0 +1,177 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+import time
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")  # watch descriptor, mask, cookie, length of the name that follows
+
+# how long we wait between 'data_version' checks when inotify isn't available - it doubles
+# while nothing changes and drops back to the minimum as soon as something does
+MIN_BACKOFF = 0.05
+MAX_BACKOFF = 1.0
+
+
+def _inotify_libc():
+    """Returns libc if it has inotify (Linux), otherwise None"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class DatabaseWatcher:
+    """
+    Tells the chat when one of the database files it's watching has changed, so it only asks
+    for new messages when there might be some. 'add' a pool for each file to watch - a chat
+    in many rooms spread over several shards still needs just the one watcher.
+
+    On Linux we ask inotify to wake us when a database or its WAL file is written to (we
+    watch their directory, since SQLite creates and deletes the WAL file as it goes), so a
+    quiet room costs nothing at all. Elsewhere - or with CHATROOM_WATCHER=poll - we fall back
+    to checking SQLite's 'data_version', which changes whenever another connection commits,
+    and back off from every MIN_BACKOFF to every MAX_BACKOFF seconds while nothing happens.
+
+    Any commit to a file wakes us, not just ones to our rooms - it's up to the caller to
+    ask the database what's new.
+    """
+    def __init__(self, pools=(), mode=os.environ.get("CHATROOM_WATCHER", "auto")):
+        self.wakeups = 0
+        self.checks = 0  # 'data_version' checks (only when polling)
+        self._names = set()  # file names whose changes wake us
+        self._directories = set()  # directories inotify is watching
+        self._versions = {}  # db_path -> [our connection, last data_version seen], for files we poll
+        self._inotify_fd = None
+        self._libc = _inotify_libc() if mode != "poll" else None
+        self._backoff = MIN_BACKOFF
+
+        if self._libc is not None:
+            fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self._inotify_fd = fd
+
+        for pool in pools:
+            self.add(pool)
+
+
+    @property
+    def mode(self):
+        return "data_version" if self._versions or self._inotify_fd is None else "inotify"
+
+
+    def add(self, pool):
+        """Starts watching 'pool's database file too (call this before reading from it, so no change slips past)"""
+        name = os.path.basename(pool.db_path)
+        self._names.update({name, name + "-wal"})
+
+        directory = os.path.dirname(os.path.abspath(pool.db_path))
+        if self._inotify_fd is not None and directory not in self._directories:
+            mask = IN_MODIFY | IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_TO
+            if self._libc.inotify_add_watch(self._inotify_fd, os.fsencode(directory), mask) >= 0:
+                self._directories.add(directory)
+
+        # no inotify, or it can't watch this directory - poll this file's data_version instead
+        if directory not in self._directories and pool.db_path not in self._versions:
+            conn = pool._connect()  # ours alone - data_version is tracked per connection
+            self._versions[pool.db_path] = [conn, conn.execute("PRAGMA data_version").fetchone()[0]]
+
+
+    async def wait(self, timeout=None):
+        """Waits until a watched database changes (returns True) or 'timeout' seconds pass without a change (returns False)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self._versions:
+            # if anything needs polling we poll, and pick up inotify's events along the way
+            changed = await self._wait_data_version(deadline)
+        elif self._directories:
+            changed = await self._wait_inotify(deadline)
+        else:
+            await asyncio.sleep(MAX_BACKOFF if timeout is None else timeout)  # nothing to watch yet
+            changed = False
+        if changed:
+            self.wakeups += 1
+        return changed
+
+
+    def _read_events(self):
+        """Reads every pending inotify event, returns True if any were about our files"""
+        if self._inotify_fd is None:
+            return False
+
+        changed = False
+        while True:
+            try:
+                data = os.read(self._inotify_fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                _wd, _mask, _cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                changed = changed or os.fsdecode(name) in self._names
+
+
+    async def _wait_inotify(self, deadline):
+        loop = asyncio.get_running_loop()
+        while True:
+            if self._read_events():
+                return True
+
+            readable = loop.create_future()
+            loop.add_reader(self._inotify_fd, lambda: readable.done() or readable.set_result(None))
+            try:
+                await asyncio.wait_for(readable, None if deadline is None else max(0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                return self._read_events()
+            finally:
+                loop.remove_reader(self._inotify_fd)
+
+
+    def _data_version_changed(self):
+        changed = self._read_events()
+        for version in self._versions.values():
+            # this only reads the WAL's shared-memory header, so it's cheap and never waits on a lock
+            (data_version,) = version[0].execute("PRAGMA data_version").fetchone()
+            self.checks += 1
+            changed = changed or data_version != version[1]
+            version[1] = data_version
+        return changed
+
+
+    async def _wait_data_version(self, deadline):
+        while True:
+            if self._data_version_changed():
+                self._backoff = MIN_BACKOFF
+                return True
+
+            delay = self._backoff
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+                if delay <= 0:
+                    return False
+            await asyncio.sleep(delay)
+            self._backoff = min(self._backoff * 2, MAX_BACKOFF)
+
+
+    def stats(self):
+        return {"mode": self.mode, "files": len(self._names) // 2, "wakeups": self.wakeups, "data_version_checks": self.checks}
+
+
+    def close(self):
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+        for conn, _data_version in self._versions.values():
+            conn.close()
+        self._versions = {}
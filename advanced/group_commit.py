@@ -0,0 +1,106 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class GroupCommitWriter:
+    """
+    Funnels writes through one background thread that commits them in batches.
+
+    A commit is the expensive part of a write (it takes the database's write lock and
+    syncs the WAL), so when several messages arrive within 'max_delay' seconds of each
+    other we apply all of them in a single transaction and commit once.
+
+    We only linger while the room is busy (the previous batch had more than one write in it),
+    and stop as soon as writes stop trickling in ('max_gap' seconds without a new one).
+    A lone sender gets its commit straight away; writes that queue up behind a commit in
+    progress are still picked up together.
+
+    'apply' is called as apply(conn, *args) for every submitted write, inside the batch's
+    transaction, and whatever it returns becomes the result of that write's future.
+    If the batch fails, every write in it fails with the same exception.
+    """
+    def __init__(self, pool, apply, max_delay=0.005, max_gap=0.001, max_batch=256):
+        self.pool = pool
+        self.apply = apply
+        self.max_delay = max_delay
+        self.max_gap = max_gap
+        self.max_batch = max_batch
+        self.batches_committed = 0
+        self.writes_committed = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._last_batch_size = 0
+
+
+    def submit(self, *args):
+        """Queues one write and returns a concurrent.futures.Future for its result"""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((future, args))
+        return future
+
+
+    def write(self, *args):
+        """Queues one write and waits for it to be committed"""
+        return self.submit(*args).result()
+
+
+    def _ensure_started(self):
+        # threads don't survive a fork, so a forked process starts its own writer
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="group-commit-writer", daemon=True)
+                self._thread.start()
+
+
+    def _collect_batch(self):
+        """Blocks for the first write, then gathers whatever else arrives within 'max_delay'"""
+        batch = [self._queue.get()]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())  # anything that queued up during the last commit
+            except queue.Empty:
+                break
+
+        if self._last_batch_size <= 1 and len(batch) == 1:
+            return batch  # nobody else is writing right now - don't make this write wait
+
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=min(remaining, self.max_gap)))
+            except queue.Empty:
+                break
+
+        return batch
+
+
+    def _run(self):
+        while True:
+            batch = [(future, args) for future, args in self._collect_batch() if future.set_running_or_notify_cancel()]
+            self._last_batch_size = len(batch)
+            if not batch:
+                continue
+
+            try:
+                with self.pool.transaction() as conn:
+                    results = [self.apply(conn, *args) for _future, args in batch]
+            except BaseException as e:
+                for future, _args in batch:
+                    future.set_exception(e)
+                continue
+
+            self.batches_committed += 1
+            self.writes_committed += len(batch)
+            for (future, _args), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,102 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class LookupCache:
+    """
+    A bounded LRU cache for small lookups that rarely change, like "does this user exist?".
+
+    Misses are cached too (negative caching), so asking about a room that doesn't exist
+    over and over doesn't hit the database every time either.
+
+    Writes made through this process should call 'invalidate'. To notice writes made by
+    other processes we keep one connection of our own and watch SQLite's 'data_version',
+    which changes whenever another connection commits. Most of those commits are chat
+    messages, which don't affect anything we cache, so when 'data_version' moves we compare
+    a cheap fingerprint of the cached tables (see 'fingerprint_query') before throwing
+    everything away.
+    """
+    # users and rooms are only ever added, so their largest ids change exactly when they do -
+    # which is why nothing that's updated in place (like a password) may be cached here
+    fingerprint_query = "SELECT (SELECT MAX(id) FROM administrative), (SELECT MAX(id) FROM rooms)"
+
+    def __init__(self, pool, maxsize=1024):
+        self.pool = pool
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._data_version = None
+        self._fingerprint = None
+        self._generation = 0  # bumped on every invalidation, so a load that raced with one isn't cached
+
+
+    def _check_other_processes(self):
+        """Clears the cache if another process changed the users or rooms tables (call with the lock held)"""
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = self.pool._connect()  # ours alone - data_version is tracked per connection
+            self._pid = os.getpid()
+            self._data_version = None
+
+        (data_version,) = self._conn.execute("PRAGMA data_version").fetchone()
+        if data_version == self._data_version:
+            return
+        self._data_version = data_version
+
+        fingerprint = self._conn.execute(self.fingerprint_query).fetchone()
+        if fingerprint != self._fingerprint:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._generation += 1
+            self._fingerprint = fingerprint
+
+
+    def get(self, key, load):
+        """Returns the cached value for 'key', calling load() to fetch it on a miss"""
+        with self._lock:
+            self._check_other_processes()
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            generation = self._generation
+
+        value = load()
+        with self._lock:
+            if generation != self._generation:
+                return value
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+
+    def invalidate(self, *keys):
+        """Forgets 'keys' - call this after writing something they depend on"""
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+            self.invalidations += 1
+            self._generation += 1
+
+
+    def close(self):
+        """Closes our data_version connection (the next lookup opens a new one)"""
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+
+    def stats(self):
+        """Hit/miss counters, for checking the cache is pulling its weight"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations, "size": len(self._entries)}
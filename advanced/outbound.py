@@ -0,0 +1,196 @@
+import asyncio
+import os
+from collections import deque
+
+# what happens when a consumer falls this far behind (see OutboundQueue)
+OUTBOUND_QUEUE_SIZE = int(os.environ.get("CHATROOM_OUTBOUND_QUEUE_SIZE", 1000))
+OUTBOUND_POLICY = os.environ.get("CHATROOM_OUTBOUND_POLICY", "coalesce")
+POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+# how long a writer waits for more messages before writing what it has (see 'OutboundQueue.get_batch')
+COALESCE_WINDOW = float(os.environ.get("CHATROOM_COALESCE_WINDOW_MS", 2)) / 1000
+COALESCE_MAX_DELAY = float(os.environ.get("CHATROOM_COALESCE_MAX_DELAY_MS", 10)) / 1000
+COALESCE_MAX_ITEMS = 256
+
+_MARKER = object()  # stands in for the coalesce marker while it's queued
+
+
+class OutboundQueue:
+    """
+    The messages waiting to go out to one consumer - a server client, a broker subscriber,
+    or the chat printing what the server pushed to it.
+
+    Fan-out only ever 'put's, which never waits, so one stalled terminal can't hold up
+    everyone else in the room. Each queue holds at most 'maxsize' droppable items; when a
+    consumer falls that far behind, 'policy' decides what to do:
+
+        drop_oldest - forget the oldest queued message to make room
+        coalesce    - throw away everything queued and send one marker in its place
+                      (marker(skipped) - e.g. "N messages skipped, resync"). Until the
+                      consumer gets to it, later overflows are added to the same marker.
+        disconnect  - give up on the consumer ('put' returns False, and the caller hangs up)
+
+    Nothing is lost for good either way - the database has every message, and consumers
+    catch up from it when they notice a gap in the sequence numbers or get a marker.
+
+    Items put with 'droppable=False' (replies to requests) are always kept.
+
+    Writers take items in batches ('get_batch') and write each batch at once, so a burst
+    of messages costs one write instead of one each.
+    """
+    def __init__(self, maxsize=OUTBOUND_QUEUE_SIZE, policy=OUTBOUND_POLICY, marker=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow consumer policy {policy!r} - use one of {', '.join(POLICIES)}")
+        if policy == "coalesce" and marker is None:
+            raise ValueError("The 'coalesce' policy needs a marker")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.marker = marker
+        self.max_depth = 0
+        self.dropped = 0  # messages we threw away (drop_oldest and coalesce)
+        self.resyncs = 0  # markers we queued (coalesce)
+        self.overflowed = False  # set once a 'disconnect' queue fills up
+        self.batches = 0  # 'get_batch' calls - writes, for our writers
+        self.batched = 0  # ... and the items they returned
+        self._items = deque()  # (item, droppable)
+        self._droppable = 0
+        self._skipped = 0  # messages the queued marker stands for
+        self._marker_queued = False
+        self._ready = asyncio.Event()
+
+
+    @property
+    def depth(self):
+        return len(self._items)
+
+
+    def put(self, item, droppable=True):
+        """Queues 'item' without waiting. Returns False if the consumer should be disconnected."""
+        if self.overflowed:
+            return False
+
+        if droppable and self._droppable >= self.maxsize:
+            if self.policy == "disconnect":
+                self.overflowed = True
+                self._ready.set()
+                return False
+            elif self.policy == "drop_oldest":
+                self._remove_droppable(1)
+            else:
+                self._skipped += self._remove_droppable(self._droppable) + 1  # + the one we're not queueing either
+                self.dropped += 1
+                if self._marker_queued:
+                    return True  # the marker that's already queued covers this one too
+                self._marker_queued = True
+                self.resyncs += 1
+                item, droppable = _MARKER, False
+
+        self._items.append((item, droppable))
+        self._droppable += droppable
+        self.max_depth = max(self.max_depth, len(self._items))
+        self._ready.set()
+        return True
+
+
+    def _remove_droppable(self, count):
+        """Removes the 'count' oldest droppable items, returns how many it removed"""
+        if self._droppable == len(self._items):  # nothing we have to keep - the usual case
+            removed = min(count, len(self._items))
+            for _ in range(removed):
+                self._items.popleft()
+            self._droppable -= removed
+            self.dropped += removed
+            return removed
+
+        kept = deque()
+        removed = 0
+        for item, droppable in self._items:
+            if droppable and removed < count:
+                removed += 1
+            else:
+                kept.append((item, droppable))
+        self._items = kept
+        self._droppable -= removed
+        self.dropped += removed
+        return removed
+
+
+    async def get(self):
+        """Waits for the next item. Raises ConnectionError once a 'disconnect' queue has overflowed."""
+        item, _droppable = await self._next()
+        return item
+
+
+    async def get_batch(self, window=COALESCE_WINDOW, max_delay=COALESCE_MAX_DELAY, max_items=COALESCE_MAX_ITEMS):
+        """
+        Waits for the next item like 'get', then keeps taking items for as long as each one
+        arrives within 'window' seconds of the last - but never for more than 'max_delay'
+        seconds after the first - and returns them all as a list.
+
+        Anything already queued is taken without waiting, so under load batches form at no
+        cost in latency. We stop waiting as soon as the batch has a reply in it, though -
+        someone is waiting on that.
+        """
+        item, droppable = await self._next()
+        batch = [item]
+        has_reply = not droppable
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max_delay
+        while len(batch) < max_items and not self.overflowed:
+            if self._items:
+                item, droppable = self._pop()
+                batch.append(item)
+                has_reply = has_reply or not droppable
+                continue
+            remaining = min(window, deadline - loop.time())
+            if has_reply or remaining <= 0:
+                break
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), remaining)
+            except asyncio.TimeoutError:  # (not the builtin TimeoutError before Python 3.11)
+                break
+        self.batches += 1
+        self.batched += len(batch)
+        return batch
+
+
+    async def _next(self):
+        while not self._items:
+            if self.overflowed:
+                raise ConnectionError("consumer fell too far behind")
+            self._ready.clear()
+            await self._ready.wait()
+        if self.overflowed:
+            raise ConnectionError("consumer fell too far behind")
+        return self._pop()
+
+
+    def _pop(self):
+        item, droppable = self._items.popleft()
+        self._droppable -= droppable
+        if item is _MARKER:
+            item = self.marker(self._skipped)
+            self._skipped = 0
+            self._marker_queued = False
+        return item, droppable
+
+
+    def stats(self):
+        return {"depth": self.depth, "max_depth": self.max_depth, "dropped": self.dropped, "resyncs": self.resyncs, "batches": self.batches, "batched": self.batched}
+
+
+def total_stats(queues):
+    """Adds up the stats of many OutboundQueues, for a server's metrics"""
+    queues = list(queues)
+    writes = sum(queue.batches for queue in queues)
+    return {
+        "consumers": len(queues),
+        "queued": sum(queue.depth for queue in queues),
+        "deepest": max((queue.depth for queue in queues), default=0),
+        "max_depth": max((queue.max_depth for queue in queues), default=0),
+        "dropped": sum(queue.dropped for queue in queues),
+        "resyncs": sum(queue.resyncs for queue in queues),
+        "writes": writes,
+        "messages per write": round(sum(queue.batched for queue in queues) / writes, 2) if writes else None,
+    }
@@ -0,0 +1,237 @@
+"""
+Password hashing.
+
+We keep a salted scrypt hash of each password (PBKDF2-SHA256 if this Python's OpenSSL has
+no scrypt), never the password itself. A stored hash carries its scheme and cost, e.g.
+"scrypt$16384$8$1$<salt>$<hash>", so raising the cost later doesn't lock anyone out - and
+neither do accounts from before we hashed passwords: their plain text still works once,
+and 'check_password' swaps it for a hash while it has the password in hand. Users whose
+hash is at an older cost get rehashed the same way.
+
+A good password hash is slow and memory-hungry on purpose (about 16 MiB and tens of
+milliseconds at the default cost), so it mustn't run on the event loop. 'PasswordHasher'
+sends it to a few worker processes instead: the chat keeps going while someone logs in,
+logins don't wait on each other (up to one per worker), and at most 'queue_size' hashes
+are queued or running at once - anyone else waits their turn in the event loop, rather
+than piling work up behind the workers.
+
+Clients of the chat server keep a resume token instead of the password, so they can log
+back in after losing their connection ('issue_resume_token'). The token is random, so we
+only store a plain SHA-256 of it, and checking it costs a query rather than a hash.
+
+Tune the cost with CHATROOM_SCRYPT_N / _R / _P (or CHATROOM_PBKDF2_ITERATIONS), the workers
+with CHATROOM_HASH_WORKERS and the queue with CHATROOM_HASH_QUEUE_SIZE.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import secrets
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import utils
+
+SCHEME = "scrypt" if hasattr(hashlib, "scrypt") else "pbkdf2_sha256"
+SCRYPT_N = int(os.environ.get("CHATROOM_SCRYPT_N", 2 ** 14))  # CPU and memory cost (a power of 2) - memory is 128 * N * R bytes
+SCRYPT_R = int(os.environ.get("CHATROOM_SCRYPT_R", 8))
+SCRYPT_P = int(os.environ.get("CHATROOM_SCRYPT_P", 1))
+PBKDF2_ITERATIONS = int(os.environ.get("CHATROOM_PBKDF2_ITERATIONS", 600_000))
+HASH_WORKERS = int(os.environ.get("CHATROOM_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+HASH_QUEUE_SIZE = int(os.environ.get("CHATROOM_HASH_QUEUE_SIZE", 16))
+RESUME_TOKEN_MAX_AGE = float(os.environ.get("CHATROOM_RESUME_TOKEN_DAYS", 30)) * 24 * 60 * 60
+
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+
+def _b64(data):
+    return base64.b64encode(data).decode("ascii")
+
+
+def current_cost():
+    """The cost new hashes get: (scheme, parameters)"""
+    if SCHEME == "scrypt":
+        return SCHEME, (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return SCHEME, (PBKDF2_ITERATIONS,)
+
+
+def _derive(scheme, parameters, password, salt):
+    if scheme == "scrypt":
+        n, r, p = parameters
+        return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p, dklen=HASH_BYTES)
+    (iterations,) = parameters
+    return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations, dklen=HASH_BYTES)
+
+
+def hash_password(password, cost=None):
+    """A fresh salted hash of 'password', to store (slow - see 'PasswordHasher')"""
+    scheme, parameters = cost or current_cost()
+    salt = secrets.token_bytes(SALT_BYTES)
+    derived = _derive(scheme, parameters, password, salt)
+    return "$".join([scheme, *map(str, parameters), _b64(salt), _b64(derived)])
+
+
+def parse_hash(stored):
+    """(scheme, parameters, salt, hash) for a stored hash - or None if 'stored' is a password from before we hashed them"""
+    scheme, _, rest = stored.partition("$")
+    fields = rest.split("$")
+    expected = {"scrypt": 5, "pbkdf2_sha256": 3}.get(scheme)
+    if expected is None or len(fields) != expected:
+        return None
+    try:
+        parameters = tuple(int(field) for field in fields[:-2])
+        return scheme, parameters, base64.b64decode(fields[-2], validate=True), base64.b64decode(fields[-1], validate=True)
+    except ValueError:
+        return None
+
+
+def verify_password(password, stored, cost=None):
+    """
+    Checks 'password' against what we stored for it, and returns (ok, new hash). The new hash
+    is None unless the password was right and 'stored' is plain text or at an older cost.
+    """
+    cost = cost or current_cost()
+    parsed = parse_hash(stored)
+    if parsed is None:
+        ok = hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8"))
+    else:
+        scheme, parameters, salt, expected = parsed
+        ok = hmac.compare_digest(_derive(scheme, parameters, password, salt), expected)
+        if (scheme, parameters) == cost:
+            return ok, None
+    return ok, hash_password(password, cost) if ok else None
+
+
+def _start_worker():
+    """Runs in each worker process as it starts"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C is for the chat - it shuts us down
+
+    # a worker holds both ends of its job queue, so it wouldn't notice if the chat was killed - we check
+    parent = os.getppid()
+
+    def exit_with_parent():
+        while os.getppid() == parent:
+            time.sleep(1)
+        os._exit(0)
+
+    threading.Thread(target=exit_with_parent, daemon=True).start()
+
+
+class PasswordHasher:
+    """
+    Runs 'hash_password' and 'verify_password' on a pool of worker processes, with at most
+    'queue_size' calls queued or running at once. The pool starts on first use.
+    """
+    def __init__(self, max_workers=HASH_WORKERS, queue_size=HASH_QUEUE_SIZE):
+        self.max_workers = max_workers
+        self.queue_size = max(queue_size, max_workers)
+        self.calls = 0
+        self.waiting = 0  # callers waiting for room in the queue right now
+        self.max_waiting = 0
+        self.rehashed = 0
+        self.total_seconds = 0.0
+        self._executor = None
+        self._loop = None
+        self._slots = None
+
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:  # a semaphore belongs to one event loop
+            self._loop, self._slots = loop, asyncio.Semaphore(self.queue_size)
+        if self._executor is None:
+            # spawned, not forked - we have database and writer threads a fork would copy mid-flight
+            self._executor = ProcessPoolExecutor(
+                self.max_workers, mp_context=multiprocessing.get_context("spawn"), initializer=_start_worker
+            )
+
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            self._slots.release()
+            self.calls += 1
+            self.total_seconds += time.perf_counter() - started
+
+
+    async def hash(self, password):
+        return await self._run(hash_password, password, current_cost())
+
+
+    async def verify(self, password, stored):
+        """(ok, new hash) - see 'verify_password'"""
+        ok, rehashed = await self._run(verify_password, password, stored, current_cost())
+        if rehashed is not None:
+            self.rehashed += 1
+        return ok, rehashed
+
+
+    def stats(self):
+        return {
+            "scheme": "$".join([SCHEME, *map(str, current_cost()[1])]),
+            "calls": self.calls,
+            "average_ms_in_pool": 1000 * self.total_seconds / self.calls if self.calls else 0.0,
+            "max_waiting": self.max_waiting,
+            "rehashed": self.rehashed,
+        }
+
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+
+hasher = PasswordHasher()
+
+
+async def check_password(db, user, password):
+    """
+    Whether 'password' is 'user''s password ('db' is an AsyncDB) - False if there's no such
+    user. If what we stored for them is plain text or an older cost, we store a fresh hash
+    now that we have the password.
+    """
+    stored = await db.run(utils.get_password_from_username, user)
+    if stored is None:
+        return False
+    ok, rehashed = await hasher.verify(password, stored)
+    if rehashed is not None:
+        await db.run(utils.replace_password, user, stored, rehashed)
+    return ok
+
+
+async def create_account(db, user, password):
+    """Creates an account with a hash of 'password' - raises sqlite3.IntegrityError if the name is taken"""
+    await db.run(utils.create_user_and_password, user, await hasher.hash(password))
+
+
+def _token_hash(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+async def issue_resume_token(db, user):
+    """A new random token that logs 'user' back in (see 'check_resume_token'), for RESUME_TOKEN_MAX_AGE"""
+    token = secrets.token_urlsafe(32)
+    user_id = await db.run(utils.get_user_id, user)
+    now = time.time()
+    await db.run(utils.add_resume_token, user_id, _token_hash(token), now, now - RESUME_TOKEN_MAX_AGE)
+    return token
+
+
+async def check_resume_token(db, user, token):
+    """Whether 'token' is one we issued to 'user' and it hasn't expired - no password hashing involved"""
+    if not isinstance(token, str):
+        return False
+    user_id = await db.run(utils.get_resume_token_user_id, _token_hash(token), time.time() - RESUME_TOKEN_MAX_AGE)
+    return user_id is not None and user_id == await db.run(utils.get_user_id, user)
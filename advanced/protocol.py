@@ -0,0 +1,108 @@
+"""
+The chat server's wire protocol (see server.py and client.py).
+
+Everything is sent as frames: a 4-byte length (of everything after it), a 1-byte frame type,
+and the payload. All numbers are big-endian.
+
+    REQUEST  request id (u32), then a JSON object with an 'op' and its fields
+    REPLY    request id (u32), then a JSON object (with an 'error' if the request failed)
+    SEND     request id (u32), room id (u32), then the message body as UTF-8
+    SENT     request id (u32), the new message's sequence number (u64) and created_at (f64)
+    MESSAGE  room id (u32), seq (u64), author id (u32), created_at (f64), then the body as UTF-8
+    RESYNC   how many messages were skipped (u32) - see outbound.py
+
+Rarely used requests (logging in, subscribing, history pages) stay JSON, which is easy to
+extend. The two frames nearly all the traffic is made of - sending a message and having
+one pushed to us - are fixed binary headers in front of the body, so what we send and
+parse grows with the message itself, not with the field names and quoting around it.
+Names travel as ids: clients learn room ids when they subscribe, and look authors up
+('user_names') the first time they see them.
+
+'read_frame' parses frames straight out of the bytes we read, through a memoryview -
+the body is decoded from the frame's own buffer without being copied out first.
+"""
+import json
+import struct
+
+REQUEST, REPLY, SEND, SENT, MESSAGE, RESYNC = range(1, 7)
+
+MAX_FRAME_SIZE = 1 << 20  # anything bigger is a broken or hostile peer, not a chat message
+
+_HEADER = struct.Struct(">IB")  # length, frame type
+_ID = struct.Struct(">I")
+_SEND = struct.Struct(">II")  # request id, room id
+_SENT = struct.Struct(">IQd")  # request id, seq, created_at
+_MESSAGE = struct.Struct(">IQId")  # room id, seq, author id, created_at
+_RESYNC = struct.Struct(">I")
+
+
+def _frame(frame_type, header, body=b""):
+    return _HEADER.pack(1 + len(header) + len(body), frame_type) + header + body
+
+
+def encode_request(request_id, request):
+    return _frame(REQUEST, _ID.pack(request_id), json.dumps(request).encode("utf-8"))
+
+
+def encode_reply(request_id, reply):
+    return _frame(REPLY, _ID.pack(request_id), json.dumps(reply).encode("utf-8"))
+
+
+def encode_send(request_id, room_id, body):
+    return _frame(SEND, _SEND.pack(request_id, room_id), body.encode("utf-8"))
+
+
+def encode_sent(request_id, seq, created_at):
+    return _frame(SENT, _SENT.pack(request_id, seq, created_at))
+
+
+def encode_message(room_id, seq, author_id, created_at, body):
+    return _frame(MESSAGE, _MESSAGE.pack(room_id, seq, author_id, created_at), body.encode("utf-8"))
+
+
+def encode_resync(skipped):
+    return _frame(RESYNC, _RESYNC.pack(skipped))
+
+
+def parse_frame(frame_type, payload):
+    """
+    Turns a frame's payload (a memoryview) into a tuple starting with its type:
+
+        (REQUEST, request_id, request)    (REPLY, request_id, reply)
+        (SEND, request_id, room_id, body) (SENT, request_id, seq, created_at)
+        (MESSAGE, room_id, seq, author_id, created_at, body)
+        (RESYNC, skipped)
+
+    Raises ValueError if the frame is malformed.
+    """
+    try:
+        if frame_type == MESSAGE:
+            return (MESSAGE, *_MESSAGE.unpack_from(payload), str(payload[_MESSAGE.size:], "utf-8"))
+        if frame_type == SEND:
+            return (SEND, *_SEND.unpack_from(payload), str(payload[_SEND.size:], "utf-8"))
+        if frame_type == SENT:
+            return (SENT, *_SENT.unpack_from(payload))
+        if frame_type in (REQUEST, REPLY):
+            (request_id,) = _ID.unpack_from(payload)
+            return (frame_type, request_id, json.loads(str(payload[_ID.size:], "utf-8")))
+        if frame_type == RESYNC:
+            return (RESYNC, *_RESYNC.unpack_from(payload))
+    except struct.error as e:
+        raise ValueError(f"truncated frame: {e}") from None
+    raise ValueError(f"unknown frame type {frame_type}")
+
+
+async def read_frame(reader):
+    """Reads and parses the next frame off a stream (see 'parse_frame'), or returns None once the other side has hung up"""
+    try:
+        header = await reader.readexactly(_HEADER.size)
+    except EOFError:  # asyncio.IncompleteReadError
+        return None
+    length, frame_type = _HEADER.unpack(header)
+    if not 1 <= length <= MAX_FRAME_SIZE:
+        raise ValueError(f"bad frame length {length}")
+    try:
+        payload = await reader.readexactly(length - 1)
+    except EOFError:
+        return None
+    return parse_frame(frame_type, memoryview(payload))
@@ -0,0 +1,294 @@
+"""
+Creates the chat database's tables and upgrades older databases in place.
+
+The schema version lives in SQLite's 'user_version' pragma. Upgrading from the original
+untyped tables happens in small steps - one short transaction to swap the tables, then one
+transaction per room to split its old 'room_content' blob into rows - so other users can
+keep chatting while a big database migrates. Every step can be re-run, which means several
+processes can migrate the same database at once, and a migration that was interrupted
+simply carries on the next time someone starts the program.
+
+There's one upgrade, from the original tables straight to the current ones (version 2).
+Messages keep just their text now, and the chat draws the speech bubble when it shows them
+(see speech_bubble.py), so the last step unwraps the stored bubbles, in batches too - unless
+we can't be sure what was inside one, in which case it stays as it was stored, and loses its
+author: that's what tells the chat to show it as it is rather than draw a bubble around it.
+"""
+import re
+
+SCHEMA_VERSION = 2
+
+# users and the room directory - these live in the main database file
+CATALOG_TABLES = (
+    """CREATE TABLE IF NOT EXISTS administrative (
+                id INTEGER PRIMARY KEY,
+                users TEXT NOT NULL UNIQUE,
+                passwords TEXT  -- NULL only for old accounts that never had one: nobody can log into those
+    );""",
+    """CREATE TABLE IF NOT EXISTS rooms (
+                id INTEGER PRIMARY KEY,
+                room_name TEXT NOT NULL UNIQUE,
+                room_update TEXT NOT NULL DEFAULT '0'
+    );""",
+    """CREATE TABLE IF NOT EXISTS settings (
+                name TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+    );""",
+    # what clients log back in with after losing their connection - hashes only, never the tokens themselves
+    """CREATE TABLE IF NOT EXISTS resume_tokens (
+                token_hash TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                created_at REAL NOT NULL
+    );""",
+)
+
+# messages - these live in the main database file too, unless rooms are sharded (see utils.configure_db)
+MESSAGE_TABLES = (
+    # one row per message - sending only ever appends, it never rewrites the room's history
+    """CREATE TABLE IF NOT EXISTS messages (
+                room_id INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                author TEXT,  -- NULL for old content we couldn't take apart: it's shown exactly as stored
+                created_at REAL NOT NULL,
+                body TEXT NOT NULL,
+                PRIMARY KEY (room_id, seq)
+    ) WITHOUT ROWID;""",
+    # each room's last sequence number - kept next to the messages so numbering carries on after archiving
+    """CREATE TABLE IF NOT EXISTS room_sequences (
+                room_id INTEGER PRIMARY KEY,
+                last_seq INTEGER NOT NULL
+    );""",
+)
+
+# matches one speech bubble as 'SpeechBubble.beautify' used to store them (in 'room_content', then in 'messages')
+LEGACY_BUBBLE_WIDTH = 50
+LEGACY_BUBBLE = re.compile(r"-{50}\n\| (?P<author>.*?): .*?\n-{50}", re.DOTALL)
+
+UNWRAP_BATCH_SIZE = 1000  # messages per transaction when unwrapping stored bubbles
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def _table_exists(conn, table):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone() is not None
+
+
+def split_legacy_room_content(room_content):
+    """
+    Splits an old 'room_content' blob into a list of (author, body) messages.
+
+    If the blob isn't made up entirely of speech bubbles we don't guess: the whole
+    thing becomes one message without an author, so nothing is ever lost.
+    """
+    if not room_content:
+        return []
+
+    matches = list(LEGACY_BUBBLE.finditer(room_content))
+    if ''.join(match.group(0) for match in matches) != room_content:
+        return [(None, room_content)]
+
+    return [(match.group("author"), match.group(0)) for match in matches]
+
+
+def legacy_bubble(author, text, line_length=LEGACY_BUBBLE_WIDTH, inner_line_length=45):
+    """The speech bubble 'SpeechBubble.beautify' used to draw and store - quirks and all"""
+    wrapped_text = f"{author}: "
+    current_line = ""
+    for word in text.split():
+        if len(current_line) + len(word) > inner_line_length:
+            if len(current_line) > 0:
+                wrapped_text += current_line + " |\n"
+            current_line = f"|{word}"
+        else:
+            current_line += f" {word}"
+
+        if len(current_line) + len(word) > line_length:
+            wrapped_text += current_line + "\n"
+            current_line = word
+
+    if len(current_line) > 0:
+        wrapped_text += current_line
+
+    edge = "-" * line_length
+    return edge + "\n" + f"| {wrapped_text.strip()} |" + "\n" + edge
+
+
+def bubble_text(body, author):
+    """
+    Takes apart a speech bubble that 'SpeechBubble.beautify' drew for 'author' and returns
+    the text inside it - or None if 'body' isn't such a bubble.
+
+    Wrapping collapsed the text's whitespace, so we get its words back separated by single
+    spaces. Wrapping also added a '|' in front of some lines, and repeated the last word of
+    a line that ended without ' |' at the start of the next one - we undo both.
+
+    Some bubbles are ambiguous (a '|' at the start of a line may be one the user typed), so
+    we only trust our answer if 'legacy_bubble' draws exactly 'body' from it again.
+    """
+    if author is None or LEGACY_BUBBLE.fullmatch(body) is None:
+        return None
+    inner = body[LEGACY_BUBBLE_WIDTH + 1:-(LEGACY_BUBBLE_WIDTH + 1)]  # "| author: ... |"
+    prefix = f"| {author}: "
+    if not inner.startswith(prefix) or not inner.endswith(" |"):
+        return None
+
+    words = []
+    lines = inner[len(prefix):-2].split("\n")
+    repeated_word = False
+    for line in lines:
+        ends_with_pipe = line.endswith(" |")
+        line_words = line.removesuffix(" |").split()
+        if line_words and line_words[0].startswith("|"):
+            line_words[0] = line_words[0][1:]
+        if repeated_word:
+            line_words = line_words[1:]
+        words.extend(word for word in line_words if word)
+        repeated_word = not ends_with_pipe
+    text = " ".join(words)
+    if legacy_bubble(author, text) != body:
+        return None
+    return text
+
+
+def _unwrap_stored_bubbles(pool, batch_size=UNWRAP_BATCH_SIZE):
+    """
+    Replaces every stored speech bubble with the text inside it (see 'bubble_text'),
+    one short transaction per 'batch_size' messages, walking the primary key so each batch
+    carries on where the last one stopped. A bubble we can't take apart keeps its body and
+    loses its author (it's still in the bubble), so it's shown as stored. Anything that isn't
+    a bubble is left alone.
+    """
+    after = (-1, -1)
+    while True:
+        with pool.transaction() as conn:
+            rows = conn.execute(
+                """SELECT room_id, seq, author, body FROM messages WHERE (room_id, seq) > (?, ?)
+                   ORDER BY room_id, seq LIMIT ?""", (*after, batch_size)
+            ).fetchall()
+            if not rows:
+                return
+            updates = []
+            for room_id, seq, author, body in rows:
+                if author is None or LEGACY_BUBBLE.fullmatch(body) is None:
+                    continue
+                text = bubble_text(body, author)
+                updates.append((author if text is not None else None, body if text is None else text, room_id, seq))
+            conn.executemany("UPDATE messages SET author=?, body=? WHERE room_id=? AND seq=?", updates)
+        after = rows[-1][:2]
+
+
+def _swap_legacy_tables(conn, with_messages):
+    """
+    Moves the untyped tables out of the way and creates the typed ones in their place.
+
+    This only copies users and room names (not room content), so it's quick.
+    Must run inside a write transaction.
+    """
+    if not with_messages and _table_exists(conn, "rooms") and "id" not in _columns(conn, "rooms"):
+        raise RuntimeError("Databases from before version 2 can only be upgraded without sharding")
+
+    if _table_exists(conn, "administrative") and "id" not in _columns(conn, "administrative"):
+        conn.execute("ALTER TABLE administrative RENAME TO legacy_administrative")
+
+    if _table_exists(conn, "rooms") and "id" not in _columns(conn, "rooms"):
+        conn.execute("ALTER TABLE rooms RENAME TO legacy_rooms")
+
+    if _table_exists(conn, "messages") and "room_id" not in _columns(conn, "messages"):
+        conn.execute("ALTER TABLE messages RENAME TO legacy_messages")
+
+    for table in CATALOG_TABLES + (MESSAGE_TABLES if with_messages else ()):
+        conn.execute(table)
+
+    if _table_exists(conn, "legacy_administrative"):
+        # the old table allowed duplicate usernames - the first account with a name keeps it
+        conn.execute("""INSERT OR IGNORE INTO administrative (users, passwords)
+                        SELECT users, passwords FROM legacy_administrative
+                        WHERE users IS NOT NULL ORDER BY rowid""")
+        conn.execute("DROP TABLE legacy_administrative")
+
+    if _table_exists(conn, "legacy_rooms"):
+        conn.execute("""INSERT OR IGNORE INTO rooms (room_name)
+                        SELECT room_name FROM legacy_rooms
+                        WHERE room_name IS NOT NULL ORDER BY rowid""")
+
+
+def _migrate_next_legacy_room(conn):
+    """
+    Splits one legacy room's content into message rows (inside the caller's write transaction).
+
+    Returns False once there are no legacy rooms left.
+    """
+    row = conn.execute("SELECT rowid, room_name, room_content FROM legacy_rooms WHERE room_name IS NOT NULL LIMIT 1").fetchone()
+    if row is None:
+        return False
+
+    rowid, room_name, room_content = row
+    (room_id,) = conn.execute("SELECT id FROM rooms WHERE room_name=?", (room_name,)).fetchone()
+    (last_seq,) = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM messages WHERE room_id=?", (room_id,)).fetchone()
+
+    # the old blob is older than anything in the (row per message) legacy_messages table, so it goes first
+    # (we never knew when those messages were sent, so their created_at is 0)
+    legacy_messages = split_legacy_room_content(room_content)
+    conn.executemany(
+        "INSERT INTO messages (room_id, seq, author, created_at, body) VALUES (?, ?, ?, 0.0, ?)",
+        [(room_id, seq, author, body) for seq, (author, body) in enumerate(legacy_messages, start=last_seq + 1)],
+    )
+
+    if _table_exists(conn, "legacy_messages"):
+        conn.execute("""INSERT INTO messages (room_id, seq, author, created_at, body)
+                        SELECT ?, seq + ?, author, created_at, body FROM legacy_messages
+                        WHERE room_name=? ORDER BY seq""", (room_id, last_seq + len(legacy_messages), room_name,))
+        conn.execute("DELETE FROM legacy_messages WHERE room_name=?", (room_name,))
+
+    conn.execute("""INSERT OR REPLACE INTO room_sequences (room_id, last_seq)
+                    SELECT ?, COALESCE(MAX(seq), 0) FROM messages WHERE room_id=?""", (room_id, room_id,))
+
+    # duplicate room names used to be possible - any later copy's content is appended in the next round
+    conn.execute("DELETE FROM legacy_rooms WHERE rowid=?", (rowid,))
+    return True
+
+
+def migrate(pool, with_messages=True):
+    """
+    Brings the database behind 'pool' up to SCHEMA_VERSION - from the original untyped
+    tables, or from nothing at all.
+
+    'with_messages' says whether this database holds messages as well as users and rooms
+    (it doesn't when rooms are sharded - see 'migrate_shard').
+    """
+    with pool.connection() as conn:
+        (version,) = conn.execute("PRAGMA user_version").fetchone()
+    if version >= SCHEMA_VERSION:
+        return
+
+    # this creates the current tables - for a new database, that's all there is to do
+    with pool.transaction() as conn:
+        _swap_legacy_tables(conn, with_messages)
+
+    while True:
+        with pool.transaction() as conn:
+            if not _table_exists(conn, "legacy_rooms") or not _migrate_next_legacy_room(conn):
+                break
+
+    with pool.transaction() as conn:
+        conn.execute("DROP TABLE IF EXISTS legacy_rooms")
+        conn.execute("DROP TABLE IF EXISTS legacy_messages")
+
+    # in batches outside any one transaction - the legacy rooms we just split are all bubbles
+    if with_messages:
+        _unwrap_stored_bubbles(pool)
+    with pool.transaction() as conn:
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+
+def migrate_shard(pool):
+    """Creates the message tables in one shard's database file (shards only ever held the current ones)"""
+    with pool.transaction() as conn:
+        (version,) = conn.execute("PRAGMA user_version").fetchone()
+        if version >= SCHEMA_VERSION:
+            return
+        for table in MESSAGE_TABLES:
+            conn.execute(table)
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
@@ -0,0 +1,283 @@
+"""
+A full-screen view for the chat: messages above, and a fixed input line at the bottom.
+
+Printing every update (and scrolling the terminal to make room for it) wipes whatever the
+user was typing, and costs a screenful of output per message. ChatScreen instead keeps what
+should be on screen in memory, remembers what it last drew, and writes only the rows that
+changed - new messages scroll the message area with the terminal's own scrolling, so a
+message costs its own rows. Redraws are batched to at most CHATROOM_FRAME_RATE a second (and
+wait while the terminal is still taking the last one), however fast messages arrive.
+
+The input line is ours too: we read keys as they're typed (the terminal is in cbreak mode
+while the chat is open), so the draft is redrawn after every update instead of vanishing.
+
+We only keep what fits on the screen in view, and there are no scroll keys - so for a lot of
+output at once (a room's whole history) 'pause' hands the terminal back: it's printed as
+usual, at the terminal's pace and into its scrollback, and 'resume' picks up from there.
+
+Outside a terminal (or with CHATROOM_SCREEN=plain) 'ChatScreen.open' returns None, and the
+chat prints as it always did.
+"""
+import asyncio
+import codecs
+import os
+import shutil
+import signal
+import sys
+import time
+from collections import deque
+
+from aioconsole.stream import get_standard_streams
+
+from wrapping import cut, display_width
+
+try:
+    import termios
+    import tty
+except ImportError:  # Windows - we fall back to printing
+    termios = None
+
+SCREEN_MODE = os.environ.get("CHATROOM_SCREEN", "auto")  # "plain" turns the screen view off
+FRAME_RATE = float(os.environ.get("CHATROOM_FRAME_RATE", 30))  # the most redraws per second
+SCROLLBACK_LINES = 1000  # lines of the message area we keep (only the last screenful is shown)
+
+CSI = "\x1b["
+
+
+def _rows(line, columns):
+    """The screen rows 'line' takes up in a terminal 'columns' wide"""
+    if display_width(line) <= columns:
+        return [line]
+    return cut(line, columns)
+
+
+class ChatScreen:
+    def __init__(self, reader, writer, input_fd, output_fd, frame_interval=1 / FRAME_RATE):
+        self.reader = reader
+        self.writer = writer
+        self.input_fd = input_fd
+        self.output_fd = output_fd
+        self.frame_interval = frame_interval
+        self.lines = deque(maxlen=SCROLLBACK_LINES)  # the message area's lines, oldest first
+        self.prompt = ""
+        self.draft = ""  # what the user has typed so far
+        self.frames = 0
+        self.rows_drawn = 0
+        self.bytes_written = 0
+        self._size = None  # (rows, columns) when we last drew
+        self._drawn = []  # what's on each row of the message area right now
+        self._drawn_input = None
+        self._added_rows = 0  # rows added to the bottom of the message area since the last frame
+        self._frame = None  # the scheduled redraw, if there is one
+        self._last_frame = 0.0
+        self._typed = deque()  # lines the user has entered that 'read_line' hasn't returned yet
+        self._line_entered = None  # what 'read_line' waits on
+        self._eof = False
+        self._escape = None  # the escape sequence (arrow keys and such) we're in the middle of, if any
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._saved_mode = termios.tcgetattr(input_fd)
+        self._keys = None  # the task reading keys, while we have the terminal
+        self.resume()
+
+
+    @classmethod
+    async def open(cls):
+        """A ChatScreen on our terminal - or None if we're not in one, and should just print"""
+        if SCREEN_MODE == "plain" or termios is None or not (sys.stdin.isatty() and sys.stdout.isatty()):
+            return None
+        reader, writer = await get_standard_streams()  # we share aioconsole's, so 'ainput' and we don't fight over stdin
+        if not isinstance(reader, asyncio.StreamReader):
+            return None
+        return cls(reader, writer, sys.stdin.fileno(), sys.stdout.fileno())
+
+
+    def write(self, text):
+        """Adds 'text' (any number of lines) to the bottom of the message area"""
+        columns = self._size[1] if self._size else 80
+        for line in text.split('\n'):
+            self.lines.append(line)
+            self._added_rows += len(_rows(line, columns))
+        self._schedule()
+
+
+    def clear(self):
+        """Empties the message area"""
+        self.lines.clear()
+        self._schedule()
+
+
+    async def read_line(self, prompt="> "):
+        """Waits for the user to enter a line, like 'ainput' - they can type while messages arrive"""
+        self.prompt = prompt
+        self._draw_input()
+        while not self._typed:
+            if self._eof:
+                raise EOFError
+            self._line_entered = asyncio.get_running_loop().create_future()
+            await self._line_entered
+        return self._typed.popleft()
+
+
+    def pause(self):
+        """
+        Puts the terminal back the way we found it, leaving the last screenful of messages on it,
+        so the caller can print to it. What's 'write'n meanwhile is kept, but not drawn.
+        """
+        if self._keys is None:
+            return
+        self._keys.cancel()
+        self._keys = None
+        if self._frame is not None:
+            self._frame.cancel()
+            self._frame = None
+        self._draw()
+        asyncio.get_running_loop().remove_signal_handler(signal.SIGWINCH)
+        termios.tcsetattr(self.input_fd, termios.TCSADRAIN, self._saved_mode)
+        self._write(f"{CSI}r{CSI}{self._size[0]};1H\n")  # no more scroll region, and the cursor below it all
+
+
+    def resume(self):
+        """Takes the terminal over (again), redrawing it from scratch"""
+        if self._keys is not None:
+            return
+        tty.setcbreak(self.input_fd)  # keys arrive as they're typed, and we do the echoing
+        asyncio.get_running_loop().add_signal_handler(signal.SIGWINCH, self._schedule)
+        self._keys = asyncio.create_task(self._read_keys())
+        self._size = None  # someone else has been writing to the terminal
+        self._schedule()
+
+
+    def close(self):
+        """Hands the terminal back for good (see 'pause')"""
+        self.pause()
+
+
+    def stats(self):
+        return {"frames": self.frames, "rows drawn": self.rows_drawn, "bytes written": self.bytes_written}
+
+
+    def _schedule(self):
+        """Redraws once the frame budget allows - everything that changes before then goes into the same frame"""
+        if self._frame is None and self._keys is not None:
+            delay = max(0.0, self._last_frame + self.frame_interval - time.monotonic())
+            self._frame = asyncio.get_running_loop().call_later(delay, self._draw_frame)
+
+
+    def _draw_frame(self):
+        self._frame = None
+        if self.writer.transport.get_write_buffer_size():
+            self._schedule()  # the terminal is still taking the last frame - skip this one
+            return
+        self._draw()
+
+
+    def _terminal_size(self):
+        try:
+            size = os.get_terminal_size(self.output_fd)
+        except OSError:
+            size = shutil.get_terminal_size()
+        return max(size.lines, 2), max(size.columns, 2)
+
+
+    def _view(self, height, columns):
+        """The message area's rows, top to bottom: the last 'height' rows of our lines"""
+        rows = []
+        for line in reversed(self.lines):
+            rows.extend(reversed(_rows(line, columns)))
+            if len(rows) >= height:
+                break
+        rows = rows[:height]
+        rows.reverse()
+        return [''] * (height - len(rows)) + rows
+
+
+    def _draw(self):
+        """Writes the rows that changed since the last frame"""
+        self._last_frame = time.monotonic()
+        size = self._terminal_size()
+        rows, columns = size
+        height = rows - 1
+        out = []
+        if size != self._size:  # first frame, or the terminal was resized - start from a blank screen
+            self._size = size
+            self._drawn = [''] * height
+            self._drawn_input = None
+            out.append(f"{CSI}1;{height}r{CSI}2J")  # the message area scrolls on its own, below it the input line stays put
+
+        view = self._view(height, columns)
+        added, self._added_rows = self._added_rows, 0
+        if 0 < added < height and self._drawn[added:] == view[:height - added]:
+            # new rows at the bottom: let the terminal scroll the rest up instead of redrawing them
+            out.append(f"{CSI}{height};1H" + '\n' * added)
+            self._drawn = self._drawn[added:] + [''] * added
+        for n, (drawn, row) in enumerate(zip(self._drawn, view)):
+            if drawn != row:
+                out.append(f"{CSI}{n + 1};1H{CSI}2K{row}")
+                self.rows_drawn += 1
+        self._drawn = view
+
+        out.append(self._input_row())
+        self.frames += 1
+        self._write(''.join(out))
+
+
+    def _input_row(self):
+        """What puts the input line on screen (if it changed), and the cursor at the end of the draft"""
+        rows, columns = self._size
+        shown = _rows(self.prompt + self.draft, columns - 1)[-1]  # a draft too long for the line pages sideways
+        if shown == self._drawn_input:
+            return f"{CSI}{rows};{display_width(shown) + 1}H"
+        self._drawn_input = shown
+        return f"{CSI}{rows};1H{CSI}2K{shown}"
+
+
+    def _draw_input(self):
+        """Keys are echoed straight away - only the message area waits for the next frame"""
+        if self._size is not None and self._keys is not None:
+            self._write(self._input_row())
+
+
+    def _write(self, text):
+        data = text.encode()
+        self.bytes_written += len(data)
+        self.writer.write(data)
+
+
+    async def _read_keys(self):
+        while True:
+            data = await self.reader.read(1024)
+            if not data:
+                self._eof = True
+                self._wake_reader()
+                return
+            for key in self._decoder.decode(data):
+                self._key(key)
+            self._draw_input()
+
+
+    def _key(self, key):
+        if self._escape is not None:
+            self._escape += key
+            if self._escape in ('[', 'O') or (self._escape[0] == '[' and len(self._escape) > 1 and not '@' <= key <= '~'):
+                return  # not finished yet
+            self._escape = None  # we don't do anything with arrow keys and such - just keep them out of the draft
+        elif key == '\x1b':
+            self._escape = ''
+        elif key in '\r\n':
+            self._typed.append(self.draft)
+            self.draft = ''
+            self._wake_reader()
+        elif key in '\x7f\b':
+            self.draft = self.draft[:-1]
+        elif key == '\x15':  # Ctrl-U
+            self.draft = ''
+        elif key == '\x04' and not self.draft:  # Ctrl-D
+            self._eof = True
+            self._wake_reader()
+        elif key.isprintable():
+            self.draft += key
+
+
+    def _wake_reader(self):
+        if self._line_entered is not None and not self._line_entered.done():
+            self._line_entered.set_result(None)
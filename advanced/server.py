@@ -0,0 +1,466 @@
+"""
+The chat server: one process that owns the database and every room's subscribers.
+
+Start it with 'python server.py' (from this folder), then run 'python client.py' in each
+terminal, on this machine or another one ('--host'). Clients never open the database
+themselves - they send requests over TCP, and when someone sends a message the server
+commits it once, encodes it once, and hands it to everyone else in the room from memory.
+
+The protocol is length-prefixed binary frames (see protocol.py). Every request gets exactly
+one reply with the same request id (plus an 'error' if it failed). Sending a message is a
+SEND frame, answered with its sequence number; new messages in the rooms a client has
+subscribed to are pushed to it as MESSAGE frames. Everything else is a JSON request with
+an 'op' - see ClientSession for the ops.
+
+A client that can't keep up has its pushed messages dropped or coalesced (see outbound.py) -
+with 'coalesce' it gets a RESYNC frame instead, and catches up with 'messages_after'.
+
+One process only uses one CPU core. With '--workers N' we start N worker processes that
+all listen on the same port (SO_REUSEPORT - the kernel spreads new connections between
+them), and this process runs a message broker (see broker.py) as the bus between them:
+each worker subscribes to the rooms its own clients are in and publishes every message
+it commits, so a message sent to a room on one worker reaches that room's clients on
+every other worker too.
+
+Workers add cores for the per-client work: reading and answering requests, writing pushed
+messages to sockets, hashing passwords. They don't raise how many messages a second the
+server can take past two things every message still goes through once - SQLite's single
+writer for its database file (CHATROOM_SHARDS spreads rooms over several), and the bus
+process. We haven't measured workers scaling at all yet: the one machine we benchmarked
+on had a single core, and there 2 and 4 workers were slower than one.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import sqlite3
+import tempfile
+from collections import defaultdict
+
+import passwords
+import protocol
+import utils
+from async_db import AsyncDB
+from broker import Broker, BrokerClient
+from outbound import OUTBOUND_POLICY, OUTBOUND_QUEUE_SIZE, POLICIES, OutboundQueue, total_stats
+
+HOST = os.environ.get("CHATROOM_SERVER_HOST", "127.0.0.1")
+PORT = int(os.environ.get("CHATROOM_SERVER_PORT", 8765))
+
+MAX_PAGE_SIZE = 500  # the most messages we send back for one request
+
+
+class ChatServer:
+    """
+    Serves chat clients over TCP - the whole server, or one of its workers (see 'run_workers').
+
+    A worker is given the path of the bus ('bus_socket') and keeps one broker connection
+    to it: it subscribes to a room there while any of its own clients are in it, and
+    publishes every message its clients send. Everything else is the same either way.
+    """
+    def __init__(self, db=None, queue_size=OUTBOUND_QUEUE_SIZE, policy=OUTBOUND_POLICY, worker=None, bus_socket=None):
+        self.db = db or AsyncDB()
+        self.queue_size = queue_size  # how many pushed messages each client can fall behind by
+        self.policy = policy  # ... and what we do when it falls further behind (see outbound.py)
+        self.worker = worker  # our number, if we're one of several workers
+        self.bus_socket = bus_socket
+        self.bus = None  # our BrokerClient, while we're connected to the bus
+        self.clients = set()
+        self.subscribers = defaultdict(set)  # room -> ClientSessions subscribed to it
+        self.messages_sent = 0
+        self.deliveries = 0
+        self.slow_disconnects = 0
+        self.bus_received = 0  # messages other workers sent us
+        self.bus_resyncs = 0  # times we fell behind on the bus
+
+
+    async def publish(self, room, room_id, seq, author, author_id, created_at, body, sender=None):
+        """Pushes a new message to the room's subscribers here (except its sender), and to the other workers"""
+        self.messages_sent += 1
+        self.deliver(room, protocol.encode_message(room_id, seq, author_id, created_at, body), sender)
+        if self.bus is not None:
+            await self.bus.publish(room, seq, author, created_at, body, room_id=room_id, author_id=author_id)
+
+
+    def deliver(self, room, data, sender=None):
+        """
+        Queues an encoded message for every subscriber of 'room' (in this process) except its sender.
+
+        Queueing never waits - each client's own task writes its queue to the socket as fast
+        as that client reads it.
+        """
+        for session in list(self.subscribers.get(room, ())):
+            if session is not sender:
+                session.push(data)
+                self.deliveries += 1
+
+
+    async def subscribe(self, session, room):
+        first = room not in self.subscribers
+        self.subscribers[room].add(session)
+        if first and self.bus is not None:
+            await self.bus.subscribe(room)
+
+
+    async def unsubscribe(self, session, room):
+        self.subscribers[room].discard(session)
+        if not self.subscribers[room]:
+            del self.subscribers[room]
+            if self.bus is not None:
+                await self.bus.unsubscribe(room)
+
+
+    async def follow_bus(self):
+        """Delivers what the other workers publish on the bus to our own subscribers, until the bus goes away"""
+        try:
+            while True:
+                message = await self.bus.next_message()
+                if message.get("op") == "resync":
+                    # the bus dropped messages we were too slow to take - everyone here catches up from the database
+                    self.bus_resyncs += 1
+                    for session in list(self.clients):
+                        if session.rooms:
+                            session.push(protocol.encode_resync(message["skipped"]))
+                else:
+                    self.bus_received += 1
+                    frame = protocol.encode_message(message["room_id"], message["seq"], message["author_id"], message["created_at"], message["body"])
+                    self.deliver(message["room"], frame)
+        except ConnectionError:
+            pass
+        finally:
+            self.bus.close()
+            self.bus = None
+
+
+    async def handle_client(self, reader, writer):
+        session = ClientSession(self, reader, writer)
+        self.clients.add(session)
+        try:
+            await session.run()
+        except (ConnectionError, ValueError):
+            pass  # a client that goes away or talks nonsense just gets dropped
+        finally:
+            self.clients.discard(session)
+            session.finished.set()
+            for room in session.rooms:
+                try:
+                    await self.unsubscribe(session, room)
+                except ConnectionError:
+                    pass  # the bus is gone, and we're on our way out too
+            writer.close()
+
+
+    async def disconnect_everyone(self):
+        """Hangs up on every client and waits for their sessions to finish"""
+        for session in list(self.clients):
+            session.writer.transport.abort()
+        await asyncio.gather(*(session.finished.wait() for session in list(self.clients)))
+
+
+    def stats(self):
+        """Our counters - with several workers, just this worker's"""
+        stats = {
+            "clients": len(self.clients),
+            "rooms": len(self.subscribers),
+            "messages": self.messages_sent,
+            "deliveries": self.deliveries,
+            "outbound queues": {**total_stats(session.outbound for session in self.clients), "policy": self.policy, "slow_disconnects": self.slow_disconnects},
+            "database calls": self.db.stats(),
+            "password hashing": passwords.hasher.stats(),
+        }
+        if self.worker is not None:
+            stats["worker"] = self.worker
+            stats["bus"] = {"connected": self.bus is not None, "received": self.bus_received, "resyncs": self.bus_resyncs}
+        return stats
+
+
+    async def serve(self, host=HOST, port=PORT):
+        utils.ensure_schema()
+        if self.bus_socket is None:
+            server = await asyncio.start_server(self.handle_client, host, port)
+            async with server:
+                await server.serve_forever()
+            return
+
+        # a worker: the other workers listen on the same port, and the bus connects us
+        self.bus = await BrokerClient.connect(self.bus_socket)
+        if self.bus is None:
+            raise ConnectionError(f"There's no bus at {self.bus_socket}")
+        server = await asyncio.start_server(self.handle_client, host, port, reuse_port=True)
+        print(f"Worker {self.worker} (pid {os.getpid()}) listening on {host}:{port}", flush=True)
+        async with server:
+            await self.follow_bus()  # we can't reach the other workers' clients without it, so we stop with it
+        await self.disconnect_everyone()
+
+
+def run_worker(worker, host, port, bus_socket, queue_size, policy):
+    """The body of each worker process (see 'run_workers')"""
+    try:
+        asyncio.run(ChatServer(queue_size=queue_size, policy=policy, worker=worker, bus_socket=bus_socket).serve(host, port))
+    except KeyboardInterrupt:
+        pass  # Ctrl+C reaches every worker - the main process says goodbye for all of us
+    finally:
+        passwords.hasher.close()  # now - on its way out a worker process waits for its children, and the pool's would wait for work
+
+
+async def run_workers(workers, host=HOST, port=PORT, queue_size=OUTBOUND_QUEUE_SIZE, policy=OUTBOUND_POLICY):
+    """
+    Runs the server as 'workers' processes sharing one port, with this process as the bus between them.
+
+    The bus is an ordinary Broker on a private Unix socket. Workers are its only clients, so
+    it always coalesces: a worker that falls 'queue_size' messages behind gets a resync
+    marker and passes it on to its clients, which catch up from the database.
+    We stop when every worker has stopped.
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("Running several workers needs SO_REUSEPORT, which this platform doesn't have")
+    utils.ensure_schema()  # once, before the workers race to do it
+
+    with tempfile.TemporaryDirectory(prefix="chatroom-server-") as directory:
+        bus_socket = os.path.join(directory, "bus.sock")
+        bus = await Broker(queue_size, "coalesce").start(bus_socket)
+        context = multiprocessing.get_context("spawn")  # a fresh interpreter, not a copy of our event loop
+        # not daemon processes: those can't have children, and each worker has its own password hashing pool
+        # (they still stop with us - we terminate them below, and they stop on their own when the bus goes)
+        processes = [
+            context.Process(target=run_worker, args=(n, host, port, bus_socket, queue_size, policy))
+            for n in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            async with bus:
+                await asyncio.gather(*(asyncio.to_thread(process.join) for process in processes))
+        finally:
+            for process in processes:
+                process.terminate()
+
+
+class ClientSession:
+    """
+    One connected client. We handle its requests one at a time, in the order they arrive -
+    SEND frames go to 'send', and each 'op_<name>' method answers the JSON request
+    {"op": "<name>", ...} and returns the fields of its reply.
+
+    Everything except the account ops needs the client to have logged in first.
+    """
+    logged_out_ops = {"user_exists", "log_in", "create_account", "resume"}
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.db = server.db
+        self.reader = reader
+        self.writer = writer
+        self.user = None
+        self.user_id = None
+        self.rooms = set()
+        self.room_ids = {}  # room id -> name, for the rooms we're subscribed to
+        self.outbound = OutboundQueue(server.queue_size, server.policy, marker=protocol.encode_resync)
+        self._sender = asyncio.create_task(self._send_outbound())
+        self.finished = asyncio.Event()
+
+
+    def push(self, data):
+        """Queues an encoded message for this client, hanging up if it's too far behind (the 'disconnect' policy)"""
+        if not self.outbound.put(data):
+            self.server.slow_disconnects += 1
+            self.writer.transport.abort()
+
+
+    async def _send_outbound(self):
+        """Writes our queue to the socket a batch at a time, waiting for the client to read each write before taking more"""
+        try:
+            while True:
+                self.writer.write(b"".join(await self.outbound.get_batch()))
+                await self.writer.drain()
+        except ConnectionError:
+            self.writer.transport.abort()
+
+
+    async def run(self):
+        try:
+            await self._handle_requests()
+        finally:
+            self._sender.cancel()
+
+
+    async def _handle_requests(self):
+        while True:
+            frame = await protocol.read_frame(self.reader)
+            if frame is None:
+                return
+
+            if frame[0] == protocol.SEND:
+                _, request_id, room_id, body = frame
+                reply = await self.send(request_id, room_id, body)
+            elif frame[0] == protocol.REQUEST:
+                _, request_id, request = frame
+                reply = protocol.encode_reply(request_id, await self.handle_request(request))
+            else:
+                raise ValueError(f"clients don't send frames of type {frame[0]}")
+            self.outbound.put(reply, droppable=False)
+
+
+    async def handle_request(self, request):
+        """Answers a JSON request, returning the fields of its reply"""
+        if not isinstance(request, dict):
+            return {"error": "a request is a JSON object"}
+        op = request.get("op")
+        handler = getattr(self, f"op_{op}", None)
+        if handler is None:
+            return {"error": f"unknown op {op!r}"}
+        if self.user is None and op not in self.logged_out_ops:
+            return {"error": "log in first"}
+        try:
+            return await handler(request) or {}
+        except (KeyError, TypeError, ValueError, AttributeError) as e:  # a field missing, or of the wrong type
+            return {"error": f"bad {op} request: {e}"}
+
+
+    async def send(self, request_id, room_id, body):
+        """Commits a message (through the group-commit writer) and pushes it to the room's other subscribers"""
+        room = self.room_ids.get(room_id)
+        if self.user is None:
+            return protocol.encode_reply(request_id, {"error": "log in first"})
+        if room is None:
+            return protocol.encode_reply(request_id, {"error": "subscribe to a room before sending to it"})
+
+        commit = await self.db.run(utils.submit_message_to_room, room, self.user, body)
+        seq, created_at = await asyncio.wrap_future(commit)
+        await self.server.publish(room, room_id, seq, self.user, self.user_id, created_at, body, sender=self)
+        return protocol.encode_sent(request_id, seq, created_at)
+
+
+    async def op_user_exists(self, request):
+        return {"exists": await self.db.run(utils.query_exists_long, request["user"])}
+
+
+    async def op_log_in(self, request):
+        """Replies with {"ok": ..., "token": ...} - the client keeps the token, not the password, to 'resume' with"""
+        if not await passwords.check_password(self.db, request["user"], request["password"]):
+            return {"ok": False}
+        return await self._logged_in(request["user"])
+
+
+    async def op_create_account(self, request):
+        try:
+            await passwords.create_account(self.db, request["user"], request["password"])
+        except sqlite3.IntegrityError:
+            return {"ok": False}
+        return await self._logged_in(request["user"])
+
+
+    async def _logged_in(self, user):
+        self.user = user
+        self.user_id = await self.db.run(utils.get_user_id, user)
+        return {"ok": True, "token": await passwords.issue_resume_token(self.db, user)}
+
+
+    async def op_room_exists(self, request):
+        return {"exists": await self.db.run(utils.query_exists_short, request["room"])}
+
+
+    async def op_create_room(self, request):
+        try:
+            await self.db.run(utils.add_room_in_rooms_table, request["room"])
+        except sqlite3.IntegrityError:
+            return {"ok": False}
+        return {"ok": True}
+
+
+    async def op_subscribe(self, request):
+        """
+        Starts pushing the room's new messages to this client, and replies with the room's id
+        (which MESSAGE and SEND frames use instead of its name) and its latest 'limit' messages.
+
+        We subscribe before reading, so a message sent in between is pushed (and may come
+        before this reply) - clients should catch up with 'messages_after' once they have the page.
+        """
+        limit = min(int(request.get("limit", MAX_PAGE_SIZE)), MAX_PAGE_SIZE)
+        room_id = await self._subscribe(request["room"])
+        return {"room_id": room_id, "messages": await self.db.run(utils.get_recent_room_messages, request["room"], limit)}
+
+
+    async def _subscribe(self, room):
+        room_id = await self.db.run(utils.get_room_id, room)
+        if room_id is None:
+            raise ValueError(f"There is no room called {room!r}")
+        self.rooms.add(room)
+        self.room_ids[room_id] = room
+        await self.server.subscribe(self, room)
+        return room_id
+
+
+    async def op_resume(self, request):
+        """
+        Picks up where a client that lost its connection left off, in one request: logs it back
+        in and resubscribes it to its rooms, given {"user": ..., "token": (from logging in), "cursors":
+        {room: the last seq it has}, "limit": N}. Checking the token is a query, not a password hash.
+
+        For each room we reply with {"room_id": ..., "messages": [...], "complete": ...} - just
+        the messages after its cursor, or if it missed more than 'limit', the room's latest
+        'limit' messages and "complete": false. So however long a client was gone, resuming
+        reads at most a page per room.
+        """
+        if not await passwords.check_resume_token(self.db, request["user"], request["token"]):
+            return {"ok": False}
+        self.user = request["user"]
+        self.user_id = await self.db.run(utils.get_user_id, self.user)
+        limit = min(int(request.get("limit", MAX_PAGE_SIZE)), MAX_PAGE_SIZE)
+        rooms = {}
+        for room, after_seq in request["cursors"].items():
+            room_id = await self._subscribe(room)
+            messages, complete = await self.db.run(utils.get_room_messages_since, room, int(after_seq), limit)
+            rooms[room] = {"room_id": room_id, "messages": messages, "complete": complete}
+        return {"ok": True, "rooms": rooms}
+
+
+    async def op_unsubscribe(self, request):
+        room = request["room"]
+        if room in self.rooms:
+            self.rooms.discard(room)
+            self.room_ids = {room_id: name for room_id, name in self.room_ids.items() if name != room}
+            await self.server.unsubscribe(self, room)
+
+
+    async def op_user_names(self, request):
+        """Given {"ids": [user id, ...]} (from MESSAGE frames), replies with {"names": {user id: username}}"""
+        return {"names": await self.db.run(utils.get_user_names, [int(user_id) for user_id in request["ids"]])}
+
+
+    async def op_messages_after(self, request):
+        """Given {"cursors": {room: after_seq}}, replies with each room's messages after its cursor"""
+        cursors = {room: int(after_seq) for room, after_seq in request["cursors"].items()}
+        return {"messages": await self.db.run(utils.get_new_messages_in_rooms, cursors)}
+
+
+    async def op_messages_before(self, request):
+        limit = min(int(request["limit"]), MAX_PAGE_SIZE)
+        return {"messages": await self.db.run(utils.get_room_messages_before, request["room"], int(request["before_seq"]), limit)}
+
+
+    async def op_messages_from(self, request):
+        """Given {"room", "after_seq", "limit"}, replies with the room's next 'limit' messages after 'after_seq' - clients page through a room's whole history with this"""
+        limit = min(int(request["limit"]), MAX_PAGE_SIZE)
+        return {"messages": await self.db.run(utils.get_room_history_chunk, request["room"], int(request["after_seq"]), limit)}
+
+
+    async def op_stats(self, request):
+        return self.server.stats()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves chat rooms to 'client.py' over TCP")
+    parser.add_argument("--host", default=HOST, help="address to listen on (0.0.0.0 for every interface)")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--queue-size", type=int, default=OUTBOUND_QUEUE_SIZE, help="pushed messages a client can fall behind by")
+    parser.add_argument("--slow-client-policy", choices=POLICIES, default=OUTBOUND_POLICY, help="what to do when a client falls further behind")
+    parser.add_argument("--workers", type=int, default=1, help="processes to serve clients with (one per CPU core is a good start)")
+    args = parser.parse_args()
+
+    print(f"Chat server listening on {args.host}:{args.port}" + (f" with {args.workers} workers" if args.workers > 1 else ""), flush=True)
+    if args.workers > 1:
+        asyncio.run(run_workers(args.workers, args.host, args.port, args.queue_size, args.slow_client_policy))
+    else:
+        asyncio.run(ChatServer(queue_size=args.queue_size, policy=args.slow_client_policy).serve(args.host, args.port))
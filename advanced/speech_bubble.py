@@ -1,42 +1,92 @@
+import shutil
+import threading
+from collections import OrderedDict
+
 from aioconsole import aprint
 
+from wrapping import draw_bubble
+
+BUBBLE_WIDTH = 50  # how wide we draw speech bubbles - narrower terminals get narrower ones
+MIN_BUBBLE_WIDTH = 20
+
 
 class SpeechBubble:
-    def __init__(self, username, text, line_length=50, inner_line_length=45):
+    def __init__(self, username, text, line_length=BUBBLE_WIDTH):
         self.username = username
         self.text = text
         self.line_length = line_length
-        self.inner_line_length = inner_line_length
-
-    
-    def wrap_multi_line(self, username, text):
-        """Nitty gritty of formatting a speech bubble"""
-        wrapped_text = f"{username}: "
-        current_line = ""
-        for word in text.split():
-            if len(current_line) + len(word) > self.inner_line_length:
-                if len(current_line) > 0:
-                    wrapped_text += current_line + " |\n"
-                current_line = f"|{word}"
-            else:
-                current_line += f" {word}"
-    
-            if len(current_line) + len(word) > self.line_length:
-                wrapped_text += current_line + "\n"
-                current_line = word   
-
-        if len(current_line) > 0:
-            wrapped_text += current_line
-                
-        return wrapped_text.strip()
-    
+
+
+    def render(self):
+        """Putting the speech bubble together (see wrapping.py)"""
+        return draw_bubble(self.username, self.text, self.line_length)
+
 
     async def beautify(self):
-        """Putting the speech bubble together"""
-        top = "-" * self.line_length
-        bottom = "-" * self.line_length
-        body = f"| {self.wrap_multi_line(self.username, self.text)} |"
-        await aprint(top)
-        await aprint(body)
-        await aprint(bottom)
-        return top + "\n" + body + "\n" + bottom
+        """Prints the speech bubble, and returns it"""
+        bubble = self.render()
+        await aprint(bubble)
+        return bubble
+
+
+def bubble_width():
+    """How wide to draw speech bubbles in this terminal right now"""
+    columns = shutil.get_terminal_size((BUBBLE_WIDTH, 24)).columns
+    return max(MIN_BUBBLE_WIDTH, min(BUBBLE_WIDTH, columns))
+
+
+class BubbleRenderer:
+    """
+    Turns stored messages into speech bubbles when they're shown.
+
+    The database only keeps each message's author and text, so we draw the bubble here -
+    and remember the last 'maxsize' we drew, keyed by (message, width), so scrolling back
+    over or switching to messages we've already shown doesn't wrap them again. The width
+    is part of the key, so resizing the terminal just draws new bubbles.
+
+    Messages without an author are old content the upgrade couldn't take apart (see
+    schema.py) - often a bubble drawn long ago - and are shown exactly as they were stored.
+    """
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._bubbles = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def render(self, key, author, text, width=None):
+        """
+        The speech bubble for 'text' by 'author'. 'key' identifies the message (e.g. (room, seq)) -
+        pass None for one that isn't stored yet, and we won't cache it.
+        """
+        width = width or bubble_width()
+        if key is not None:
+            with self._lock:
+                bubble = self._bubbles.get((key, width))
+                if bubble is not None:
+                    self._bubbles.move_to_end((key, width))
+                    self.hits += 1
+                    return bubble
+
+        bubble = self._draw(author, text, width)
+        if key is not None:
+            with self._lock:
+                self.misses += 1
+                self._bubbles[(key, width)] = bubble
+                if len(self._bubbles) > self.maxsize:
+                    self._bubbles.popitem(last=False)
+        return bubble
+
+
+    def _draw(self, author, text, width):
+        if author is None:
+            return text
+        return SpeechBubble(author, text, width).render()
+
+
+    def stats(self):
+        return {"cached": len(self._bubbles), "hits": self.hits, "misses": self.misses}
+
+
+renderer = BubbleRenderer()
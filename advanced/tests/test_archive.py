@@ -0,0 +1,45 @@
+import archive
+import utils
+
+
+def test_blocks_round_trip():
+    messages = [(1, "alice", 1700000000.5, "hi"), (2, None, 0.0, "from before we had authors"), (3, "bob", 1700000001.0, "你好 😀\n" * 100)]
+    assert archive.decode_block(archive.encode_block(messages)) == messages
+
+
+def test_archived_messages_read_back_like_the_rest(tmp_path):
+    utils.configure_db(str(tmp_path / "chat.db"))
+    utils.ensure_schema()
+    utils.add_room_in_rooms_table("r")
+    for n in range(1, 1001):
+        utils.add_message_to_room("r", "alice", f"message {n}")
+    everything = utils.get_room_messages("r")
+
+    moved = archive.archive_old_messages(utils.shard_pool_for_room("r"), utils.archive, max_age_seconds=-60, block_size=64)
+    assert moved == 1000
+    assert utils.get_room_messages("r") == everything
+    assert utils.get_room_messages_before("r", 501, 10) == everything[490:500]
+    assert utils.get_room_history_chunk("r", 990, 100) == everything[990:]
+
+    # numbering carries on after the whole room is archived, and new messages follow the archived ones
+    seq, _created_at = utils.add_message_to_room("r", "bob", "new")
+    assert seq == 1001
+    assert [body for _seq, _author, _created_at, body in utils.get_room_messages_before("r", None, 3)] == ["message 999", "message 1000", "new"]
+
+
+def test_only_the_recently_read_rooms_stay_mapped(tmp_path):
+    messages = archive.MessageArchive(str(tmp_path / "archive"), mapped_rooms=3)
+    with messages.writing():
+        for room_id in range(1, 11):
+            messages.append_block(room_id, [(1, "alice", 0.0, f"hi {room_id}")])
+
+    for room_id in range(1, 11):
+        assert messages.messages_after(room_id, 0, 10)[0][3] == f"hi {room_id}"
+    messages.messages_after(8, 0, 10)
+    assert list(messages._mapped) == [9, 10, 8]
+
+    with messages.writing():  # the room grew - reading remaps it
+        messages.append_block(1, [(2, "bob", 0.0, "more")])
+    assert [message[3] for message in messages.messages_after(1, 0, 10)] == ["hi 1", "more"]
+    assert list(messages._mapped) == [10, 8, 1]
+    messages.close()
@@ -0,0 +1,82 @@
+import asyncio
+import contextlib
+
+from broker import Broker, BrokerClient
+
+
+@contextlib.asynccontextmanager
+async def running_broker(tmp_path):
+    """A Broker on a socket of our own, in this event loop; yields a function that connects a client to it"""
+    socket_path = str(tmp_path / "broker.sock")
+    server = await Broker().start(socket_path)
+    clients = []
+
+    async def connect():
+        clients.append(await BrokerClient.connect(socket_path))
+        return clients[-1]
+
+    try:
+        yield connect
+    finally:
+        for client in clients:
+            client.close()
+        server.close()
+
+
+def test_publishes_reach_the_rooms_other_subscribers(tmp_path):
+    async def main():
+        async with running_broker(tmp_path) as connect:
+            alice, bob, carol = await connect(), await connect(), await connect()
+            for client in (alice, bob):
+                await client.subscribe("lobby")
+            await carol.subscribe("other")
+            await asyncio.sleep(0.05)
+
+            await alice.publish("lobby", 1, "alice", 1.5, "hi", user_id=7)
+            received = await asyncio.wait_for(bob.next_message(), 1)
+            nothing_for = []
+            for client in (alice, carol):  # not the sender, and not another room
+                try:
+                    await asyncio.wait_for(client.next_message(), 0.1)
+                except asyncio.TimeoutError:
+                    nothing_for.append(client)
+            return received, nothing_for == [alice, carol]
+
+    received, others_got_nothing = asyncio.run(main())
+    assert received == {"op": "message", "room": "lobby", "seq": 1, "author": "alice", "created_at": 1.5, "body": "hi", "user_id": 7}
+    assert others_got_nothing
+
+
+def test_unsubscribing_stops_delivery(tmp_path):
+    async def main():
+        async with running_broker(tmp_path) as connect:
+            alice, bob = await connect(), await connect()
+            await bob.subscribe("lobby")
+            await bob.unsubscribe("lobby")
+            await bob.subscribe("other")
+            await asyncio.sleep(0.05)
+            await alice.publish("lobby", 1, "alice", 1.0, "not for bob")
+            await alice.publish("other", 1, "alice", 1.0, "for bob")
+            return await asyncio.wait_for(bob.next_message(), 1)
+
+    assert asyncio.run(main())["body"] == "for bob"
+
+
+def test_lines_that_arent_requests_get_the_client_dropped(tmp_path):
+    async def main():
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        async with running_broker(tmp_path) as connect:
+            dropped = []
+            for line in (b"[]\n", b"1\n", b"not json\n"):
+                client = await connect()
+                client.writer.write(line)
+                dropped.append(await asyncio.wait_for(client.reader.read(), 1) == b"")  # the broker hangs up
+
+            alice, bob = await connect(), await connect()  # and carries on for everyone else
+            await bob.subscribe("lobby")
+            await asyncio.sleep(0.05)
+            await alice.publish("lobby", 1, "alice", 1.0, "still here")
+            return dropped, (await asyncio.wait_for(bob.next_message(), 1))["body"], list(errors)
+
+    assert asyncio.run(main()) == ([True, True, True], "still here", [])  # and nothing blew up on the way
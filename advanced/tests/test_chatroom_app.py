@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+import chatroom_app
+import utils
+from db_watcher import DatabaseWatcher
+from speech_bubble import BubbleRenderer
+
+
+@pytest.fixture
+def chat_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(chatroom_app, "renderer", BubbleRenderer())  # bubbles are cached by (room, seq), and every test has its own rooms
+    utils.configure_db(str(tmp_path / "chat.db"))
+    utils.ensure_schema()
+    for room in ("lobby", "other"):
+        utils.add_room_in_rooms_table(room)
+
+
+async def _joined(user, *rooms):
+    chat = chatroom_app.SharedChat(user, rooms[0], '')
+    chat.watcher = DatabaseWatcher(mode="poll")  # no broker - the checker has to poll, like without one
+    for room in rooms:
+        await chat.subscribe(room)
+    chat.current_room = rooms[0]
+    return chat
+
+
+def test_the_checker_never_shows_our_own_messages(chat_db):
+    async def main():
+        chat = await _joined("alice", "lobby")
+        shown = []
+        sending = True
+
+        async def checker():
+            while sending:
+                shown.append(await chat.fetch_new_content())
+                await asyncio.sleep(0)
+
+        task = asyncio.create_task(checker())
+        for n in range(100):
+            await chat.update_room_content_class_db(f"message {n}", "lobby")
+            await asyncio.sleep(0.001)
+        sending = False
+        await task
+        shown.append(await chat.fetch_new_content())
+        chat.watcher.close()
+        return shown
+
+    assert "alice:" not in "".join(asyncio.run(main()))
+
+
+def test_other_users_messages_are_shown_once(chat_db):
+    async def main():
+        chat = await _joined("alice", "lobby")
+        await chat.update_room_content_class_db("mine", "lobby")
+        utils.add_message_to_room("lobby", "bob", "hello")
+        first, again = await chat.fetch_new_content(), await chat.fetch_new_content()
+        chat.watcher.close()
+        return first, again
+
+    first, again = asyncio.run(main())
+    assert "bob: hello" in first and "mine" not in first
+    assert again == ''
+
+
+def test_more_carries_on_from_what_switch_showed(chat_db, monkeypatch):
+    async def main():
+        for n in range(1, 21):
+            utils.add_message_to_room("lobby", "bob", f"message {n}")
+        chat = chatroom_app.SharedChat("alice", "lobby", '', history_page_size=10)
+        chat.watcher = DatabaseWatcher(mode="poll")
+        await chat.subscribe("lobby")  # messages 11-20
+        await chat.subscribe("other")
+        chat.current_room = "other"
+        for n in range(21, 36):
+            utils.add_message_to_room("lobby", "bob", f"message {n}")
+        await chat.fetch_new_content()  # 'recent' now holds 26-35
+
+        shown = []
+
+        async def show(text, clear=False):
+            shown.append(text)
+
+        chat.show = show
+        monkeypatch.setattr(chatroom_app, "aprint", show)  # history is printed straight to the terminal
+        await chat.switch_room_command("lobby")
+        shown.clear()
+        await chat.show_older_messages()
+        chat.watcher.close()
+        return "\n".join(shown)
+
+    older = asyncio.run(main())
+    assert "message 25 " in older and "message 16 " in older
+    assert "message 15 " not in older and "message 26 " not in older
+
+
+def test_messages_in_the_other_rooms_wait_for_switch(chat_db, monkeypatch):
+    async def main():
+        chat = await _joined("alice", "lobby", "other")
+        shown = []
+
+        async def show(text, clear=False):
+            shown.append(text)
+
+        chat.show = show
+        monkeypatch.setattr(chatroom_app, "aprint", show)
+        utils.add_message_to_room("other", "bob", "first")
+        utils.add_message_to_room("other", "bob", "second")
+        utils.add_message_to_room("lobby", "carol", "here")
+        checked = await chat.fetch_new_content()
+        await chat.show_rooms()
+        rooms = shown[:]
+
+        shown.clear()
+        await chat.switch_room_command("other")
+        switched = "\n".join(shown)
+        shown.clear()
+        await chat.show_rooms()
+        await chat.leave_room_command("other")
+        chat.watcher.close()
+        return checked, rooms, switched, shown, chat.current_room
+
+    checked, rooms, switched, after, current_room = asyncio.run(main())
+    assert "carol: here" in checked and "first" not in checked
+    assert "/switch other" in checked  # one notice, however many messages
+    assert rooms == ["* lobby", "  other (2 unread)"]
+    assert "bob: first" in switched and "bob: second" in switched
+    assert after[:2] == ["  lobby", "* other"]
+    assert current_room == "lobby"  # leaving the room on screen takes us back to one we're still in
@@ -0,0 +1,59 @@
+import sqlite3
+
+import pytest
+
+import utils
+from lookup_cache import LookupCache
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "chat.db")
+    utils.configure_db(path)
+    utils.ensure_schema()
+    return path
+
+
+def test_misses_are_cached_until_we_write(db_path):
+    assert not utils.query_exists_short("lobby")
+    assert not utils.query_exists_short("lobby")
+    assert utils.lookup_cache.stats()["hits"] == 1
+
+    utils.add_room_in_rooms_table("lobby")
+    assert utils.query_exists_short("lobby")
+
+
+def test_other_processes_adding_users_and_rooms_are_noticed(db_path):
+    assert not utils.query_exists_long("alice") and not utils.query_exists_short("lobby")
+
+    with sqlite3.connect(db_path) as other_process:
+        other_process.execute("INSERT INTO administrative (users, passwords) VALUES ('alice', 'x')")
+        other_process.execute("INSERT INTO rooms (room_name) VALUES ('lobby')")
+    other_process.close()
+    assert utils.query_exists_long("alice") and utils.query_exists_short("lobby")
+
+
+def test_other_processes_sending_messages_keep_the_cache(db_path):
+    utils.add_room_in_rooms_table("lobby")
+    utils.query_exists_short("lobby")
+
+    with sqlite3.connect(db_path) as other_process:
+        other_process.execute("INSERT INTO messages (room_id, seq, author, created_at, body) VALUES (1, 1, 'bob', 0, 'hi')")
+    other_process.close()
+    invalidations = utils.lookup_cache.stats()["invalidations"]
+    assert utils.query_exists_short("lobby")
+    assert utils.lookup_cache.stats()["invalidations"] == invalidations
+
+
+def test_the_least_recently_used_entries_go_first(db_path):
+    cache = LookupCache(utils.pool, maxsize=2)
+    loads = []
+
+    def load(key):
+        loads.append(key)
+        return key
+
+    for key in ("a", "b", "a", "c", "a", "b"):
+        cache.get(key, lambda: load(key))
+    cache.close()
+    assert loads == ["a", "b", "c", "b"]  # "b" was the least recently used when "c" came in
@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+from outbound import OutboundQueue
+
+
+def test_get_batch_returns_a_lone_item_once_the_window_passes():
+    async def main():
+        queue = OutboundQueue(policy="drop_oldest")
+        queue.put("only")
+        batch = await asyncio.wait_for(queue.get_batch(window=0.01, max_delay=0.05), 1)
+        queue.put("next")  # and the queue still works afterwards
+        return batch, await asyncio.wait_for(queue.get_batch(window=0.01, max_delay=0.05), 1)
+
+    assert asyncio.run(main()) == (["only"], ["next"])
+
+
+def _drain(queue):
+    async def main():
+        items = []
+        while queue.depth:
+            items.append(await queue.get())
+        return items
+
+    return asyncio.run(main())
+
+
+def test_drop_oldest_keeps_the_newest_and_every_reply():
+    queue = OutboundQueue(maxsize=3, policy="drop_oldest")
+    queue.put(1)
+    queue.put("reply", droppable=False)
+    for item in range(2, 6):
+        assert queue.put(item)
+    assert _drain(queue) == ["reply", 3, 4, 5]
+    assert queue.dropped == 2
+
+
+def test_coalesce_swaps_the_backlog_for_one_marker():
+    queue = OutboundQueue(maxsize=3, policy="coalesce", marker=lambda skipped: f"{skipped} skipped")
+    for item in range(1, 9):
+        assert queue.put(item)
+    # 1-4 became the marker, then 5-8 overflowed again - the marker that's still queued covers them too
+    assert _drain(queue) == ["8 skipped"]
+    assert queue.resyncs == 1
+
+    queue.put(9)
+    assert _drain(queue) == [9]
+
+
+def test_disconnect_gives_up_on_the_consumer():
+    queue = OutboundQueue(maxsize=2, policy="disconnect")
+    assert queue.put(1) and queue.put(2)
+    assert not queue.put(3)
+    assert not queue.put("reply", droppable=False)
+    with pytest.raises(ConnectionError):
+        asyncio.run(queue.get())
@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+import passwords
+import utils
+from async_db import AsyncDB
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(passwords, "SCRYPT_N", 2 ** 4)  # the format is what we're testing, not the cost
+    monkeypatch.setattr(passwords, "PBKDF2_ITERATIONS", 1000)
+    utils.configure_db(str(tmp_path / "chat.db"))
+    utils.ensure_schema()
+    db = AsyncDB()
+    yield db
+    db.close()
+    passwords.hasher.close()
+
+
+def test_unknown_users_dont_match(db):
+    assert asyncio.run(passwords.check_password(db, "nobody", "hunter2")) is False
+
+
+def test_plain_text_passwords_are_rehashed_on_login(db):
+    utils.create_user_and_password("alice", "hunter2")  # an account from before we hashed passwords
+
+    assert asyncio.run(passwords.check_password(db, "alice", "wrong")) is False
+    assert utils.get_password_from_username("alice") == "hunter2"
+
+    assert asyncio.run(passwords.check_password(db, "alice", "hunter2")) is True
+    stored = utils.get_password_from_username("alice")
+    assert passwords.parse_hash(stored) is not None
+    assert asyncio.run(passwords.check_password(db, "alice", "hunter2")) is True
@@ -0,0 +1,22 @@
+import asyncio
+
+import protocol
+
+
+def _read(data):
+    async def main():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await protocol.read_frame(reader)
+
+    return asyncio.run(main())
+
+
+def test_sent_carries_the_stored_created_at():
+    assert _read(protocol.encode_sent(7, 42, 1700000000.25)) == (protocol.SENT, 7, 42, 1700000000.25)
+
+
+def test_message_round_trip():
+    frame = protocol.encode_message(3, 42, 9, 1700000000.25, "hi ✨")
+    assert _read(frame) == (protocol.MESSAGE, 3, 42, 9, 1700000000.25, "hi ✨")
@@ -0,0 +1,83 @@
+import asyncio
+import random
+import sqlite3
+
+import passwords
+import schema
+import utils
+from async_db import AsyncDB
+
+
+def _random_message(rng):
+    words = ["a", "ok", "chat", "tomorrow", "message", "|", "|pipe", "a|b", "x" * 44, "y" * 60, "https://example.com/" + "z" * 80]
+    return " ".join(rng.choice(words) for _ in range(rng.randint(0, 40)))
+
+
+def test_bubble_text_gives_back_what_was_typed():
+    rng = random.Random(0)
+    unwrapped = 0
+    for _ in range(20_000):
+        author = rng.choice(["alice", "bob the builder"])
+        text = _random_message(rng)
+        body = schema.legacy_bubble(author, text)
+        got = schema.bubble_text(body, author)
+        # either the words the user typed (wrapping never kept their spacing), or we leave the bubble alone
+        assert got is None or got == " ".join(text.split())
+        if got is None:
+            assert "|" in text
+        unwrapped += got is not None
+    assert unwrapped > 10_000
+
+
+def test_bubble_text_leaves_typed_pipes_alone():
+    body = schema.legacy_bubble("alice", "|pipe hi")
+    assert schema.bubble_text(body, "alice") is None
+    assert schema.bubble_text(schema.legacy_bubble("alice", "hello there"), "alice") == "hello there"
+
+
+def test_bubble_text_only_takes_its_authors_bubbles():
+    assert schema.bubble_text(schema.legacy_bubble("alice", "hi"), "bob") is None
+    assert schema.bubble_text("just some text", "alice") is None
+    assert schema.bubble_text(schema.legacy_bubble("alice", "hi"), None) is None
+
+
+def _baseline_database(path):
+    """A database as the first version of the chat left it - untyped tables, and each room's bubbles in one blob"""
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE administrative (users, passwords)")
+        conn.execute("CREATE TABLE rooms (room_name, room_content, room_update)")
+        conn.executemany("INSERT INTO administrative VALUES (?, ?)", [("alice", "pw"), ("bob", "pw2"), ("alice", "someone else's"), ("carol", None)])
+        lobby = schema.legacy_bubble("alice", "hi there") + schema.legacy_bubble("bob", "hello alice")
+        pipes = schema.legacy_bubble("alice", "|pipe hi")  # one we can't be sure how to take apart
+        conn.executemany("INSERT INTO rooms VALUES (?, ?, ?)", [("lobby", lobby, "0"), ("notes", "not a bubble", "0"), ("pipes", pipes, "0")])
+    conn.close()
+
+
+def _logs_in(user, password):
+    db = AsyncDB()
+    try:
+        return asyncio.run(passwords.check_password(db, user, password))
+    finally:
+        db.close()
+        passwords.hasher.close()
+
+
+def test_the_original_database_upgrades_in_one_go(tmp_path):
+    path = str(tmp_path / "chat.db")
+    _baseline_database(path)
+    utils.configure_db(path)
+    utils.ensure_schema()
+
+    assert [(author, body) for _seq, author, _created_at, body in utils.get_room_messages("lobby")] == [("alice", "hi there"), ("bob", "hello alice")]
+    assert [(author, body) for _seq, author, _created_at, body in utils.get_room_messages("notes")] == [(None, "not a bubble")]
+    assert [(author, body) for _seq, author, _created_at, body in utils.get_room_messages("pipes")] == [(None, schema.legacy_bubble("alice", "|pipe hi"))]
+    assert utils.get_password_from_username("alice") == "pw"  # the first account with a name keeps it
+    assert utils.query_exists_long("carol") and not _logs_in("carol", "")  # never had a password, so nobody gets in
+    assert utils.add_message_to_room("lobby", "bob", "and after")[0] == 3
+
+    utils.ensure_schema()  # the second time there's nothing to do
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("PRAGMA user_version").fetchone() == (schema.SCHEMA_VERSION,)
+        assert conn.execute("SELECT name FROM sqlite_master WHERE name LIKE 'legacy%'").fetchall() == []
+    conn.close()
+    assert len(utils.get_room_messages("lobby")) == 3
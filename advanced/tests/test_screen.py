@@ -0,0 +1,124 @@
+import asyncio
+import contextlib
+import fcntl
+import os
+import pty
+import struct
+import termios
+
+import pytest
+
+import chatroom_app
+import utils
+from db_watcher import DatabaseWatcher
+from screen import ChatScreen
+from speech_bubble import BubbleRenderer
+
+
+@contextlib.asynccontextmanager
+async def terminal(rows=24, columns=80):
+    """
+    A ChatScreen on a pseudo-terminal of its own. Yields it, a function that returns what
+    it's been sent so far, and one that types keys at it.
+    """
+    master, slave = pty.openpty()
+    fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack("HHHH", rows, columns, 0, 0))
+    os.set_blocking(master, False)
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    read_transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(slave, "rb", 0, closefd=False))
+    write_transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, os.fdopen(slave, "wb", 0, closefd=False))
+    writer = asyncio.StreamWriter(write_transport, protocol, reader, loop)
+    received = bytearray()
+    loop.add_reader(master, lambda: received.extend(os.read(master, 65536)))  # a terminal that keeps up
+
+    async def output():
+        await writer.drain()
+        await asyncio.sleep(0.05)
+        return received.decode(errors="replace")
+
+    async def type_keys(keys):
+        os.write(master, keys.encode())
+        await asyncio.sleep(0.05)
+
+    screen = ChatScreen(reader, writer, slave, slave, frame_interval=0.01)
+    try:
+        yield screen, output, type_keys
+    finally:
+        screen.close()
+        await output()
+        loop.remove_reader(master)
+        read_transport.close()
+        write_transport.close()
+        os.close(master)
+        os.close(slave)
+
+
+@pytest.fixture
+def chat_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(chatroom_app, "renderer", BubbleRenderer())
+    utils.configure_db(str(tmp_path / "chat.db"))
+    utils.ensure_schema()
+    utils.add_room_in_rooms_table("lobby")
+
+
+def test_history_on_the_screen_reaches_the_terminal_in_full(chat_db, monkeypatch):
+    async def main():
+        for n in range(300):
+            utils.add_message_to_room("lobby", "bob", f"message {n}")
+        async with terminal() as (screen, output, _type_keys):
+            writes = []
+
+            async def aprint(text):  # the terminal's ours: print to it
+                writes.append(text)
+                screen.writer.write(text.encode() + b"\n")
+                await screen.writer.drain()
+
+            monkeypatch.setattr(chatroom_app, "aprint", aprint)
+            chat = chatroom_app.SharedChat("alice", "lobby", '')
+            chat.watcher = DatabaseWatcher(mode="poll")
+            chat.screen = screen
+            await chat.subscribe("lobby")
+            await chat.show_whole_history()
+            await asyncio.sleep(0.05)
+            chat.watcher.close()
+            return await output(), screen.lines
+
+    printed, lines = asyncio.run(main())
+    for n in range(300):
+        assert f"message {n} " in printed
+    assert any("message 299 " in line for line in lines)  # and the screen still has the end of it once it's back
+
+
+def test_messages_go_above_the_draft_and_leave_it_alone():
+    async def main():
+        async with terminal(rows=6, columns=20) as (screen, output, type_keys):
+            line = asyncio.create_task(screen.read_line("> "))
+            await type_keys("half a dra")
+            for n in range(3):
+                screen.write(f"message {n}")
+            screen.write("a line too long for the screen")
+            await asyncio.sleep(0.05)
+            layout = (list(screen._drawn), screen._drawn_input)
+            await type_keys("ft\n")
+            return layout, await line
+
+    (rows, input_row), entered = asyncio.run(main())
+    assert rows == ["message 0", "message 1", "message 2", "a line too long for ", "the screen"]
+    assert input_row == "> half a dra"
+    assert entered == "half a draft"
+
+
+def test_a_new_message_only_draws_its_own_rows():
+    async def main():
+        async with terminal(rows=10, columns=40) as (screen, output, _type_keys):
+            for n in range(20):
+                screen.write(f"message {n}")
+            await asyncio.sleep(0.05)
+            before = screen.rows_drawn
+            screen.write("one more")
+            await asyncio.sleep(0.05)
+            return screen.rows_drawn - before, screen._drawn[-1]
+
+    drawn, last_row = asyncio.run(main())
+    assert drawn == 1 and last_row == "one more"  # the rest scrolled up on the terminal's own
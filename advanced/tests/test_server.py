@@ -0,0 +1,171 @@
+import asyncio
+import contextlib
+
+import pytest
+
+import chatroom_app
+import passwords
+import protocol
+import server
+import utils
+from client import RemoteSharedChat, ServerConnection, ServerError
+from speech_bubble import BubbleRenderer
+
+
+@pytest.fixture(autouse=True)
+def chat_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(passwords, "SCRYPT_N", 2 ** 4)  # logging in is what we're testing, not the cost
+    monkeypatch.setattr(chatroom_app, "renderer", BubbleRenderer())
+    utils.configure_db(str(tmp_path / "chat.db"))
+    utils.ensure_schema()
+    for room in ("lobby", "other"):
+        utils.add_room_in_rooms_table(room)
+    yield
+    passwords.hasher.close()
+
+
+@contextlib.asynccontextmanager
+async def running_server():
+    """A ChatServer on a free port of our own, in this event loop"""
+    chat_server = server.ChatServer()
+    listener = await asyncio.start_server(chat_server.handle_client, "127.0.0.1", 0)
+    try:
+        yield listener.sockets[0].getsockname()[1]
+    finally:
+        listener.close()
+        await chat_server.disconnect_everyone()
+        chat_server.db.close()
+
+
+async def _account(port, user):
+    connection = await ServerConnection.connect(port=port)
+    assert await connection.create_account(user, "pw")
+    return connection
+
+
+def test_logging_in():
+    async def main():
+        async with running_server() as port:
+            alice = await _account(port, "alice")
+            taken = await (await ServerConnection.connect(port=port)).create_account("alice", "other")
+            wrong = await (await ServerConnection.connect(port=port)).log_in("alice", "nope")
+            stranger = await ServerConnection.connect(port=port)
+            try:
+                await stranger.subscribe("lobby", 5)
+                refused = False
+            except ServerError:
+                refused = True
+            right = await (await ServerConnection.connect(port=port)).log_in("alice", "pw")
+            alice.close()
+            return taken, wrong, refused, right
+
+    assert asyncio.run(main()) == (False, False, True, True)
+
+
+def test_messages_are_pushed_to_the_rest_of_the_room():
+    async def main():
+        async with running_server() as port:
+            alice, bob = await _account(port, "alice"), await _account(port, "bob")
+            await alice.subscribe("lobby", 5)
+            await bob.subscribe("lobby", 5)
+            seq, created_at = await alice.send_message("lobby", "hi bob")
+            pushed = await asyncio.wait_for(bob.next_message(), 1)
+            try:
+                await asyncio.wait_for(alice.next_message(), 0.1)
+                echoed = True
+            except asyncio.TimeoutError:
+                echoed = False
+            alice.close()
+            bob.close()
+            return seq, created_at, pushed, echoed
+
+    seq, created_at, pushed, echoed = asyncio.run(main())
+    assert (pushed["room"], pushed["seq"], pushed["author"], pushed["created_at"], pushed["body"]) == ("lobby", seq, "alice", created_at, "hi bob")
+    assert not echoed  # the sender already has its own message
+
+
+def test_joining_a_room_doesnt_swallow_pushes_for_the_others():
+    async def main():
+        async with running_server() as port:
+            alice, bob = await _account(port, "alice"), await _account(port, "bob")
+            chat = RemoteSharedChat(alice, "alice", "lobby")
+            await chat.subscribe("lobby")
+            await bob.subscribe("lobby", 5)
+            await bob.send_message("lobby", "hello")
+            await asyncio.sleep(0.1)  # pushed to alice, but the chat hasn't taken it yet
+
+            await chat.subscribe("other")
+            pushed = await asyncio.wait_for(alice.next_message(), 1)
+            shown = await chat.handle_pushed_message(pushed)
+            alice.close()
+            bob.close()
+            return shown
+
+    assert "bob: hello" in asyncio.run(main())
+
+
+def test_clients_resume_with_a_token_instead_of_the_password(monkeypatch):
+    async def main():
+        async with running_server() as port:
+            alice = await _account(port, "alice")
+            await alice.subscribe("lobby", 5)
+            assert "pw" not in alice.credentials
+
+            async def no_hashing(*args):
+                raise AssertionError("resuming hashed a password")
+
+            monkeypatch.setattr(passwords.hasher, "verify", no_hashing)
+            resumed = await alice.resume({"lobby": 0}, 5)
+
+            mallory = await ServerConnection.connect(port=port)
+            mallory.credentials = ("alice", "a guess")
+            refused = await mallory.resume({"lobby": 0}, 5)
+            alice.close()
+            mallory.close()
+            return resumed, refused
+
+    resumed, refused = asyncio.run(main())
+    assert resumed["lobby"]["complete"] and refused is None
+
+
+def test_resuming_catches_up_on_what_we_missed():
+    async def main():
+        async with running_server() as port:
+            alice, bob = await _account(port, "alice"), await _account(port, "bob")
+            for room in ("lobby", "other"):
+                await alice.subscribe(room, 5)
+                await bob.subscribe(room, 5)
+            await bob.send_message("lobby", "before")
+            for n in range(3):
+                await bob.send_message("lobby", f"missed {n}")
+            for n in range(12):
+                await bob.send_message("other", f"lots {n}")
+            resumed = await alice.resume({"lobby": 1, "other": 0}, 5)
+            await bob.send_message("other", "after")
+            pushed = await asyncio.wait_for(alice.next_message(), 1)
+            alice.close()
+            bob.close()
+            return resumed, pushed
+
+    resumed, pushed = asyncio.run(main())
+    lobby, other = resumed["lobby"], resumed["other"]
+    assert lobby["complete"] and [message[3] for message in lobby["messages"]] == ["missed 0", "missed 1", "missed 2"]
+    assert not other["complete"] and [message[3] for message in other["messages"]] == [f"lots {n}" for n in range(7, 12)]
+    assert pushed["body"] == "after"  # and we're subscribed again
+
+
+def test_requests_that_arent_objects_are_refused():
+    async def main():
+        async with running_server() as port:
+            connection = await ServerConnection.connect(port=port)
+            refused = []
+            for request in ([], 1, "log_in"):
+                try:
+                    await connection._request(protocol.encode_request, request)
+                except ServerError:
+                    refused.append(request)
+            still_works = await connection.create_account("alice", "pw")
+            connection.close()
+            return refused, still_works
+
+    assert asyncio.run(main()) == ([[], 1, "log_in"], True)
@@ -0,0 +1,52 @@
+import sqlite3
+
+import pytest
+
+import utils
+
+ROOMS = [f"room{n}" for n in range(12)]
+
+
+@pytest.fixture
+def sharded(tmp_path):
+    utils.configure_db(str(tmp_path / "chat.db"), shards=3)
+    utils.ensure_schema()
+    for room in ROOMS:
+        utils.add_room_in_rooms_table(room)
+    return tmp_path
+
+
+def _rooms_in(path):
+    with sqlite3.connect(path) as conn:
+        rooms = {room_id for (room_id,) in conn.execute("SELECT DISTINCT room_id FROM messages")}
+    conn.close()
+    return rooms
+
+
+def test_each_rooms_messages_live_in_its_own_shard(sharded):
+    for room in ROOMS:
+        utils.add_message_to_room(room, "alice", f"hi {room}")
+
+    for n in range(3):
+        expected = {utils.get_room_id(room) for room in ROOMS if utils._shard_number(room) == n}
+        assert _rooms_in(sharded / f"chat.shard{n}.db") == expected
+    assert {utils._shard_number(room) for room in ROOMS} == {0, 1, 2}  # the rooms really are spread out
+    with sqlite3.connect(sharded / "chat.db") as catalog:  # which only has users and rooms
+        assert catalog.execute("SELECT 1 FROM sqlite_master WHERE name='messages'").fetchone() is None
+    catalog.close()
+
+
+def test_reads_across_shards_find_every_room(sharded):
+    for room in ROOMS:
+        utils.add_message_to_room(room, "alice", f"hi {room}")
+        utils.add_message_to_room(room, "bob", f"bye {room}")
+
+    new = utils.get_new_messages_in_rooms({room: 1 for room in ROOMS})
+    assert {room: [body for _seq, _author, _created_at, body in messages] for room, messages in new.items()} == {room: [f"bye {room}"] for room in ROOMS}
+    assert [body for _seq, _author, _created_at, body in utils.get_room_messages("room5")] == ["hi room5", "bye room5"]
+
+
+def test_the_shard_count_cant_change(sharded):
+    utils.configure_db(str(sharded / "chat.db"), shards=2)
+    with pytest.raises(RuntimeError):
+        utils.ensure_schema()
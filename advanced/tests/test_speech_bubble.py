@@ -0,0 +1,14 @@
+from speech_bubble import BubbleRenderer
+
+
+def test_messages_are_drawn_whatever_they_start_with():
+    renderer = BubbleRenderer()
+    dashes = "-" * 60 + " a divider"
+    assert "| alice: " in renderer.render(("lobby", 1), "alice", dashes, width=50)
+    assert "| alice: hi" in renderer.render(("lobby", 2), "alice", "hi", width=50)
+
+
+def test_messages_without_an_author_are_shown_as_stored():
+    renderer = BubbleRenderer()
+    stored = "-" * 50 + "\n| alice: |pipe hi |\n" + "-" * 50
+    assert renderer.render(("lobby", 1), None, stored, width=30) == stored
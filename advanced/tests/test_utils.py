@@ -0,0 +1,49 @@
+import sqlite3
+
+import utils
+from archive import archive_old_messages
+
+
+def test_sends_return_the_created_at_they_stored(tmp_path):
+    utils.configure_db(str(tmp_path / "chat.db"))
+    utils.ensure_schema()
+    utils.add_room_in_rooms_table("r")
+
+    first = utils.add_message_to_room("r", "alice", "hi")
+    second = utils.submit_message_to_room("r", "bob", "hello").result()
+
+    stored = utils.get_room_messages("r")
+    assert [(seq, created_at) for seq, _author, created_at, _body in stored] == [first, second]
+
+
+def test_history_chunks_dont_skip_rows_archived_while_reading(tmp_path, monkeypatch):
+    utils.configure_db(str(tmp_path / "chat.db"))
+    utils.ensure_schema()
+    utils.add_room_in_rooms_table("r")
+    for n in range(10):
+        utils.add_message_to_room("r", "alice", f"message {n}")
+
+    real_messages_after = utils.archive.messages_after
+    calls = []
+
+    def archiver_runs_in_between(room_id, after_seq, limit):
+        rows = real_messages_after(room_id, after_seq, limit)
+        if not calls:  # right after our first look at the archive, everything is moved into it
+            archive_old_messages(utils.shard_pool_for_room("r"), utils.archive, max_age_seconds=-60)
+        calls.append(after_seq)
+        return rows
+
+    monkeypatch.setattr(utils.archive, "messages_after", archiver_runs_in_between)
+    chunk = utils.get_room_history_chunk("r", 0, 100)
+    assert [body for _seq, _author, _created_at, body in chunk] == [f"message {n}" for n in range(10)]
+
+
+def test_password_changes_by_other_processes_are_seen(tmp_path):
+    utils.configure_db(str(tmp_path / "chat.db"))
+    utils.ensure_schema()
+    utils.create_user_and_password("alice", "old hash")
+    assert utils.get_password_from_username("alice") == "old hash"
+
+    with sqlite3.connect(tmp_path / "chat.db") as other_process:  # e.g. another server worker rehashing on login
+        other_process.execute("UPDATE administrative SET passwords='new hash' WHERE users='alice'")
+    assert utils.get_password_from_username("alice") == "new hash"
@@ -1,89 +1,400 @@
-import sqlite3
+import os
+import time
+import zlib
+
+from archive import MessageArchive
+from connection_pool import ConnectionPool
+from group_commit import GroupCommitWriter
+from lookup_cache import LookupCache
+import schema
+
+
+# The database is split in two kinds of files. The catalog ('pool') holds users and the room
+# directory. Messages live in one or more shards ('shard_pools'): with sharding off (the default)
+# the catalog is the only shard, otherwise every room is hashed onto one of N separate files,
+# so writers in different rooms don't queue up behind the same database lock.
+#
+# Everything is set up by 'configure_db' at the bottom of this module, from CHATROOM_DB_PATH,
+# CHATROOM_ARCHIVE_DIR and CHATROOM_SHARDS (or call it again to use a different database).
+pool = None
+shard_pools = []
+writers = []  # one group-commit writer per shard - see 'submit_message_to_room'
+archive = None  # old messages are moved out of the database into here (see archive.py) - reads fall back to it
+lookup_cache = None  # answers "does this user/room exist?" and id lookups without a query most of the time
+
+
+def configure_db(db_path, archive_dir=None, shards=0, **pool_options):
+    """
+    Points every helper in this module at a different database.
+
+    With 'shards' > 0 messages go into 'shards' extra files next to 'db_path'
+    (chatroom_app.shard0.db, chatroom_app.shard1.db, ...). A database's shard count is
+    recorded when it's created and can't be changed afterwards (see 'ensure_schema').
+    """
+    global pool, shard_pools, writers, archive, lookup_cache
+    for old_pool in {id(p): p for p in [pool, *shard_pools] if p is not None}.values():
+        old_pool.close()
+    if archive is not None:
+        archive.close()
+    if lookup_cache is not None:
+        lookup_cache.close()
+
+    base, extension = os.path.splitext(db_path)
+    pool = ConnectionPool(db_path, **pool_options)
+    if shards:
+        shard_pools = [ConnectionPool(f"{base}.shard{n}{extension}", **pool_options) for n in range(shards)]
+    else:
+        shard_pools = [pool]
+    writers = [GroupCommitWriter(shard_pool, _insert_message) for shard_pool in shard_pools]
+    archive = MessageArchive(archive_dir or base + "_archive")
+    lookup_cache = LookupCache(pool)
+    return pool
+
+
+def ensure_schema():
+    """Creates or upgrades the catalog and every shard, and checks they were created with the same shard count"""
+    sharded = shard_pools != [pool]
+    schema.migrate(pool, with_messages=not sharded)
+    if sharded:
+        for shard_pool in shard_pools:
+            schema.migrate_shard(shard_pool)
+
+    with pool.transaction() as conn:
+        conn.execute("INSERT OR IGNORE INTO settings (name, value) VALUES ('shards', ?)", (str(len(shard_pools) if sharded else 0),))
+        (recorded,) = conn.execute("SELECT value FROM settings WHERE name='shards'").fetchone()
+    if int(recorded) != (len(shard_pools) if sharded else 0):
+        raise RuntimeError(f"{pool.db_path} was created with {recorded} shards, not {len(shard_pools) if sharded else 0} - set CHATROOM_SHARDS={recorded}")
+
+
+def _shard_number(room):
+    """Which shard a room's messages live in (crc32 rather than hash(), which changes between runs)"""
+    return zlib.crc32(room.encode("utf-8")) % len(shard_pools)
+
+
+def shard_pool_for_room(room):
+    return shard_pools[_shard_number(room)]
 
 
 def query_exists_short(response):
-    """Essentially checking whether a given room name exists"""
-    conn = sqlite3.connect("chatroom_app.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT room_name FROM rooms WHERE room_name=?", (response,))
-    if cursor.fetchall():
-        conn.close()
-        return True
+    """Essentially checking whether a given room name exists (cached - see 'lookup_cache')"""
+    def load():
+        with pool.connection() as conn:
+            return conn.execute("SELECT 1 FROM rooms WHERE room_name=?", (response,)).fetchone() is not None
 
-    conn.close()
-    return False
+    return lookup_cache.get(("room", response), load)
 
 
 def query_exists_long(response):
-    """Checking whether a given username exists"""
+    """Checking whether a given username exists (cached - see 'lookup_cache')"""
     if response is None:
         return False
 
-    conn = sqlite3.connect("chatroom_app.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM administrative WHERE users=?", (response,))
-    if cursor.fetchall():
-        conn.close()
-        return True
-    else:
-        conn.close()
-        return False
+    def load():
+        with pool.connection() as conn:
+            return conn.execute("SELECT 1 FROM administrative WHERE users=?", (response,)).fetchone() is not None
+
+    return lookup_cache.get(("user", response), load)
 
 
 def get_password_from_username(user):
     """
-    Given a username, we query the database and retrieve the user's password.
-    We use this to ensure that the user-supplied password matches the password we previously stored.
-    """
-    conn = sqlite3.connect("chatroom_app.db")
-    cursor = conn.cursor()
-    print(f"user == {user}")
-    print(f"type of user == {type(user)}")
+    Given a username, we query the database and retrieve what we stored for the user's password -
+    a hash, or the password itself for accounts from before we hashed them (see passwords.py).
+    None if there's no such user.
 
-    cursor.execute("SELECT passwords FROM administrative WHERE users=?", (user,))
-    counter = 0
-    for password in cursor.fetchall():
-        counter += 1
-        assert(counter != 2)  # this and the assert statement below ensure there is only one password in the cursor.fetchall() list
-        return password[0]
-    
-    assert(counter != 0)
+    Not cached: passwords change in place (rehashing on login), which 'lookup_cache' can't see
+    other processes do - and a login spends far longer hashing than on this query.
+    """
+    with pool.connection() as conn:
+        row = conn.execute("SELECT passwords FROM administrative WHERE users=?", (user,)).fetchone()
+    return row[0] if row is not None else None  # usernames are unique, so there's one password if the user exists
 
 
 def create_user_and_password(username, password):
     """
-    adds username and password to users and passwords columns in administrative table
+    adds username and password to users and passwords columns in administrative table -
+    'password' is what we store, so pass a hash ('passwords.create_account' does)
+
+    Usernames are unique - raises sqlite3.IntegrityError if the name is already taken.
+    """
+    user_id = None
+    try:
+        with pool.transaction() as conn:
+            user_id = conn.execute("INSERT INTO administrative (users, passwords) VALUES (?, ?)", (username, password)).lastrowid
+    finally:
+        lookup_cache.invalidate(("user", username), ("user_id", username), ("user_name", user_id))
+
+
+def replace_password(user, old, new):
+    """
+    Stores 'new' (a hash) for the user's password, if what's stored is still 'old' - so of
+    two logins rehashing the same account at once, only one write wins, and neither clobbers a changed password.
     """
-    conn = sqlite3.connect("chatroom_app.db")
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO administrative (users, passwords) VALUES (?, ?)", (username, password))
-    conn.commit()
-    conn.close()
+    with pool.transaction() as conn:
+        conn.execute("UPDATE administrative SET passwords=? WHERE users=? AND passwords=?", (new, user, old))
+
+
+def add_resume_token(user_id, token_hash, created_at, expired_before):
+    """Stores the hash of a resume token handed to 'user_id' - and forgets tokens created before 'expired_before' while we're here"""
+    with pool.transaction() as conn:
+        conn.execute("DELETE FROM resume_tokens WHERE created_at<?", (expired_before,))
+        conn.execute("INSERT INTO resume_tokens (token_hash, user_id, created_at) VALUES (?, ?, ?)", (token_hash, user_id, created_at))
+
+
+def get_resume_token_user_id(token_hash, expired_before):
+    """The id of the user a resume token was handed to - None if there's no such token, or it was created before 'expired_before'"""
+    with pool.connection() as conn:
+        row = conn.execute(
+            "SELECT user_id FROM resume_tokens WHERE token_hash=? AND created_at>=?", (token_hash, expired_before,)
+        ).fetchone()
+    return row[0] if row is not None else None
+
+
+def get_user_id(user):
+    """The user's id in the catalog (None if there's no such user) - cached like 'get_room_id'"""
+    def load():
+        with pool.connection() as conn:
+            row = conn.execute("SELECT id FROM administrative WHERE users=?", (user,)).fetchone()
+        return row[0] if row else None
+
+    return lookup_cache.get(("user_id", user), load)
+
+
+def get_user_names(user_ids):
+    """Returns {user id: username} for the given ids (ids nobody has are left out)"""
+    def load(user_id):
+        with pool.connection() as conn:
+            row = conn.execute("SELECT users FROM administrative WHERE id=?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    names = {user_id: lookup_cache.get(("user_name", user_id), lambda: load(user_id)) for user_id in user_ids}
+    return {user_id: name for user_id, name in names.items() if name is not None}
 
 
 def get_room_content_from_db(room):
-    """Given a room name, we query the database and retrieve the room's contents"""
-    conn = sqlite3.connect("chatroom_app.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT room_content FROM rooms WHERE room_name=?", (room,))  # ensure you don't fuck oup the database mwehn you change room_content
-    counter = 0
-    for room_content in cursor.fetchall():
-        conn.close()
-        counter += 1
-        assert(counter != 2)  # if this fails, does that fetchall() returned multiple room content values?
-        conn.close()
-        return room_content[0]
-    
-    conn.close()  # we should never reach here
-    assert(counter != 0)  # make sure you don't pass the room_content variable again lol
+    """
+    Given a room name, we query the database and retrieve the room's messages as one string.
+
+    Prefer 'iter_room_messages' for anything new - this is only kept for older callers.
+    """
+    return ''.join(body for chunk in iter_room_messages(room) for _seq, _author, _created_at, body in chunk)
+
+
+def get_room_id(room):
+    """The room's id in the catalog (None if there's no such room) - rooms never change ids, so this is cached"""
+    def load():
+        with pool.connection() as conn:
+            row = conn.execute("SELECT id FROM rooms WHERE room_name=?", (room,)).fetchone()
+        return row[0] if row else None
+
+    return lookup_cache.get(("room_id", room), load)
+
+
+def _require_room_id(room):
+    room_id = get_room_id(room)
+    if room_id is None:
+        raise ValueError(f"There is no room called {room!r}")
+    return room_id
+
+
+def get_room_messages(room):
+    """
+    Given a room name, we return the room's messages as a list of
+    (seq, author, created_at, body) rows, oldest first - archived ones included.
+
+    This holds the whole history at once - 'iter_room_messages' reads it a chunk at a time.
+    """
+    return [message for chunk in iter_room_messages(room) for message in chunk]
+
+
+def get_room_history_chunk(room, after_seq, limit):
+    """
+    Returns up to 'limit' of the room's messages after 'after_seq', oldest first - archived ones
+    included. Each call is a few archive blocks or one range scan on the (room_id, seq) primary key.
+    """
+    room_id = get_room_id(room)
+    if room_id is None:
+        return []
+    rows = archive.messages_after(room_id, after_seq, limit)
+    if len(rows) < limit:
+        start = rows[-1][0] if rows else after_seq
+        with shard_pool_for_room(room).connection() as conn:
+            live = conn.execute(
+                "SELECT seq, author, created_at, body FROM messages WHERE room_id=? AND seq>? ORDER BY seq LIMIT ?",
+                (room_id, start, limit - len(rows),),
+            ).fetchall()
+        # the archiver may have moved the next rows out of the table between our two reads - it
+        # writes them to the archive before deleting them, so if they're gone they're in there now
+        moved = archive.messages_after(room_id, start, limit - len(rows))
+        if moved:
+            live = moved + [row for row in live if row[0] > moved[-1][0]]
+        rows += live[:limit - len(rows)]
+    return rows
+
+
+def iter_room_messages(room, chunk_size=1000):
+    """
+    Yields the room's whole history, oldest first, as lists of at most 'chunk_size' rows -
+    however big the room is, we only ever hold one chunk (and a pooled connection only while reading it).
+    """
+    after_seq = 0
+    while chunk := get_room_history_chunk(room, after_seq, chunk_size):
+        yield chunk
+        after_seq = chunk[-1][0]
+
+
+def get_room_messages_after(room, after_seq):
+    """
+    Returns the room's messages with a sequence number greater than 'after_seq', oldest first.
+
+    This is a single range scan on the (room_id, seq) primary key, so its cost depends
+    on how many messages are new, not on how big the room's history is.
+    """
+    room_id = get_room_id(room)
+    with shard_pool_for_room(room).connection() as conn:
+        return conn.execute(
+            "SELECT seq, author, created_at, body FROM messages WHERE room_id=? AND seq>? ORDER BY seq",
+            (room_id, after_seq,),
+        ).fetchall()
+
+
+def get_new_messages_in_rooms(cursors):
+    """
+    Given {room name: after_seq}, returns {room name: [(seq, author, created_at, body), ...]}
+    with each room's messages after its own cursor, oldest first.
+
+    However many rooms there are, this is one query per shard: we join the cursors (as a
+    VALUES list) against the messages table, so each room still gets its own range scan on
+    the (room_id, seq) primary key.
+    """
+    new_messages = {room: [] for room in cursors}
+    by_shard = {}
+    for room, after_seq in cursors.items():
+        room_id = get_room_id(room)
+        if room_id is not None:
+            by_shard.setdefault(_shard_number(room), {})[room_id] = (room, after_seq)
+
+    for shard, rooms_by_id in by_shard.items():
+        values = ", ".join("(?, ?)" for _ in rooms_by_id)
+        parameters = [value for room_id, (_room, after_seq) in rooms_by_id.items() for value in (room_id, after_seq)]
+        with shard_pools[shard].connection() as conn:
+            # CROSS JOIN makes SQLite loop over the cursors and look each room up in 'messages', not the other way round
+            rows = conn.execute(
+                f"""WITH cursors (room_id, after_seq) AS (VALUES {values})
+                    SELECT messages.room_id, seq, author, created_at, body FROM cursors CROSS JOIN messages
+                    ON messages.room_id=cursors.room_id AND seq>cursors.after_seq ORDER BY messages.room_id, seq""",
+                parameters,
+            ).fetchall()
+        for room_id, seq, author, created_at, body in rows:
+            new_messages[rooms_by_id[room_id][0]].append((seq, author, created_at, body))
+
+    return new_messages
+
+
+def get_recent_room_messages(room, limit):
+    """
+    Returns the room's 'limit' most recent messages, oldest first.
+
+    Walks the (room_id, seq) primary key backwards from the newest message, so it only
+    reads the rows it returns however long the room's history is.
+    """
+    return get_room_messages_before(room, None, limit)
+
+
+def get_room_messages_since(room, after_seq, limit):
+    """
+    For catching up after a disconnect: returns (messages, complete).
+
+    If the room has at most 'limit' messages after 'after_seq', 'messages' is all of them
+    and 'complete' is True. Otherwise we don't read the whole gap - 'messages' is just
+    the room's latest 'limit' messages, and 'complete' is False.
+    """
+    rows = get_recent_room_messages(room, limit)
+    complete = len(rows) < limit or (rows and rows[0][0] <= after_seq + 1)
+    return [row for row in rows if row[0] > after_seq], bool(complete)
+
+
+def get_room_messages_before(room, before_seq, limit):
+    """
+    Returns up to 'limit' messages sent just before 'before_seq' (or the newest ones, if
+    'before_seq' is None), oldest first. This is how we scroll back.
+
+    When the database runs out of messages we carry on into the archive.
+    """
+    room_id = get_room_id(room)
+    with shard_pool_for_room(room).connection() as conn:
+        rows = conn.execute(
+            """SELECT seq, author, created_at, body FROM messages
+               WHERE room_id=? AND seq<? ORDER BY seq DESC LIMIT ?""",
+            (room_id, before_seq if before_seq is not None else 2 ** 63 - 1, limit,),
+        ).fetchall()
+    rows.reverse()
+
+    if len(rows) < limit and room_id is not None:
+        archived_before = rows[0][0] if rows else (before_seq if before_seq is not None else 2 ** 63 - 1)
+        rows[:0] = archive.messages_before(room_id, archived_before, limit - len(rows))
+    return rows
+
+
+def _insert_message(conn, room_id, author, body):
+    """
+    Inserts one message inside the caller's write transaction (on the room's shard) and returns
+    (its sequence number, the created_at we stored) - callers pass that on rather than asking the
+    clock again, so what they show and push matches the row. The shard keeps each room's last sequence number in 'room_sequences',
+    so numbering never has to touch the catalog and carries on after messages are archived.
+    """
+    (seq,) = conn.execute(
+        """INSERT INTO room_sequences (room_id, last_seq) VALUES (?, 1)
+           ON CONFLICT (room_id) DO UPDATE SET last_seq=last_seq + 1 RETURNING last_seq""", (room_id,)
+    ).fetchone()
+    created_at = time.time()
+    conn.execute(
+        "INSERT INTO messages (room_id, seq, author, created_at, body) VALUES (?, ?, ?, ?, ?)",
+        (room_id, seq, author, created_at, body,),
+    )
+    return seq, created_at
+
+
+def add_message_to_room(room, author, body):
+    """
+    Appends a single message to a room and returns (its sequence number, its created_at).
+
+    Sequence numbers increase monotonically per room. 'transaction()' takes the write lock
+    up front so two users posting at once can't both claim the same number.
+    The cost of a send only depends on the size of the message, not on the room's history.
+    """
+    room_id = _require_room_id(room)
+    with shard_pool_for_room(room).transaction() as conn:
+        return _insert_message(conn, room_id, author, body)
+
+
+def submit_message_to_room(room, author, body):
+    """
+    Like 'add_message_to_room', but hands the message to its shard's group-commit writer,
+    so messages sent within a few milliseconds of each other share one commit.
+
+    Returns a concurrent.futures.Future that resolves to (the message's sequence number, its created_at)
+    (in a coroutine: 'seq, created_at = await asyncio.wrap_future(submit_message_to_room(...))').
+    """
+    return writers[_shard_number(room)].submit(_require_room_id(room), author, body)
 
 
 def add_room_in_rooms_table(room_name):
     """
     adds room to room_names column
+
+    Room names are unique - raises sqlite3.IntegrityError if the room already exists.
     """
-    conn = sqlite3.connect('chatroom_app.db')
-    conn.execute("INSERT INTO rooms (room_name, room_content, room_update) VALUES (?, ?, ?)", (room_name, '', '0',))
-    conn.commit()
-    conn.close()
+    try:
+        with pool.transaction() as conn:
+            conn.execute("INSERT INTO rooms (room_name) VALUES (?)", (room_name,))
+    finally:
+        lookup_cache.invalidate(("room", room_name), ("room_id", room_name))
     return
+
+
+configure_db(
+    os.environ.get("CHATROOM_DB_PATH", "chatroom_app.db"),
+    archive_dir=os.environ.get("CHATROOM_ARCHIVE_DIR"),
+    shards=int(os.environ.get("CHATROOM_SHARDS", 0)),
+)
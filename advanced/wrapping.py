@@ -0,0 +1,96 @@
+"""
+Wrapping text for the terminal, and drawing speech bubbles with it.
+
+Widths here are terminal cells, not characters: East Asian wide characters (CJK, most emoji)
+take two cells, and combining marks (accents typed as separate code points) take none - so
+a bubble around "你好" or "é" still lines up. Pure ASCII text, nearly every message, skips
+all of that and is measured with len().
+
+Everything is one pass over the text, collecting pieces in lists and joining them at the
+end, so wrapping is linear in the length of the message. Words wider than a line are broken
+wherever they reach the edge (never between a character and its combining marks).
+"""
+import unicodedata
+from functools import lru_cache
+
+
+@lru_cache(maxsize=4096)
+def char_width(char):
+    """How many terminal cells 'char' takes: 0, 1 or 2"""
+    category = unicodedata.category(char)
+    if category in ("Mn", "Me", "Cf", "Cc") or unicodedata.combining(char):
+        return 0
+    if category != "Cn" and unicodedata.east_asian_width(char) in ("W", "F"):  # (not unassigned code points)
+        return 2
+    return 1
+
+
+def display_width(text):
+    """How many terminal cells 'text' takes"""
+    if text.isascii():
+        return len(text)
+    return sum(map(char_width, text))
+
+
+def cut(text, width):
+    """Breaks 'text' into pieces at most 'width' cells wide (a single character wider than that gets a piece of its own)"""
+    if text.isascii():
+        return [text[i:i + width] for i in range(0, len(text), width)] or [""]
+    pieces = []
+    start = used = 0
+    for i, char in enumerate(text):
+        cells = char_width(char)
+        if used + cells > width and i > start:
+            pieces.append(text[start:i])
+            start, used = i, 0
+        used += cells
+    pieces.append(text[start:])
+    return pieces
+
+
+def wrap(text, width):
+    """
+    Splits 'text' into lines at most 'width' cells wide, breaking between words - and inside
+    words that don't fit on a line of their own. Whitespace between words becomes one space.
+    """
+    measure = len if text.isascii() else display_width
+    lines = []
+    line = []  # the words on the line we're filling
+    used = -1  # ... and how many cells they take, with the spaces between them (-1 makes room for no space before the first)
+    for word in text.split():
+        cells = measure(word)
+        used += 1 + cells
+        if used <= width:
+            line.append(word)
+            continue
+        if line:
+            lines.append(" ".join(line))
+        if cells <= width:
+            line, used = [word], cells
+            continue
+        *full, rest = cut(word, width)
+        lines.extend(full)
+        line, used = [rest], measure(rest)
+    if line:
+        lines.append(" ".join(line))
+    return lines or [""]
+
+
+def draw_bubble(author, text, width=50):
+    """
+    The speech bubble for 'text' by 'author', 'width' cells wide:
+
+        ----------------------
+        | alice: hello there |
+        | everyone           |
+        ----------------------
+    """
+    inner = max(width - 4, 1)
+    text = f"{author}: {text}"
+    measure = len if text.isascii() else display_width
+    edge = "-" * width
+    rows = [edge]
+    for line in wrap(text, inner):
+        rows.append(f"| {line}{' ' * (inner - measure(line))} |")
+    rows.append(edge)
+    return "\n".join(rows)
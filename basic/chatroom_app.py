@@ -243,42 +243,45 @@ class SharedChat(ChatApp):
 
 
 class SpeechBubble:
-    def __init__(self, username, text, line_length=50, inner_line_length=45):
+    def __init__(self, username, text, line_length=50):
         self.username = username
         self.text = text
         self.line_length = line_length
-        self.inner_line_length = inner_line_length
 
-    
-    def wrap_multi_line(self, username, text):
-        wrapped_text = f"{username}: "
-        current_line = ""
-        for word in text.split():
-            if len(current_line) + len(word) > self.inner_line_length:
-                if len(current_line) > 0:
-                    wrapped_text += current_line + " |\n"
-                current_line = f"|{word}"
-            else:
-                current_line += f" {word}"
-    
-            if len(current_line) + len(word) > self.line_length:
-                wrapped_text += current_line + "\n"
-                current_line = word   
 
-        if len(current_line) > 0:
-            wrapped_text += current_line
-                
-        return wrapped_text.strip()
+    def wrap_multi_line(self, username, text):
+        """
+        Splits "username: text" into the bubble's lines, each short enough to fit between its
+        borders. Words are collected in lists and joined once (so long messages don't get
+        slower and slower), and a word too long for a line is cut where it reaches the edge.
+        """
+        inner = max(self.line_length - 4, 1)
+        lines = []
+        line = []
+        used = -1  # the length of 'line' with spaces between its words (-1: no space before the first)
+        for word in f"{username}: {text}".split():
+            used += 1 + len(word)
+            if used <= inner:
+                line.append(word)
+                continue
+            if line:
+                lines.append(" ".join(line))
+            pieces = [word[i:i + inner] for i in range(0, len(word), inner)]
+            lines.extend(pieces[:-1])
+            line, used = [pieces[-1]], len(pieces[-1])
+        if line:
+            lines.append(" ".join(line))
+        return lines
 
 
     def beautify(self):
-        top = "-" * self.line_length
-        bottom = "-" * self.line_length
-        body = f"| {self.wrap_multi_line(self.username, self.text)} |"
-        print(top)
-        print(body)
-        print(bottom)
-        return top + "\n" + bottom + "\n" + body
+        """Prints the speech bubble, and returns it"""
+        inner = max(self.line_length - 4, 1)
+        edge = "-" * self.line_length
+        rows = [f"| {line.ljust(inner)} |" for line in self.wrap_multi_line(self.username, self.text)]
+        bubble = "\n".join([edge, *rows, edge])
+        print(bubble)
+        return bubble
 
 
 if __name__ == "__main__":
@@ -1,7 +1,9 @@
 
 import asyncio
 import sqlite3
+import time
 import pdb
+import unicodedata
 from multiprocessing import Process, Queue
 
 import aioconsole
@@ -34,6 +36,16 @@ class ChatApp:
                          room_update
             );""")
 
+            # one row per message - sending only ever appends, it never rewrites the room's history
+            conn.execute("""CREATE TABLE IF NOT EXISTS messages (
+                         room_name TEXT NOT NULL,
+                         seq INTEGER NOT NULL,
+                         author TEXT,
+                         created_at REAL NOT NULL,
+                         body TEXT NOT NULL,
+                         PRIMARY KEY (room_name, seq)
+            );""")
+
 
     def ensure_logged_in(self):
         '''
@@ -277,26 +289,67 @@ def create_user_and_password(username, password):
     conn.close()
 
 
-def get_room_content_from_db(room):  # calling this seems to duplicate
-    # print("are we calling our precious every time?")
+def get_room_content_from_db(room):
+    """Legacy 'room_content' blob followed by the room's messages, as one string"""
     conn = sqlite3.connect("chatroom_app.db")
     cursor = conn.cursor()
-    cursor.execute("SELECT room_content FROM rooms WHERE room_name=?", (room,))  # ensure you don't fuck oup the database mwehn you change room_content
-    counter = 0
-    # print(f"we're in room_content print cursor.fetchall(): {cursor.fetchall()[0]}")
-    # cursor.execute("SELECT room_content FROM rooms WHERE room_name=?", (room,))
-    for room_content in cursor.fetchall():
-        conn.close()
-        counter += 1
-        assert(counter != 2)  # if this fails, does that fetchall() returned multiple room content values?
-        # print(f"type of get_room_content == {type(room_content[0])}")
-        # print(f"get_room_content itself == {room_content[0]}")
+    cursor.execute("SELECT room_content FROM rooms WHERE room_name=?", (room,))
+    rows = cursor.fetchall()
+    assert(len(rows) == 1)  # if this fails, fetchall() returned zero or multiple room content values
+    legacy_content = rows[0][0] or ''
+
+    cursor.execute("SELECT body FROM messages WHERE room_name=? ORDER BY seq", (room,))
+    content = legacy_content + ''.join(body for (body,) in cursor.fetchall())
+    conn.close()
+    return content
+
+
+def get_room_messages(room):
+    """(seq, author, created_at, body) rows for a room, oldest first"""
+    conn = sqlite3.connect("chatroom_app.db")
+    cursor = conn.cursor()
+    cursor.execute("SELECT seq, author, created_at, body FROM messages WHERE room_name=? ORDER BY seq", (room,))
+    messages = cursor.fetchall()
+    conn.close()
+    return messages
+
+
+def get_room_messages_after(room, after_seq):
+    """(seq, author, created_at, body) rows for a room's messages after 'after_seq', oldest first"""
+    conn = sqlite3.connect("chatroom_app.db")
+    cursor = conn.cursor()
+    cursor.execute("SELECT seq, author, created_at, body FROM messages WHERE room_name=? AND seq>? ORDER BY seq", (room, after_seq,))
+    messages = cursor.fetchall()
+    conn.close()
+    return messages
+
+
+def get_latest_seq(room):
+    """The sequence number of a room's latest message (0 if it has none)"""
+    conn = sqlite3.connect("chatroom_app.db")
+    (seq,) = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM messages WHERE room_name=?", (room,)).fetchone()
+    conn.close()
+    return seq
+
+
+def add_message_to_room(room, author, body):
+    """Appends a single message to a room and returns its (per-room, monotonically increasing) sequence number"""
+    conn = sqlite3.connect("chatroom_app.db", isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        (seq,) = conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM messages WHERE room_name=?", (room,)).fetchone()
+        conn.execute(
+            "INSERT INTO messages (room_name, seq, author, created_at, body) VALUES (?, ?, ?, ?, ?)",
+            (room, seq, author, time.time(), body,),
+        )
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
         conn.close()
-        return room_content[0]
-    
-    # print(f"inspect cursor: {cursor.fetchall()[0]}")
-    conn.close()  # we should never reach here
-    assert(counter != 0)  # make sure you don't pass the room_content variable again lol
+    return seq
 
 
 def add_room_in_rooms_table(room_name):
@@ -322,24 +375,12 @@ class SharedChat(ChatApp):
     def __init__(self, current_user, room):
         super().__init__(current_user, current_room)
         self.current_room = room  # note, we override the parent class' self.current_room method
-        self.room_content = ''
+        self.last_seq = 0  # the latest message in the room we've shown - we never keep the whole history around
 
 
     async def update_room_content_class_db(self, message, room):  # ensure 'message' here is already beautified 
-        conn = sqlite3.connect("chatroom_app.db")
-        cursor = conn.cursor()
-
-        pre_update_content = self.room_content
-        if self.room_content == '':  # if we're just joining the chat, we check if there's previous chat history - if not, we initialize with ''
-            pre_update_content = get_room_content_from_db(room)
-
-        self.room_content = pre_update_content + message  # basically gets the current room content and appends user's message
-
-        cursor.execute("UPDATE rooms SET room_content=? WHERE room_name=?", (self.room_content, room,))
-        conn.commit()
-        conn.close()
-
-        # print("ran conn close - do we finish the update class/db func?")
+        # a send only appends one row, it doesn't rewrite the whole room
+        add_message_to_room(room, self.current_user, message)
         return
     
 
@@ -378,7 +419,6 @@ class SharedChat(ChatApp):
             cursor = conn.cursor()
             cursor.execute("SELECT room_update FROM rooms WHERE room_name=?", (self.current_room,))
             if cursor.fetchall()[0] == '1':
-                self.room_content = get_room_content_from_db(self.current_room)
                 print(get_room_content_from_db(self.current_room), flush=True)
                 cursor.execute("UPDATE rooms set room_update=? WHERE room_name=?", ('0', self.current_room,))
                 conn.commit()
@@ -394,8 +434,11 @@ class SharedChat(ChatApp):
             # self.room_content += beautified_message
             # update room content in class attribute and database
 
-            new_content = get_room_content_from_db(self.current_room).replace(self.room_content, "")
-            print(f"new content == {new_content}")
+            # what the others said since we last looked - just the rows after the last one we've seen
+            for seq, author, _created_at, body in get_room_messages_after(self.current_room, self.last_seq):
+                if author != self.current_user:  # (ours were printed as we sent them)
+                    print(body, flush=True)
+                self.last_seq = seq
 
             await self.update_room_content_class_db(await bubble.beautify(), self.current_room)  # add user input to database - should the be a class method or unattached (does it rely on aioconsole?)
     
@@ -462,6 +505,7 @@ class SharedChat(ChatApp):
 
         Caller performs error checking for the room name.
         """
+        self.last_seq = get_latest_seq(room)  # (first - a message sent meanwhile is then shown twice, rather than never)
         chat_history = get_room_content_from_db(room)
         if chat_history == '':
             await aioconsole.aprint(f"Congratulations on joining {room}!")
@@ -479,42 +523,73 @@ class SharedChat(ChatApp):
 
 
 class SpeechBubble:
-    def __init__(self, username, text, line_length=50, inner_line_length=45):
+    def __init__(self, username, text, line_length=50):
         self.username = username
         self.text = text
         self.line_length = line_length
-        self.inner_line_length = inner_line_length
 
-    
-    def wrap_multi_line(self, username, text):
-        wrapped_text = f"{username}: "
-        current_line = ""
-        for word in text.split():
-            if len(current_line) + len(word) > self.inner_line_length:
-                if len(current_line) > 0:
-                    wrapped_text += current_line + " |\n"
-                current_line = f"|{word}"
-            else:
-                current_line += f" {word}"
-    
-            if len(current_line) + len(word) > self.line_length:
-                wrapped_text += current_line + "\n"
-                current_line = word   
 
-        if len(current_line) > 0:
-            wrapped_text += current_line
-                
-        return wrapped_text.strip()
+    @staticmethod
+    def width(text):
+        """Terminal cells 'text' takes - East Asian wide characters take two, combining marks none"""
+        if text.isascii():
+            return len(text)
+        cells = 0
+        for char in text:
+            if unicodedata.combining(char) or unicodedata.category(char) in ("Mn", "Me", "Cf", "Cc"):
+                continue
+            cells += 2 if unicodedata.east_asian_width(char) in ("W", "F") else 1
+        return cells
+
+
+    def cut(self, word, width):
+        """Breaks a word too wide for a line into pieces that fit"""
+        pieces = []
+        start = used = 0
+        for i, char in enumerate(word):
+            cells = self.width(char)
+            if used + cells > width and i > start:
+                pieces.append(word[start:i])
+                start, used = i, 0
+            used += cells
+        pieces.append(word[start:])
+        return pieces
+
+
+    def wrap_multi_line(self, username, text):
+        """
+        Splits "username: text" into the bubble's lines, each narrow enough (in terminal cells)
+        to fit between its borders. Words are collected in lists and joined once, and a word
+        too wide for a line is cut where it reaches the edge.
+        """
+        inner = max(self.line_length - 4, 1)
+        lines = []
+        line = []
+        used = -1  # the cells 'line' takes with spaces between its words (-1: no space before the first)
+        for word in f"{username}: {text}".split():
+            cells = self.width(word)
+            used += 1 + cells
+            if used <= inner:
+                line.append(word)
+                continue
+            if line:
+                lines.append(" ".join(line))
+            *full, rest = self.cut(word, inner) if cells > inner else [word]
+            lines.extend(full)
+            line, used = [rest], self.width(rest)
+        if line:
+            lines.append(" ".join(line))
+        return lines
 
 
     async def beautify(self):
-        top = "-" * self.line_length
-        bottom = "-" * self.line_length
-        body = f"| {self.wrap_multi_line(self.username, self.text)} |"
-        await aioconsole.aprint(top)
-        await aioconsole.aprint(body)
-        await aioconsole.aprint(bottom)
-        return top + "\n" + body + "\n" + bottom
+        """Prints the speech bubble, and returns it"""
+        inner = max(self.line_length - 4, 1)
+        edge = "-" * self.line_length
+        rows = [f"| {line}{' ' * (inner - self.width(line))} |" for line in self.wrap_multi_line(self.username, self.text)]
+        bubble = "\n".join([edge, *rows, edge])
+        await aioconsole.aprint(bubble)
+        return bubble
 
 
 if __name__ == "__main__":